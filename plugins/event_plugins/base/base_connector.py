@@ -1,4 +1,6 @@
 # -*- coding: UTF-8 -*-
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 from airflow.utils.log.logging_mixin import LoggingMixin
 
@@ -20,7 +22,36 @@ class BaseConnector(LoggingMixin):
             implement how to get messages, and return message in list format
         ''')
 
+    def iter_batches(self):
+        ''' Yield the messages of get_messages in batches as they are consumed,
+            override if the source is consumed batch by batch
+        '''
+        yield self.get_messages()
+
     def close(self):
         raise NotImplementedError('''
             implement how to close connection, such as self.consumer.close()
         ''')
+
+
+def prefetch(batches, depth=1):
+    ''' Yield items of batches while the next `depth` items are fetched by a thread,
+        e.g. consume the next batch of messages while the previous one is stored.
+        Only the thread touches the iterator, it's stopped after the current fetch
+        when the generator is closed
+    '''
+    iterator = iter(batches)
+    pool = ThreadPool(1)
+    try:
+        # tasks of one thread run in order, so the iterator is never called concurrently
+        pending = deque(pool.apply_async(next, (iterator, )) for _ in range(depth))
+        while pending:
+            try:
+                batch = pending.popleft().get()
+            except StopIteration:
+                return
+            pending.append(pool.apply_async(next, (iterator, )))
+            yield batch
+    finally:
+        pool.terminate()
+        pool.join()
@@ -1,7 +1,10 @@
 # -*- coding: UTF-8 -*-
 
+import logging
 import os
 import time
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
 
 from airflow.exceptions import AirflowException, AirflowSensorTimeout, \
     AirflowSkipException, AirflowRescheduleException
@@ -13,6 +16,9 @@ from airflow.settings import Session
 from airflow.ti_deps.deps.ready_to_reschedule import ReadyToRescheduleDep
 
 from event_plugins import factory
+from event_plugins.base.base_connector import prefetch
+from event_plugins.common.metrics import PokeMetrics
+from event_plugins.common.schedule.spread import WakeUpSpreader, get_max_wakeups_per_sec
 from event_plugins.common.schedule.timeout import TaskTimeout
 from event_plugins.common.schedule.time_utils import TimeUtils
 from event_plugins.common.status import DBStatus
@@ -28,6 +34,10 @@ class BaseConsumerOperator(BaseOperator, SuccessMixin, SkipMixin):
 
     source_type = 'base'
 
+    conn_handler = None
+    # status db is initialized by execute, skip initializing it again in the first poke
+    db_initialized = False
+
     @apply_defaults
     def __init__(self,
                  msgs,
@@ -39,6 +49,12 @@ class BaseConsumerOperator(BaseOperator, SuccessMixin, SkipMixin):
                  status_file=None,
                  debug_mode=False,
                  sensor_name=None,
+                 jitter=0,
+                 tabulate_interval=0,
+                 tabulate_changed_only=False,
+                 match_workers=1,
+                 prefetch_batches=0,
+                 write_behind=False,
                  *args,
                  **kwargs):
         super(BaseConsumerOperator, self).__init__(*args, **kwargs)
@@ -47,13 +63,26 @@ class BaseConsumerOperator(BaseOperator, SuccessMixin, SkipMixin):
         self.poke_interval = poke_interval
         self.soft_fail = soft_fail
         self.debug_mode = debug_mode
+        self.tabulate_interval = tabulate_interval
+        self.tabulate_changed_only = tabulate_changed_only
+        self.last_tabulate_at = None
+        self.match_workers = match_workers
+        self.prefetch_batches = prefetch_batches
+        # matched messages of the poke whose tasks are marked success after their
+        # receive updates are drained, (wanted message, event time, receive time)
+        self.drained_to_mark = list()
 
         # check parameters
         if sensor_name is None:
             sensor_name = ".".join([self.dag.dag_id, self.task_id])
+        self.sensor_name = sensor_name
         self.set_mode(mode)
         self.set_db_handler(sensor_name)
+        if write_behind:
+            self.db_handler.set_write_behind()
         self.set_all_msgs_handler(msgs)
+        self.spreader = WakeUpSpreader(sensor_name, jitter, get_max_wakeups_per_sec())
+        self.metrics = PokeMetrics('event_plugins.{}'.format(sensor_name))
 
     def set_mode(self, mode):
         if mode not in self.valid_modes:
@@ -73,39 +102,218 @@ class BaseConsumerOperator(BaseOperator, SuccessMixin, SkipMixin):
         self.all_msgs_handler = factory.plugin_factory(self.source_type).all_msgs_handler(msgs)
 
     def poke(self, context, consumer):
-        # initialize or update messages in status db before consuming messages
-        self.initialize_db_handler()
-        # start conuming and matching messages
-        msg_list = consumer.get_messages()
-        receive_dt = TimeUtils().get_now()
+        metrics = self.metrics
+        with metrics.count_queries(self.db_handler.session):
+            # initialize or update messages in status db before consuming messages,
+            # unless execute has just done it before the first poke
+            if self.db_initialized:
+                self.db_initialized = False
+            else:
+                with metrics.stage('db_init'):
+                    self.initialize_db_handler()
+            # start conuming and matching messages
+            self.before_consume(consumer)
+            received_msgs = list()
+            self.drained_to_mark = list()
+            with closing(self.iter_batches(consumer)) as batches:
+                for msg_list in batches:
+                    metrics.incr('consumed', len(msg_list))
+                    receive_dt = TimeUtils().get_now()
+                    received_msgs.extend(self.receive_messages(context, msg_list, receive_dt))
+            # updates of write-behind are stored before they are read or offsets are stored
+            with metrics.stage('db_write'):
+                self.db_handler.drain()
+            self.mark_success_drained(context)
+
+            # mark skip if last_receive_time is not None and task status is None (received before)
+            if self.mark_success:
+                self._mark_skip_received_before(context, received_msgs)
+            self.after_consume(consumer)
+            is_criteria_met = self.is_criteria_met()
+        self.emit_metrics()
+        return is_criteria_met
+
+    def iter_batches(self, consumer):
+        ''' Consumed messages of a poke. If prefetch_batches > 0, consume batch by batch
+            by a thread, which fetches the next batches while the poke thread matches and
+            stores the current one. Otherwise all messages are consumed as one batch.
+            Time waiting for messages is recorded as consume
+        '''
+        if self.prefetch_batches <= 0:
+            with self.metrics.stage('consume'):
+                msg_list = consumer.get_messages()
+            yield msg_list
+            return
+        batches = prefetch(consumer.iter_batches(), self.prefetch_batches)
+        try:
+            for msg_list in self.metrics.timer.iterate(batches, 'consume'):
+                yield msg_list
+        finally:
+            batches.close()
+
+    def receive_messages(self, context, msg_list, receive_dt):
+        ''' Decode and match a batch of consumed messages, store the matched ones and
+            mark their tasks success (after poke drains them if write-behind)
+            Returns:
+                wanted messages received in the batch
+        '''
+        metrics = self.metrics
         received_msgs = list()
-        for msg in msg_list:
+        rows, matches, errors = self.decode_and_match(msg_list, receive_dt)
+        for i, (_, decoded, msg_value) in enumerate(rows):
+            if i in errors:
+                metrics.incr('skipped')
+                if self.debug_mode:
+                    self.log.warning(errors[i])
+                    self.log.warning('[SkipMessage] {}'.format(msg_value))
+            elif i in matches:
+                match_wanted, receive_msg = matches[i]
+                event_dt = self.all_msgs_handler.event_time(decoded)
+                metrics.incr('matched')
+                received_msgs.append(match_wanted)
+                # success time is stored with the receive update before marking the task,
+                # so that each matched message costs one write. With write-behind, tasks
+                # are marked after the updates are drained by mark_success_drained
+                mark_now = self.mark_success and self.db_handler.writer is None
+                success_dt = TimeUtils().get_now() if mark_now else None
+                with metrics.stage('db_write'):
+                    self.db_handler.update_on_receive(match_wanted, receive_msg,
+                                                      event_dt, receive_dt, success_dt)
+                self.observe_latency('consume', event_dt, receive_dt, match_wanted)
+                if self.debug_mode:
+                    self.log.info("Received wanted data: {}".format(msg_value))
+                if mark_now:
+                    self.mark_success_received(context, match_wanted, event_dt, receive_dt,
+                                               success_dt)
+                elif self.mark_success:
+                    self.drained_to_mark.append((match_wanted, event_dt, receive_dt))
+            elif self.debug_mode:
+                self.log.info('Received message and pass: {}'.format(msg_value))
+        return received_msgs
+
+    def mark_success_received(self, context, match_wanted, event_dt, receive_dt, success_dt):
+        self._mark_success_task_by_id(context, match_wanted['task_id'])
+        self.observe_latency('success', receive_dt, success_dt, match_wanted)
+        self.observe_latency('total', event_dt, success_dt, match_wanted)
+
+    def mark_success_drained(self, context):
+        ''' Mark tasks of the messages received with write-behind, after their receive
+            updates are drained. Success times are queued and written by the next flush
+        '''
+        to_mark, self.drained_to_mark = self.drained_to_mark, list()
+        for match_wanted, event_dt, receive_dt in to_mark:
+            success_dt = TimeUtils().get_now()
+            self.mark_success_received(context, match_wanted, event_dt, receive_dt, success_dt)
+            with self.metrics.stage('db_write'):
+                self.db_handler.update_on_success(match_wanted, success_dt)
+
+    def shard_key(self, msg):
+        ''' Messages of the same key are decoded and matched in order by one worker,
+            override to shard by e.g. partition of source
+        '''
+        return None
+
+    def decode_and_match(self, msg_list, receive_dt):
+        ''' Decode and match consumed messages. If match_workers > 1, shards of messages
+            are decoded and matched by a pool of threads, the results are collected in
+            the consumed order so that the status db is only written by the poke thread
+            Returns:
+                rows (list): (index in msg_list, decoded message, raw value) of messages
+                    not skipped by decoding
+                matches, errors (dict): results of match_batch, keyed by index in rows
+        '''
+        shards = dict()
+        if self.match_workers > 1:
+            for i, msg in enumerate(msg_list):
+                shards.setdefault(self.shard_key(msg), list()).append((i, msg))
+        if len(shards) <= 1:
+            return self._decode_and_match(list(enumerate(msg_list)), receive_dt, self.metrics)
+
+        # every worker takes whole shards, so that the order in a shard is kept
+        num_workers = min(self.match_workers, len(shards))
+        work = [list() for _ in range(num_workers)]
+        for n, key in enumerate(sorted(shards, key=lambda k: -len(shards[k]))):
+            work[n % num_workers].extend(shards[key])
+
+        def run(indexed_msgs):
+            metrics = PokeMetrics(self.metrics.prefix)
+            return self._decode_and_match(indexed_msgs, receive_dt, metrics) + (metrics, )
+
+        pool = ThreadPool(num_workers)
+        try:
+            with self.metrics.stage('parallel_match'):
+                results = pool.map(run, work)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        merged = list()
+        for worker_rows, worker_matches, worker_errors, metrics in results:
+            self.metrics.merge(metrics)
+            for n, row in enumerate(worker_rows):
+                merged.append((row, worker_matches.get(n), worker_errors.get(n)))
+        merged.sort(key=lambda r: r[0][0])
+        rows, matches, errors = list(), dict(), dict()
+        for n, (row, match, error) in enumerate(merged):
+            rows.append(row)
+            if match is not None:
+                matches[n] = match
+            if error is not None:
+                errors[n] = error
+        return rows, matches, errors
+
+    def _decode_and_match(self, indexed_msgs, receive_dt, metrics):
+        rows = self.decode_messages(indexed_msgs, metrics)
+        with metrics.stage('match'):
+            matches, errors = self.all_msgs_handler.match_batch([r[1] for r in rows], receive_dt)
+        return rows, matches, errors
+
+    def decode_messages(self, indexed_msgs, metrics):
+        ''' Decode consumed messages before matching, skip the ones failed to decode
+            or not needed (e.g. topic paused)
+            Args:
+                indexed_msgs (list): (index, message) of consumed messages
+                metrics (PokeMetrics): where decode time and skipped messages are recorded
+            Returns:
+                (index, decoded message, raw value) of messages not skipped,
+                raw value is logged in debug mode
+        '''
+        rows = list()
+        for i, msg in indexed_msgs:
+            msg_value = None
             try:
                 msg_value = factory.plugin_factory(self.source_type) \
                                 .msg_handler(msg=msg, mtype='receive').value()
-                match_wanted, receive_msg = self.all_msgs_handler.match(msg, receive_dt)
+                with metrics.stage('decode'):
+                    decoded = self.all_msgs_handler.decode(msg)
             except Exception, e:
+                metrics.incr('skipped')
                 if self.debug_mode:
                     self.log.warning(e)
                     self.log.warning('[SkipMessage] {}'.format(msg_value))
-            else:
-                if match_wanted is not None:
-                    received_msgs.append(match_wanted)
-                    self.db_handler.update_on_receive(match_wanted, receive_msg)
-                    if self.debug_mode:
-                        self.log.info("Received wanted data: {}".format(msg_value))
-                        self.log.info(self.db_handler.tabulate_data())
-                    if self.mark_success:
-                        self._mark_success_task_by_id(context, match_wanted['task_id'])
-                else:
-                    if self.debug_mode:
-                        self.log.info('Received message and pass: {}'.format(msg_value))
-
-        # mark skip if last_receive_time is not None and task status is None (received before)
-        if self.mark_success:
-            for have_successed_msg in self.db_handler.have_successed_msgs(received_msgs):
-                self._mark_skip_task_by_id(context, have_successed_msg['task_id'])
-        return self.is_criteria_met()
+                continue
+            if decoded is None:
+                metrics.incr('skipped')
+                continue
+            rows.append((i, decoded, msg_value))
+        return rows
+
+    def observe_latency(self, name, start_dt, end_dt, wanted_msg):
+        ''' Record seconds between two moments of a matched message
+            consume: produced -> consumed, includes broker delay and poke interval
+            success: consumed -> task marked success, includes status db writes
+            total: produced -> task marked success
+        '''
+        if start_dt is None:
+            return
+        self.metrics.observe('latency.{}'.format(name), (end_dt - start_dt).total_seconds(),
+                             topic=wanted_msg.get('topic'))
+
+    def emit_metrics(self):
+        # send the metrics of current poke to statsd and summarize in one line
+        self.metrics.emit()
+        self.log.info('poke summary: {}'.format(self.metrics))
+        self.metrics.reset()
 
     def execute(self, context):
         if self.mark_success:
@@ -114,8 +322,23 @@ class BaseConsumerOperator(BaseOperator, SuccessMixin, SkipMixin):
             if self.debug_mode:
                 self.log.info('downstream task {}'.format(self.downstream_tasks_map.keys()))
 
-        # initialize connector
-        self.initialize_conn_handler()
+        # check status db before connecting to source, messages with frequency 'M' might
+        # have been received in previous runs
+        with self.metrics.stage('db_init'):
+            self.initialize_db_handler()
+        self.db_initialized = True
+        if self.db_handler.status() == DBStatus.ALL_RECEIVED:
+            self.log.info('all wanted messages have been received before, skip connecting to source')
+            if self.mark_success:
+                self._mark_skip_received_before(context, list())
+            self.is_criteria_met()
+            self.emit_metrics()
+            self.close_connection()
+            return
+
+        # initialize connector, the time is reported with the first poke
+        with self.metrics.stage('connect'):
+            self.initialize_conn_handler()
         started_at = TimeUtils().get_now()
 
         # If reschedule, use first start date of current try
@@ -135,9 +358,11 @@ class BaseConsumerOperator(BaseOperator, SuccessMixin, SkipMixin):
             if self.poke(context, self.conn_handler):
                 break
 
-            # check if next schedule is timeout, set last time poke before actually timeout
+            # check if next schedule is timeout, set last time poke before actually timeout.
+            # the spread delay can be longer than poke_interval, check with the actual one
+            delay = self.next_poke_delay()
             timeout_handler.execute_last_poke_after_secs = None
-            if timeout_handler.is_next_poke_timeout():
+            if timeout_handler.is_next_poke_timeout(delay=delay):
                 self.log.info('next poke will exceed timeout: {}'.format(timeout_handler.timeout_dt))
                 if timeout_handler.execute_last_poke_after_secs:
                     self.log.info('poke after {}s'.format(
@@ -146,7 +371,9 @@ class BaseConsumerOperator(BaseOperator, SuccessMixin, SkipMixin):
                 else:
                     self.handle_timeout(context)
             else:
-                self.schedule_next_time(self.poke_interval)
+                if self.debug_mode:
+                    self.log.info('next poke after {}s'.format(delay))
+                self.schedule_next_time(delay)
 
         # critieria met
         self.close_connection()
@@ -155,11 +382,24 @@ class BaseConsumerOperator(BaseOperator, SuccessMixin, SkipMixin):
     def close_connection(self):
         # close connection before exit
         # 1. close connection to source
-        self.conn_handler.close()
-        # 2. close db connection if not using airflow database to store messages status
+        if self.conn_handler:
+            self.conn_handler.close()
+        # 2. write the pending updates of status db
+        self.db_handler.close_writer()
+        # 3. close db connection if not using airflow database to store messages status
         if USE_AIRFLOW_DATABASE is False:
             self.db_handler.session.remove()
 
+    def next_poke_delay(self):
+        ''' Seconds to the next poke, poke_interval spread by jitter and the slot of
+            sensor if wake-ups are rate limited. Slots are cached per process, see
+            EventMessageCRUD.get_sensor_slot
+        '''
+        if not self.spreader.rate_limited:
+            return self.spreader.delay(self.poke_interval, time.time())
+        fleet_size, slot = self.db_handler.get_sensor_slot()
+        return self.spreader.delay(self.poke_interval, time.time(), fleet_size, slot)
+
     def schedule_next_time(self, seconds):
         # handle different mode: reschedule or poke
         if self.reschedule:
@@ -181,13 +421,21 @@ class BaseConsumerOperator(BaseOperator, SuccessMixin, SkipMixin):
     def initialize_conn_handler(self):
         raise NotImplementedError('implement how to connect to source and return connector')
 
+    def before_consume(self, consumer):
+        # invoked after status db is initialized and before consuming messages,
+        # override to adjust the connector, e.g. topics that still need to be consumed
+        pass
+
+    def after_consume(self, consumer):
+        # invoked after received messages are stored in status db,
+        # override to persist the state of connector, e.g. consumed offsets
+        pass
+
     def initialize_db_handler(self):
         # Initialize status DB, clear last_receive_time if msg timeout
         # override if you need to render the messages
         msgs = self.all_msgs_handler.get_wanted_msgs()
         self.db_handler.initialize(msg_list=msgs)
-        if self.debug_mode:
-            self.log.info(self.db_handler.tabulate_data())
 
     def is_criteria_met(self):
         # check if condition met before exist poke function
@@ -195,14 +443,33 @@ class BaseConsumerOperator(BaseOperator, SuccessMixin, SkipMixin):
         if self.debug_mode:
             threshold = None
         if self.db_handler.status() == DBStatus.ALL_RECEIVED:
-            self.log.info(self.db_handler.tabulate_data(threshold=threshold))
+            self.log_status_table(threshold=threshold, force=True)
             return True
         elif self.db_handler.status() == DBStatus.NOT_ALL_RECEIVED:
             unreceived_rmsgs = self.db_handler.get_unreceived_msgs()
-            self.log.info(self.db_handler.tabulate_data(threshold=threshold))
+            self.log_status_table(threshold=threshold)
             self.log.info('criteria not met in this round, require msgs {}'.format(unreceived_rmsgs))
             return False
 
+    def log_status_table(self, threshold=None, force=False):
+        ''' Log messages in status db as table, at most once every tabulate_interval seconds
+            Args:
+                threshold(int): max length of value in each cell
+                force(bool): log even if tabulate_interval is not passed, e.g. criteria met
+        '''
+        if not self.log.isEnabledFor(logging.INFO):
+            return
+        now = time.time()
+        if not force and self.last_tabulate_at is not None \
+                and now - self.last_tabulate_at < self.tabulate_interval:
+            return
+        self.last_tabulate_at = now
+        with self.metrics.stage('tabulate'):
+            table = self.db_handler.tabulate_data(threshold=threshold,
+                                                  changed_only=self.tabulate_changed_only)
+        if table is not None:
+            self.log.info(table)
+
     @property
     def reschedule(self):
         return self.mode == 'reschedule'
@@ -220,6 +487,10 @@ class BaseConsumerOperator(BaseOperator, SuccessMixin, SkipMixin):
         self.log.info('mark task success: {}'.format(task_id))
         self.success(context['dag_run'], context['ti'].execution_date, [ti])
 
+    def _mark_skip_received_before(self, context, received_msgs):
+        for have_successed_msg in self.db_handler.have_successed_msgs(received_msgs):
+            self._mark_skip_task_by_id(context, have_successed_msg['task_id'])
+
     def _mark_skip_task_by_id(self, context, task_id):
         ti = self.downstream_tasks_map[task_id]
         if ti.current_state() == State.NONE:
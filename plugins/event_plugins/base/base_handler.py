@@ -40,6 +40,16 @@ class BaseAllMessageHandler(object):
             if would be invoked to skip unexecuted tasks when soft_fail=True
         """)
 
+    def decode(self, receive_msg):
+        ''' Decode the message from source before matching, override if decoding is not
+            trivial so that it is measured separately. Return None to skip the message
+        '''
+        return receive_msg
+
+    def event_time(self, receive_msg):
+        ''' When the decoded message was produced, None if unknown '''
+        return None
+
     def match(self, receive_msg, receive_dt):
         raise NotImplementedError("""
             implement how to check if receive message match any message in wanted messages,
@@ -47,6 +57,24 @@ class BaseAllMessageHandler(object):
             else None
         """)
 
+    def match_batch(self, receive_msgs, receive_dt):
+        ''' Match decoded messages consumed in one poke, override if they could be
+            matched faster together than one by one
+            Returns:
+                matches (dict): {index in receive_msgs: (wanted message, received message)}
+                errors (dict): {index in receive_msgs: exception raised by matching}
+        '''
+        matches, errors = dict(), dict()
+        for i, receive_msg in enumerate(receive_msgs):
+            try:
+                match_wanted, match_receive = self.match(receive_msg, receive_dt)
+            except Exception, e:
+                errors[i] = e
+            else:
+                if match_wanted is not None:
+                    matches[i] = (match_wanted, match_receive)
+        return matches, errors
+
 
 class BaseSingleMessageHandler(object):
     ''' Handle single msg (json format)
@@ -0,0 +1,127 @@
+# -*- coding: UTF-8 -*-
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+try:
+    from airflow.stats import Stats
+except ImportError:
+    # airflow < 1.10.7
+    from airflow.settings import Stats
+
+
+class StageTimer(object):
+    ''' Accumulate seconds spent in each stage of a pipeline
+        Stages are reported in the order they are first recorded
+    '''
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def get(self, name):
+        return self.stages.get(name, 0)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - started)
+
+    def iterate(self, iterable, name):
+        ''' Yield items of iterable and record the time waiting for each item as `name` '''
+        iterator = iter(iterable)
+        while True:
+            started = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.time() - started)
+                return
+            self.add(name, time.time() - started)
+            yield item
+
+    def __str__(self):
+        return ', '.join('{}: {:.3f}s'.format(k, v) for k, v in self.stages.iteritems())
+
+
+class PokeMetrics(object):
+    ''' Timers and counters of the stages in one poke, emitted through airflow Stats
+        Args:
+            prefix(str): prefix of the stat names, e.g. event_plugins.<sensor_name>
+    '''
+
+    def __init__(self, prefix, topic_prefix='event_plugins.topic'):
+        self.prefix = prefix
+        self.topic_prefix = topic_prefix
+        self.reset()
+
+    def reset(self):
+        self.timer = StageTimer()
+        self.counters = OrderedDict()
+        self.observations = list()
+        self.gauges = OrderedDict()
+
+    def stage(self, name):
+        return self.timer.stage(name)
+
+    def incr(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, seconds, topic=None):
+        ''' Record a value of histogram, aggregated per sensor and per topic if given '''
+        self.observations.append((name, seconds, topic))
+
+    def merge(self, other):
+        ''' Add the timers, counters and observations of other, e.g. recorded by a worker
+            thread, timers are summed over workers
+        '''
+        for name, seconds in other.timer.stages.iteritems():
+            self.timer.add(name, seconds)
+        for name, count in other.counters.iteritems():
+            self.incr(name, count)
+        self.observations.extend(other.observations)
+        self.gauges.update(other.gauges)
+
+    @contextmanager
+    def count_queries(self, session):
+        ''' Count the statements executed through the engine of session as db_queries '''
+        engine = session.get_bind()
+
+        def on_execute(*args, **kwargs):
+            self.incr('db_queries')
+
+        event.listen(engine, 'before_cursor_execute', on_execute)
+        try:
+            yield
+        finally:
+            event.remove(engine, 'before_cursor_execute', on_execute)
+
+    def emit(self):
+        for name, seconds in self.timer.stages.iteritems():
+            Stats.timing('{}.{}'.format(self.prefix, name), seconds * 1000)
+        for name, count in self.counters.iteritems():
+            Stats.incr('{}.{}'.format(self.prefix, name), count)
+        for name, value in self.gauges.iteritems():
+            Stats.gauge('{}.{}'.format(self.prefix, name), value)
+        for name, seconds, topic in self.observations:
+            Stats.timing('{}.{}'.format(self.prefix, name), seconds * 1000)
+            if topic:
+                Stats.timing('{}.{}.{}'.format(self.topic_prefix, topic, name), seconds * 1000)
+
+    def __str__(self):
+        counters = ', '.join('{}: {}'.format(k, v) for k, v in self.counters.iteritems())
+        max_values = OrderedDict()
+        for name, seconds, _ in self.observations:
+            max_values[name] = max(max_values.get(name, seconds), seconds)
+        observations = ', '.join('{} max: {:.3f}s'.format(k, v) for k, v in max_values.iteritems())
+        return ', '.join(v for v in [counters, str(self.timer), observations] if v)
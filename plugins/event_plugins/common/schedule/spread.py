@@ -0,0 +1,75 @@
+# -*- coding: UTF-8 -*-
+from __future__ import division
+
+import hashlib
+import math
+
+from event_plugins.common.storage.db import STORAGE_CONF
+
+
+def get_max_wakeups_per_sec():
+    ''' Global limit of sensor wake-ups per second, None if not set in config '''
+    if STORAGE_CONF.has_option("Schedule", "max_wakeups_per_second"):
+        value = STORAGE_CONF.get("Schedule", "max_wakeups_per_second")
+        if value.strip() != '':
+            return float(value)
+    return None
+
+
+class WakeUpSpreader(object):
+    ''' Spread the wake-ups of sensors sharing the same poke_interval
+        Args:
+            sensor_name(str): seed of the deterministic phase of the sensor
+            jitter(int): max seconds added to every poke interval, the actual value is
+                phase * jitter so that it's stable for the same sensor among reschedules
+            max_wakeups_per_sec(float): global limit of wake-ups. If set, every sensor
+                only wakes up on its own slot of a grid with period fleet_size / limit.
+                Slots are 1 / limit seconds apart, so the fleet wakes up at most `limit`
+                times per second if every sensor is given a distinct slot, see delay
+    '''
+
+    def __init__(self, sensor_name, jitter=0, max_wakeups_per_sec=None):
+        self.sensor_name = sensor_name
+        self.jitter = jitter or 0
+        self.max_wakeups_per_sec = max_wakeups_per_sec
+        digest = hashlib.md5(sensor_name.encode('utf-8')).hexdigest()
+        self.phase = int(digest[:8], 16) / float(0x100000000)
+
+    @property
+    def rate_limited(self):
+        return bool(self.max_wakeups_per_sec)
+
+    def max_delay(self, seconds, fleet_size=1):
+        '''Get the upper bound of delay among all sensors and times, i.e. seconds plus
+            the max jitter, and the period of slots if rate limited (the next slot is
+            less than a period after seconds + jitter)
+        '''
+        max_delay = seconds + self.jitter
+        if self.rate_limited:
+            max_delay += max(fleet_size, 1) / self.max_wakeups_per_sec
+        return max_delay
+
+    def delay(self, seconds, now_ts, fleet_size=1, slot=None):
+        '''Get seconds to wait before next wake-up
+            Args:
+                seconds(int): poke interval
+                now_ts(float): timestamp of now
+                fleet_size(int): number of sensors sharing the rate limit
+                slot(int): distinct index of sensor in the fleet, 0 ~ fleet_size - 1.
+                    If not given, the slot is picked by phase and sensors may share
+                    a slot, so the limit is only kept on average
+            Returns:
+                delay(float): seconds, not less than `seconds`
+        '''
+        delay = seconds + self.phase * self.jitter
+        if not self.rate_limited:
+            return delay
+        fleet_size = max(fleet_size, 1)
+        period = fleet_size / self.max_wakeups_per_sec
+        if slot is None:
+            offset = self.phase * period
+        else:
+            offset = (slot % fleet_size) / self.max_wakeups_per_sec
+        target_ts = now_ts + delay
+        slot_ts = math.ceil((target_ts - offset) / period) * period + offset
+        return slot_ts - now_ts
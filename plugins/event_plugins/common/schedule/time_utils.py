@@ -1,6 +1,8 @@
 # -*- coding: UTF-8 -*-
 from __future__ import print_function
 
+import bisect
+import calendar
 import datetime as dt
 from dateutil.relativedelta import relativedelta
 from dateutil.parser import parse
@@ -30,6 +32,12 @@ class TimeUtils(object):
     def get_now(cls, tz=AIRFLOW_EVENT_PLUGINS_TIMEZONE):
         return cls.make_aware(dt.datetime.now(), tz)
 
+    def get_now_ts(cls):
+        ''' Unix timestamp of get_now, cheaper to compare with than a datetime.
+            Patch it together with get_now to move the clock
+        '''
+        return time.time()
+
     def datetime(cls, *args, **kwargs):
         # TODO: using timezone.datetime from airflow
         return dt.datetime(*args, **kwargs)
@@ -141,6 +149,146 @@ class TimeUtils(object):
             base = dt.datetime.fromtimestamp(base)
         return base.strftime(fmt)
 
+    def cvt_timestamp2datetime(cls, timestamp, tz=AIRFLOW_EVENT_PLUGINS_TIMEZONE):
+        '''Convert unix timestamp (seconds) to time-aware datetime in tz '''
+        return dt.datetime.fromtimestamp(timestamp, tz)
+
     def time_delta(cls, dt1, dt2):
         ''' Time delta between two datetime '''
         return relativedelta(dt1, dt2)
+
+
+class PeriodCache(object):
+    ''' Memoize values which only change when the day (or month) of now changes,
+        e.g. the timeout of daily messages. A value is computed once in each period and
+        computed again after the period rolls over. The period of a value is kept as
+        timestamps, so now is only built as a datetime when a value is computed
+        Args:
+            bucketer(DayBucketer): bounds of days in the timezone of now
+    '''
+
+    def __init__(self, bucketer=None):
+        self.bucketer = bucketer or DayBucketer()
+        self.values = dict()    # {key: (start timestamp, end timestamp, value)}
+
+    def bounds(self, base, frequency):
+        ''' Timestamps of the start and end (exclusive) of the day, or month if frequency
+            is 'M', of base (time-aware datetime)
+        '''
+        day = self.bucketer.day(base)
+        if frequency != 'M':
+            return self.bucketer.day_range(day)
+        first_day = day // 100 * 100 + 1
+        if first_day % 10000 > 1200:
+            next_first_day = (day // 10000 + 1) * 10000 + 101
+        else:
+            next_first_day = first_day + 100
+        return self.bucketer.day_range(first_day)[0], self.bucketer.day_range(next_first_day)[0]
+
+    def get(self, key, frequency, compute, offset_sec=0):
+        '''
+            Args:
+                key(hashable): what the value is of, e.g. (message class, frequency)
+                frequency(str): 'D' or 'M', length of the period
+                compute(func): compute(base) the value in the period of base, called with
+                    now plus offset_sec if not cached in current period
+                offset_sec(int): seconds added to now before getting the period
+        '''
+        now_ts = TimeUtils().get_now_ts()
+        cached = self.values.get(key)
+        if cached is not None and cached[0] <= now_ts < cached[1]:
+            return cached[2]
+        base = TimeUtils().get_now() + dt.timedelta(seconds=offset_sec)
+        value = compute(base)
+        start, end = self.bounds(base, frequency)
+        self.values[key] = (start - offset_sec, end - offset_sec, value)
+        return value
+
+    def clear(self):
+        self.values.clear()
+
+
+class DayBucketer(object):
+    ''' Map timestamps and datetimes to integer day (yyyymmdd) or month (yyyymm) buckets
+        in a timezone. Boundaries of the days looked up are kept, so bucketing a unix
+        timestamp is a bisect instead of building datetime objects. Day starts are
+        localized by the timezone, so days around DST transitions are 23 or 25 hours.
+        Boundaries are replaced as a whole when a day is added, so it can be shared by threads
+        Args:
+            tz(timezone): timezone of the buckets
+            max_days(int): boundaries kept before they are dropped
+    '''
+
+    def __init__(self, tz=AIRFLOW_EVENT_PLUGINS_TIMEZONE, max_days=1000):
+        self.tz = tz
+        self.max_days = max_days
+        # sorted timestamps of day starts, timestamps of day ends and days
+        self.bounds = (list(), list(), list())
+        self.last_dt = dict()   # {offset: (datetime, day)} of the last datetime bucketed
+
+    def clear(self):
+        self.bounds = (list(), list(), list())
+        self.last_dt.clear()
+
+    def day(self, base, offset_sec=0):
+        ''' Day bucket of base after adding offset_sec
+            Args:
+                base(int | time-aware/naive datetime): unix timestamp or datetime,
+                    naive datetime is regarded as in self.tz
+                offset_sec(int): offset seconds to add before bucketing
+            Returns:
+                day(int): yyyymmdd
+        '''
+        if isinstance(base, six.integer_types):
+            return self._day_of_timestamp(base + offset_sec)
+        if isinstance(base, dt.datetime):
+            last = self.last_dt.get(offset_sec)
+            if last is not None and last[0] is base:
+                return last[1]
+            day = self._day_of_datetime(base + dt.timedelta(seconds=offset_sec))
+            self.last_dt[offset_sec] = (base, day)
+            return day
+        return self._day_of_datetime(TimeUtils().add_seconds(base, offset_sec))
+
+    def day_range(self, day):
+        ''' Timestamps of the start and end (exclusive) of a day bucket (yyyymmdd) '''
+        date = dt.date(day // 10000, day // 100 % 100, day % 100)
+        return self._timestamp_of_midnight(date), \
+            self._timestamp_of_midnight(date + dt.timedelta(days=1))
+
+    def month(self, base, offset_sec=0):
+        ''' Month bucket (yyyymm) of base after adding offset_sec '''
+        return self.day(base, offset_sec) // 100
+
+    def _day_of_datetime(self, base):
+        if base.tzinfo is not None:
+            base = base.astimezone(self.tz)
+        return base.year * 10000 + base.month * 100 + base.day
+
+    def _day_of_timestamp(self, timestamp):
+        starts, ends, days = self.bounds
+        i = bisect.bisect_right(starts, timestamp) - 1
+        if i >= 0 and timestamp < ends[i]:
+            return days[i]
+        return self._add_day(timestamp)
+
+    def _add_day(self, timestamp):
+        local = dt.datetime.fromtimestamp(timestamp, self.tz)
+        start = self._timestamp_of_midnight(local.date())
+        end = self._timestamp_of_midnight(local.date() + dt.timedelta(days=1))
+        day = self._day_of_datetime(local)
+        starts, ends, days = self.bounds
+        if len(starts) >= self.max_days:
+            starts, ends, days = list(), list(), list()
+        i = bisect.bisect_left(starts, start)
+        if i < len(starts) and starts[i] == start:
+            # added by another thread
+            return day
+        self.bounds = (starts[:i] + [start] + starts[i:],
+                       ends[:i] + [end] + ends[i:],
+                       days[:i] + [day] + days[i:])
+        return day
+
+    def _timestamp_of_midnight(self, date):
+        midnight = TimeUtils().make_aware(dt.datetime(date.year, date.month, date.day), self.tz)
+        return calendar.timegm(midnight.utctimetuple())
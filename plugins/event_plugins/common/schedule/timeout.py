@@ -123,9 +123,13 @@ class TaskTimeout(LoggingMixin):
         else:
             return False
 
-    def is_next_poke_timeout(self, now=None):
+    def is_next_poke_timeout(self, now=None, delay=None):
+        '''
+            delay(float): seconds to the next poke, poke_interval if not given. Pass
+                the actual delay if wake-ups are spread, which can be longer
+        '''
         now = now or TimeUtils().get_now()
-        next_poke_dt = now + relativedelta(seconds=self.poke_interval)
+        next_poke_dt = now + relativedelta(seconds=self.poke_interval if delay is None else delay)
         if next_poke_dt >= self.timeout_dt:
             self.set_execute_last_poke_after_secs()
             return True
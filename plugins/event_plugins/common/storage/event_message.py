@@ -2,12 +2,16 @@ import ConfigParser
 import json
 import os
 import six
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
+from Queue import Queue, Empty, Full
 from tabulate import tabulate
 
-from sqlalchemy import Column, Integer, String
-from sqlalchemy import and_
-from sqlalchemy.orm import validates
+from sqlalchemy import BigInteger, Column, Integer, String
+from sqlalchemy import and_, inspect
+from sqlalchemy.orm import deferred, sessionmaker, validates
 
 from airflow.models import Base
 from airflow.utils.db import provide_session
@@ -19,6 +23,12 @@ from event_plugins.common.schedule.time_utils import TimeUtils
 from event_plugins.common.storage.db import STORAGE_CONF, db_commit
 
 
+def get_offset_table_name():
+    if STORAGE_CONF.has_option("Storage", "offset_table_name"):
+        return STORAGE_CONF.get("Storage", "offset_table_name")
+    return STORAGE_CONF.get("Storage", "table_name") + "_offsets"
+
+
 def get_string_if_json(msg):
     if msg is None:
         return
@@ -30,6 +40,36 @@ def get_string_if_json(msg):
         raise TypeError("msg should be either string or dict type")
 
 
+def timeout_key(msg):
+    ''' Messages with the same topic and frequency have the same timeout '''
+    return msg.get('topic'), msg['frequency']
+
+
+def chunks(items, size=500):
+    ''' Split items for IN clauses, sqlite limits the number of bound parameters '''
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def is_memory_db(engine):
+    ''' in-memory sqlite is only visible to the connection (thread) that created it '''
+    return engine.dialect.name == 'sqlite' and engine.url.database in (None, '', ':memory:')
+
+
+def update_records(session, sensor_name, updates):
+    ''' Update the records of wanted messages, not committed
+        Args:
+            updates(dict): {wanted message in json string: {column: value}}
+    '''
+    for str_match_wanted, values in updates.iteritems():
+        session.query(EventMessage).filter(
+            and_(
+                EventMessage.name == sensor_name,
+                EventMessage.msg == str_match_wanted
+            )
+        ).update(values)
+
+
 class EventMessage(Base):
 
     __tablename__ = STORAGE_CONF.get("Storage", "table_name")
@@ -43,6 +83,14 @@ class EventMessage(Base):
     last_receive = Column(String)
     last_receive_time = Column(UtcDateTime)
     timeout = Column(UtcDateTime)
+    # when the last received message was produced, and when the task of message was
+    # marked success. Used to track end-to-end latency, not shown in tabulate_data.
+    # Deferred so that tables without them (see check_added_columns) can still be read
+    last_event_time = deferred(Column(UtcDateTime, nullable=True))
+    last_success_time = deferred(Column(UtcDateTime, nullable=True))
+
+    display_columns = ['id', 'name', 'msg', 'source_type', 'frequency',
+                       'last_receive', 'last_receive_time', 'timeout']
 
     # available options for fields
     available_frequency = ['D', 'M']
@@ -96,6 +144,227 @@ class EventMessage(Base):
         return source_type
 
 
+# nullable columns added to EventMessage after its table was released, see check_added_columns
+ADDED_COLUMNS = ['last_event_time', 'last_success_time']
+# columns of ADDED_COLUMNS missing in the table of each database, {url: set of columns}
+missing_columns = dict()
+
+
+def check_added_columns(engine):
+    ''' Get the columns of ADDED_COLUMNS missing in the table of EventMessage, checked once
+        per database in a process. If create_table_if_not_exist is set, the missing columns
+        are added. Otherwise the table is managed outside the plugin: the columns are not
+        written until they are added by the migration in docs
+    '''
+    url = str(engine.url)
+    if url in missing_columns:
+        return missing_columns[url]
+    table = EventMessage.__table__
+
+    def get_missing():
+        exist_columns = set(c['name'] for c in inspect(engine).get_columns(table.name))
+        return set(name for name in ADDED_COLUMNS if name not in exist_columns)
+
+    if table.name not in inspect(engine).get_table_names():
+        return set()
+    missing = get_missing()
+    if missing and STORAGE_CONF.getboolean("Storage", "create_table_if_not_exist"):
+        for name in ADDED_COLUMNS:
+            if name not in missing:
+                continue
+            try:
+                engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table.name, name, table.c[name].type.compile(dialect=engine.dialect)))
+            except Exception:
+                # fine if it's added by another sensor at the same time
+                if name in get_missing():
+                    raise
+        missing = get_missing()
+    elif missing:
+        print("columns {} are not in table {}, they are not written until added".format(
+            sorted(missing), table.name))
+    missing_columns[url] = missing
+    return missing
+
+
+# seconds the sorted sensor names of get_sensor_slot are cached, {db url: (time, names)}
+SENSOR_NAMES_TTL = 600
+sensor_names_cache = dict()
+
+
+class EventOffset(Base):
+    ''' Position of sensor in each partition of source, used if sensor assigns
+        partitions by itself instead of committing offsets to the source
+    '''
+
+    __tablename__ = get_offset_table_name()
+    __table_args__ = {'extend_existing': True}
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String, nullable=False)
+    source_type = Column(String(32), nullable=False)
+    topic = Column(String, nullable=False)
+    partition = Column(Integer, nullable=False)
+    offset = Column(BigInteger, nullable=False)
+    update_time = Column(UtcDateTime)
+
+
+class StatusWriter(object):
+    ''' Write-behind of the updates of wanted messages when they are received or their
+        tasks are marked success. Updates of the same message are coalesced, and pending
+        updates are written in one transaction when flush_size messages are pending or
+        the oldest one has waited flush_interval seconds.
+
+        Updates are written by a thread with its own session, started by the first put,
+        queued at most max_pending (put blocks when it's full). For in-memory sqlite, which
+        other threads can't see, they are written by the caller in put and drain instead.
+
+        Args:
+            session: session of EventMessageCRUD, the thread binds to the same engine
+            sensor_name(str): sensor of the records
+            max_pending(int): max updates queued for the thread
+            flush_size(int): write when this number of messages are pending
+            flush_interval(float): seconds an update may wait before written
+    '''
+
+    def __init__(self, session, sensor_name, max_pending=1000, flush_size=100, flush_interval=1):
+        self.session = session
+        self.sensor_name = sensor_name
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending = OrderedDict()
+        self.pending_since = None
+        self.error = None
+        self.thread = None
+        engine = session.get_bind()
+        self.threaded = not is_memory_db(engine)
+        self.session_factory = sessionmaker(bind=engine, autocommit=False, autoflush=False,
+                                            expire_on_commit=False)
+        self.queue = Queue(maxsize=max_pending)
+
+    def put(self, str_match_wanted, values):
+        ''' Queue the update of values of the wanted message '''
+        self.raise_error()
+        if not self.threaded:
+            self.coalesce(str_match_wanted, values)
+            if self.should_flush():
+                self.flush(self.session)
+                self.raise_error()
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run,
+                                           name='status-writer-{}'.format(self.sensor_name))
+            self.thread.daemon = True
+            self.thread.start()
+        self.send('update', (str_match_wanted, values))
+
+    def send(self, command, arg, check_interval=1):
+        ''' Queue a command for the thread. Waits while the queue is full, but raises
+            the error of writing, or RuntimeError, once the thread has exited
+        '''
+        while True:
+            if not self.thread.is_alive():
+                self.raise_error()
+                raise RuntimeError('status writer of {} has exited'.format(self.sensor_name))
+            try:
+                self.queue.put((command, arg), timeout=check_interval)
+                return
+            except Full:
+                pass
+
+    def drain(self):
+        ''' Write all the pending updates before return, raise the error of writing if any,
+            or if the thread has exited before writing them
+        '''
+        if not self.threaded:
+            self.flush(self.session)
+        elif self.thread is not None:
+            drained = threading.Event()
+            if self.thread.is_alive():
+                self.send('drain', drained)
+                while not drained.wait(1) and self.thread.is_alive():
+                    pass
+            self.raise_error()
+            if not drained.is_set():
+                raise RuntimeError('status writer of {} exited with pending updates'.format(
+                    self.sensor_name))
+        self.raise_error()
+
+    def close(self):
+        ''' Drain and stop the thread '''
+        try:
+            self.drain()
+        finally:
+            if self.thread is not None and self.thread.is_alive():
+                self.send('stop', None)
+                self.thread.join()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def coalesce(self, str_match_wanted, values):
+        if not self.pending:
+            self.pending_since = time.time()
+        self.pending.setdefault(str_match_wanted, dict()).update(values)
+
+    def should_flush(self):
+        return len(self.pending) >= self.flush_size or \
+            (self.pending and time.time() - self.pending_since >= self.flush_interval)
+
+    def flush(self, session):
+        if not self.pending:
+            return
+        updates, self.pending = self.pending, OrderedDict()
+        try:
+            update_records(session, self.sensor_name, updates)
+            session.commit()
+        except Exception, e:
+            session.rollback()
+            self.error = e
+            # keep the updates to retry by the next flush, the updates queued meanwhile
+            # are newer
+            for str_match_wanted, values in self.pending.iteritems():
+                updates.setdefault(str_match_wanted, dict()).update(values)
+            self.pending = updates
+            self.pending_since = time.time()
+        finally:
+            # the session of caller (in-memory sqlite) is left open for the caller
+            if session is not self.session:
+                session.close()
+
+    def run(self):
+        try:
+            self.write_updates()
+        except Exception, e:
+            # raised by drain or put of the caller
+            self.error = e
+
+    def write_updates(self):
+        session = self.session_factory()
+        while True:
+            timeout = None
+            if self.pending:
+                timeout = max(self.pending_since + self.flush_interval - time.time(), 0)
+            try:
+                command, arg = self.queue.get(timeout=timeout)
+            except Empty:
+                command, arg = 'flush', None
+            if command == 'update':
+                self.coalesce(*arg)
+                if len(self.pending) >= self.flush_size:
+                    self.flush(session)
+            elif command == 'flush':
+                self.flush(session)
+            elif command == 'drain':
+                self.flush(session)
+                arg.set()
+            elif command == 'stop':
+                self.flush(session)
+                return
+
+
 class EventMessageCRUD:
 
     @provide_session
@@ -103,32 +372,61 @@ class EventMessageCRUD:
         self.source_type = source_type
         self.sensor_name = sensor_name
         self.session = session
+        # values of rows rendered by tabulate_data(changed_only=True), {id: values}
+        self.tabulated_rows = dict()
+        # write-behind of update_on_receive and update_on_success if set
+        self.writer = None
+        # columns of ADDED_COLUMNS not in the table, checked by initialize
+        self.missing_columns = set()
+
+    def set_write_behind(self, max_pending=1000, flush_size=100, flush_interval=1):
+        ''' Write the updates on receiving and success by StatusWriter, call drain before
+            reading them
+        '''
+        self.close_writer()
+        self.writer = StatusWriter(self.session, self.sensor_name, max_pending=max_pending,
+                                   flush_size=flush_size, flush_interval=flush_interval)
+
+    def drain(self):
+        ''' Write the pending updates of write-behind '''
+        if self.writer is not None:
+            self.writer.drain()
+
+    def close_writer(self):
+        if self.writer is not None:
+            writer, self.writer = self.writer, None
+            writer.close()
 
     @db_commit
     def initialize(self, msg_list, dt=None):
+        self.missing_columns = check_added_columns(self.session.get_bind())
         if self.get_sensor_messages().count() > 0:
             dt = dt or TimeUtils().get_now()
             self.update_msgs(msg_list)
             self.reset_timeout(base_time=dt)
         else:
-            for msg in msg_list:
-                str_msg = get_string_if_json(msg)
-                record = EventMessage(
-                    name=self.sensor_name,
-                    msg=str_msg,
-                    source_type=self.source_type,
-                    frequency=msg['frequency'],
-                    last_receive=None,
-                    last_receive_time=None,
-                    timeout=self.get_timeout(msg)
-                )
-                self.session.add(record)
+            self.add_msgs(msg_list)
 
     def get_sensor_messages(self):
         ''' get messages of self.sensor_name '''
         records = self.session.query(EventMessage).filter(EventMessage.name == self.sensor_name)
         return records
 
+    def get_sensor_slot(self, ttl=SENSOR_NAMES_TTL):
+        ''' Number of sensors that store messages in the table, and the index of
+            self.sensor_name in their sorted names (None if not stored yet). The names
+            are cached per database in a process for ttl seconds, and looked up again
+            if self.sensor_name is not in them
+        '''
+        url = str(self.session.get_bind().url)
+        cached_at, names = sensor_names_cache.get(url, (None, None))
+        if cached_at is None or time.time() - cached_at >= ttl or self.sensor_name not in names:
+            names = [name for name, in self.session.query(EventMessage.name)
+                     .distinct().order_by(EventMessage.name)]
+            sensor_names_cache[url] = (time.time(), names)
+        slot = names.index(self.sensor_name) if self.sensor_name in names else None
+        return len(names), slot
+
     @db_commit
     def update_msgs(self, msg_list):
         '''Compare msgs in msg_list to msgs in db. If there are msgs only exist in db,
@@ -137,29 +435,35 @@ class EventMessageCRUD:
             Args:
                 msg_list(list of json object): messages that need to be record in db
         '''
-        exist_records = self.session.query(EventMessage).filter(EventMessage.name == self.sensor_name)
-        str_msg_list = map(get_string_if_json, msg_list)
-        del_record_list = filter(lambda r: r.msg not in str_msg_list, exist_records)
-        del_ids = map(lambda r: r.id, del_record_list)
-        exist_records.filter(EventMessage.id.in_(del_ids)).delete(synchronize_session='fetch')
+        exist_msgs = dict(self.session.query(EventMessage.msg, EventMessage.id)
+                          .filter(EventMessage.name == self.sensor_name))
+        str_msg_list = set(map(get_string_if_json, msg_list))
+        del_ids = [i for msg, i in exist_msgs.iteritems() if msg not in str_msg_list]
+        for ids in chunks(del_ids):
+            self.session.query(EventMessage).filter(EventMessage.id.in_(ids)) \
+                .delete(synchronize_session='fetch')
 
-        new_msgs = list()
+        new_msgs = [msg for msg in msg_list if get_string_if_json(msg) not in exist_msgs]
+        self.add_msgs(new_msgs)
+
+    def add_msgs(self, msg_list):
+        ''' Add records of messages, timeouts are computed once for each topic and frequency.
+            Inserted as mappings, which leave out the columns not given (may be missing
+            in the table, see check_added_columns)
+        '''
+        timeouts = self.get_timeouts(msg_list)
+        records = list()
         for msg in msg_list:
-            str_msg = get_string_if_json(msg)
-            if str_msg not in [r.msg for r in exist_records]:
-                new_msgs.append(msg)
-        for new_msg in new_msgs:
-            str_new_msg = get_string_if_json(new_msg)
-            record = EventMessage(
+            records.append(dict(
                 name=self.sensor_name,
-                msg=str_new_msg,
+                msg=get_string_if_json(msg),
                 source_type=self.source_type,
-                frequency=new_msg['frequency'],
+                frequency=msg['frequency'],
                 last_receive=None,
                 last_receive_time=None,
-                timeout=self.get_timeout(new_msg)
-            )
-            self.session.add(record)
+                timeout=timeouts[timeout_key(msg)]
+            ))
+        self.session.bulk_insert_mappings(EventMessage, records)
 
     @db_commit
     def reset_timeout(self, base_time=None):
@@ -177,16 +481,30 @@ class EventMessageCRUD:
             | a   | D         | None                     |  None         | dt(2019, 6, 16, 23, 59, 59) |
         '''
         base_time = base_time or TimeUtils().get_now()
-        update_records = self.session.query(EventMessage).filter(
+        expired = self.session.query(EventMessage.id, EventMessage.msg).filter(
             and_(
                 EventMessage.name == self.sensor_name,
                 EventMessage.timeout < base_time
             )
         )
-        for record in update_records:
-            record.last_receive_time = None
-            record.last_receive = None
-            record.timeout = self.get_timeout(json.loads(record.msg))
+        # ids of expired records with the same timeout, {(topic, frequency): [id]}
+        groups = dict()
+        msgs = list()
+        for record_id, msg in expired:
+            msg = json.loads(msg)
+            key = timeout_key(msg)
+            if key not in groups:
+                groups[key] = list()
+                msgs.append(msg)
+            groups[key].append(record_id)
+        timeouts = self.get_timeouts(msgs)
+        for key, record_ids in groups.iteritems():
+            for ids in chunks(record_ids):
+                self.session.query(EventMessage).filter(EventMessage.id.in_(ids)).update({
+                    "last_receive_time": None,
+                    "last_receive": None,
+                    "timeout": timeouts[key]
+                }, synchronize_session=False)
 
     def get_timeout(self, msg):
         '''Get timeout defined by each plugin
@@ -196,6 +514,19 @@ class EventMessageCRUD:
         return factory.plugin_factory(self.source_type) \
                 .msg_handler(msg=msg, mtype='wanted').timeout()
 
+    def get_timeouts(self, msg_list):
+        '''Get timeouts of messages. Timeout only depends on topic and frequency of
+            message, so it's computed once for each of them
+            Returns:
+                dict of {(topic, frequency): timeout}
+        '''
+        timeouts = dict()
+        for msg in msg_list:
+            key = timeout_key(msg)
+            if key not in timeouts:
+                timeouts[key] = self.get_timeout(msg)
+        return timeouts
+
     def status(self):
         '''Status of self.sensor_name
             Return(define in status.py):
@@ -239,32 +570,106 @@ class EventMessageCRUD:
                 )).all()
         )
 
-    @db_commit
-    def update_on_receive(self, match_wanted, receive_msg):
-        ''' Update last receive time and object when receiving wanted message '''
-        str_match_wanted = get_string_if_json(match_wanted)
-        self.session.query(EventMessage).filter(
-            and_(
-                EventMessage.name == self.sensor_name,
-                EventMessage.msg == str_match_wanted
-            )
-        ).update({
-            "last_receive_time": TimeUtils().get_now(),
-            "last_receive": get_string_if_json(receive_msg)
+    def update_on_receive(self, match_wanted, receive_msg, event_time=None, receive_time=None,
+                          success_time=None):
+        ''' Update last receive time and object when receiving wanted message
+            Args:
+                event_time(datetime): when the message was produced, None if unknown
+                receive_time(datetime): when the message was consumed, now if not given
+                success_time(datetime): when the task of message is marked success, None
+                    if not marked. Written in the same update, without another commit
+        '''
+        self.update_msg(match_wanted, {
+            "last_receive_time": receive_time or TimeUtils().get_now(),
+            "last_receive": get_string_if_json(receive_msg),
+            "last_event_time": event_time,
+            "last_success_time": success_time
+        })
+
+    def update_on_success(self, match_wanted, success_time=None):
+        ''' Update the time when the task of wanted message is marked success '''
+        self.update_msg(match_wanted, {
+            "last_success_time": success_time or TimeUtils().get_now()
         })
 
+    def update_msg(self, match_wanted, values):
+        ''' Update columns of the record of wanted message, by the writer if write-behind '''
+        str_match_wanted = get_string_if_json(match_wanted)
+        if self.missing_columns:
+            values = dict((k, v) for k, v in values.iteritems() if k not in self.missing_columns)
+            if not values:
+                return
+        if self.writer is not None:
+            self.writer.put(str_match_wanted, values)
+        else:
+            self.update_records({str_match_wanted: values})
+
+    @db_commit
+    def update_records(self, updates):
+        update_records(self.session, self.sensor_name, updates)
+
+    def get_offsets(self):
+        '''
+        Return:
+            dict of stored offsets: {(topic, partition): offset}
+        '''
+        records = self.session.query(EventOffset).filter(EventOffset.name == self.sensor_name)
+        return dict([((r.topic, r.partition), r.offset) for r in records])
+
+    @db_commit
+    def update_offsets(self, offsets):
+        '''Store the next offset to consume of each partition
+            Args:
+                offsets(dict): {(topic, partition): offset}
+        '''
+        if not offsets:
+            return
+        now = TimeUtils().get_now()
+        records = self.session.query(EventOffset).filter(EventOffset.name == self.sensor_name)
+        exist_records = dict([((r.topic, r.partition), r) for r in records])
+        for (topic, partition), offset in offsets.items():
+            record = exist_records.get((topic, partition))
+            if record is None:
+                self.session.add(EventOffset(name=self.sensor_name,
+                                             source_type=self.source_type,
+                                             topic=topic,
+                                             partition=partition,
+                                             offset=offset,
+                                             update_time=now))
+            elif record.offset != offset:
+                record.offset = offset
+                record.update_time = now
+
     @db_commit
     def delete(self):
-        ''' delete all messages rows of self.sensor_name '''
+        ''' delete all messages rows and offsets of self.sensor_name '''
         self.session.query(EventMessage) \
             .filter(EventMessage.name == self.sensor_name) \
             .delete(synchronize_session='fetch')
+        self.session.query(EventOffset) \
+            .filter(EventOffset.name == self.sensor_name) \
+            .delete(synchronize_session='fetch')
 
-    def tabulate_data(self, threshold=None, tablefmt='fancy_grid'):
-        headers = [str(c).split('.')[1] for c in EventMessage.__table__.columns]
+    def tabulate_data(self, threshold=None, tablefmt='fancy_grid', changed_only=False):
+        ''' Render messages of sensor as table
+            Args:
+                threshold(int): max length of value in each cell
+                tablefmt(str): format of tabulate
+                changed_only(bool): only render rows changed since last rendering with
+                    changed_only, all rows are rendered at the first time
+            Returns:
+                table(str): None if changed_only and nothing changed
+        '''
+        headers = EventMessage.display_columns
         data = list()
         records = self.session.query(EventMessage).filter(EventMessage.name == self.sensor_name)
         for r in records:
+            if changed_only:
+                # compare raw values to skip unchanged rows before building strings
+                values = tuple(getattr(r, col) for col in headers)
+                if self.tabulated_rows.get(r.id) == values:
+                    continue
+                self.tabulated_rows[r.id] = values
             rows = list()
             for col in headers:
                 str_val = str(getattr(r, col))
@@ -273,4 +678,6 @@ class EventMessageCRUD:
                 else:
                     rows.append(str_val)
             data.append(rows)
+        if changed_only and not data:
+            return None
         return tabulate(data, headers=headers, tablefmt=tablefmt)
@@ -1,7 +1,7 @@
 # -*- coding: UTF-8 -*-
 from __future__ import print_function
 
-from event_plugins.common.schedule.time_utils import TimeUtils
+from event_plugins.common.schedule.time_utils import TimeUtils, PeriodCache, DayBucketer
 
 
 class BasicMessage(object):
@@ -30,6 +30,11 @@ class BasicMessage(object):
     render_match_keys = []
     time_key = None
 
+    # day boundaries of the event plugins timezone, shared by all messages
+    day_bucketer = DayBucketer()
+    # timeouts of current day/month, shared by messages of the same class and frequency
+    timeout_cache = PeriodCache(day_bucketer)
+
     def __init__(self, wanted_msg):
         self.wanted_msg = wanted_msg
 
@@ -54,6 +59,15 @@ class BasicMessage(object):
         '''
         return TimeUtils().add_seconds(base, self.offset_sec)
 
+    def day_bucket(self, base):
+        ''' Day of time after offset
+            Args:
+                base (int | time-aware/naive datetime): timestamp or datetime before offset
+            Returns:
+                day (int): yyyymmdd in the event plugins timezone
+        '''
+        return self.day_bucketer.day(base, self.offset_sec)
+
     def match(self, msg, receive_dt):
         ''' Define how to match a received message with self.wanted_msg
             Args:
@@ -71,8 +85,8 @@ class BasicMessage(object):
             if self.time_key is not None and self.time_key not in msg:
                 print("specify time key '{}' in msg for matching".format(self.time_key))
             elif (self.time_key is None) or \
-                (match_handler.match_by_tkey(self.time_offset(msg[self.time_key]),
-                                             self.time_offset(receive_dt))):
+                (match_handler.match_by_tkey(self.day_bucket(msg[self.time_key]),
+                                             self.day_bucket(receive_dt))):
 
                 # return if there's no other keys need to be match
                 if len(self.render_match_keys) == 0:
@@ -91,7 +105,12 @@ class BasicMessage(object):
             Returns:
                 timeout(datetime): timeout datetime with timezone
         '''
-        base_time = TimeUtils().add_seconds(TimeUtils().get_now(), self.offset_sec)
+        frequency = self.wanted_msg['frequency']
+        return self.timeout_cache.get((type(self), frequency), frequency, self.compute_timeout,
+                                      self.offset_sec)
+
+    def compute_timeout(self, base_time):
+        ''' Timeout of the day or month of base_time (now with offset_sec) '''
         if self.wanted_msg['frequency'] == 'D':
             end_of_day = base_time.replace(hour=23, minute=59, second=59)
             return TimeUtils().add_seconds(end_of_day, 0-self.offset_sec)
@@ -118,9 +137,6 @@ class Match:
         return all([msg.get(key) == wanted_msg.get(key) for key in match_keys])
 
     @staticmethod
-    def match_by_tkey(msg_dt, wanted_dt):
-        msg_date = TimeUtils().cvt_datetime2str(msg_dt, fmt='%Y%m%d')
-        wanted_date = TimeUtils().cvt_datetime2str(wanted_dt, fmt='%Y%m%d')
-        if msg_date == wanted_date:
-            return True
-        return False
+    def match_by_tkey(msg_day, wanted_day):
+        ''' Match if in the same day, days are yyyymmdd integers of BasicMessage.day_bucket '''
+        return msg_day == wanted_day
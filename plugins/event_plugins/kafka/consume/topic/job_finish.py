@@ -1,7 +1,6 @@
 # -*- coding: UTF-8 -*-
 
-from event_plugins.kafka.consume.topic.basic import BasicMessage
-from event_plugins.common.schedule.time_utils import TimeUtils
+from event_plugins.kafka.consume.topic.basic import BasicMessage, Match
 
 
 class JobFinish:
@@ -29,20 +28,7 @@ class Message(BasicMessage):
         return JobFinishMatch
 
 
-class JobFinishMatch:
-
-    @staticmethod
-    def match_by_keys(msg, wanted_msg, match_keys):
-        return all([msg.get(key) == wanted_msg.get(key) for key in match_keys])
-
-    @staticmethod
-    def match_by_rkeys(msg, wanted_msg, match_keys):
-        return all([msg.get(key) == wanted_msg.get(key) for key in match_keys])
-
-    @staticmethod
-    def match_by_tkey(msg_dt, wanted_dt):
-        msg_date = TimeUtils().cvt_datetime2str(msg_dt, fmt='%Y%m%d')
-        wanted_date = TimeUtils().cvt_datetime2str(wanted_dt, fmt='%Y%m%d')
-        if msg_date == wanted_date:
-            return True
-        return False
+class JobFinishMatch(Match):
+    ''' Same comparisons as Match, override them to match job-finish messages differently
+        (which are then not matched by columns with batch_match)
+    '''
@@ -2,9 +2,10 @@
 from __future__ import print_function
 
 import time
-from confluent_kafka import Consumer, KafkaError, Producer
+from confluent_kafka import Consumer, KafkaError, Producer, TopicPartition, OFFSET_BEGINNING
 
 from event_plugins.base.base_connector import BaseConnector
+from event_plugins.kafka.produce.delivery import DeliverySummary
 
 
 class KafkaConnector(BaseConnector):
@@ -12,56 +13,247 @@ class KafkaConnector(BaseConnector):
     consumer = None
     producer = None
 
+    # topics being consumed, and whether partitions are assigned by consumer itself
+    topics = []
+    assign_mode = False
+    # topics that partitions are paused (not fetched) since no more messages are needed
+    paused_topics = set()
+
+    # named producer configs, which trade latency of single message for throughput
+    producer_profiles = {
+        'throughput': {
+            'compression.codec': 'lz4',
+            'linger.ms': 100,
+            'batch.num.messages': 10000,
+            'queue.buffering.max.messages': 500000,
+            # idempotence keeps the order of messages on retry with 5 in-flight requests
+            'enable.idempotence': True,
+            'max.in.flight.requests.per.connection': 5
+        },
+        'latency': {
+            'compression.codec': 'none',
+            'linger.ms': 0,
+            'batch.num.messages': 100,
+            'max.in.flight.requests.per.connection': 1
+        }
+    }
+
     def __init__(self, broker):
         super(KafkaConnector, self).__init__()
         self.broker = broker
+        # messages consumed while waiting for the partitions assigned
+        self.pending_msgs = list()
 
-    def set_consumer(self, group_id, client_id, topics, timeout=5):
-        self._set_consumer(self.broker, group_id, client_id, timeout)
-        self._subscribe(topics)
-        # TODO: sleep to wait for assigned finish, but not in a good way
-        time.sleep(2)
+    # time spent from setting consumer to getting partitions assigned the first time, it
+    # shows how long it takes to rejoin the group (with or without rebalance)
+    assign_latency = None
+    # max seconds set_consumer waits for the partitions assigned when subscribing
+    assign_wait_secs = 2
+
+    def set_consumer(self, group_id, client_id, topics, timeout=5,
+                     group_instance_id=None, session_timeout=None, offsets=None,
+                     enable_auto_commit=True):
+        '''
+            group_instance_id(str): enable static membership if given. The consumer would
+                rejoin the group without rebalance if it's back within session timeout.
+            session_timeout(int): seconds, use timeout + 1 if not given
+            offsets(dict): {(topic, partition): offset}. If given (even empty), assign all
+                partitions of topics with these offsets instead of subscribing, which skips
+                group coordination. Partitions not in offsets are consumed from the beginning
+            enable_auto_commit(bool): commit consumed offsets automatically when subscribing,
+                otherwise offsets are committed by commit_offsets
+        '''
+        self.connect_started_at = time.time()
+        self.assign_latency = None
+        self.assign_mode = offsets is not None
+        if self.assign_mode:
+            self._set_consumer(self.broker, group_id, client_id, timeout,
+                               enable_auto_commit=False)
+            self._assign(topics, offsets, timeout)
+        else:
+            self._set_consumer(self.broker, group_id, client_id, timeout,
+                               group_instance_id, session_timeout, enable_auto_commit)
+            self._subscribe(topics)
+            self._wait_for_assignment()
 
-    def set_producer(self):
-        self._set_producer()
+    def set_producer(self, profile=None, config=None):
+        '''
+            profile(str): name in producer_profiles, use librdkafka defaults if not given
+            config(dict): producer config to override the profile
+        '''
+        self._set_producer(profile, config)
 
     def get_messages(self):
         all_msgs = list()
+        for msgs in self.iter_batches():
+            all_msgs.extend(msgs)
+        return all_msgs
+
+    def iter_batches(self):
+        ''' Yield batches of consumed messages until no more messages are available '''
         msgs = self._consume_valid_messages()
         while msgs:
-            all_msgs.extend(msgs)
+            yield msgs
             msgs = self._consume_valid_messages()
-        return all_msgs
+
+    def consume(self, num_messages=1000, timeout=5):
+        ''' Consume one batch of at most num_messages, wait at most timeout seconds '''
+        return self._consume_valid_messages(num_messages, timeout) or list()
+
+    def commit_offsets(self, offsets):
+        ''' Commit next offsets to consume synchronously, partitions not assigned are ignored
+            Args:
+                offsets (dict): {(topic, partition): offset}
+        '''
+        if not self.consumer:
+            return
+        assigned = set((tp.topic, tp.partition) for tp in self.consumer.assignment())
+        partitions = [TopicPartition(topic, partition, offset)
+                      for (topic, partition), offset in sorted(offsets.items())
+                      if (topic, partition) in assigned]
+        if partitions:
+            self.consumer.commit(offsets=partitions, asynchronous=False)
 
     def close(self):
         if self.consumer:
             self.consumer.close()
 
-    def _set_consumer(self, broker, group_id, client_id, timeout=5):
+    def set_topics(self, topics, offsets=None):
+        ''' Change the topics to consume of current consumer
+            Args:
+                topics (list): topics to consume
+                offsets (dict): {(topic, partition): offset} to assign partitions in assign
+                    mode, positions of current assignment are kept if not in offsets
+        '''
+        if not self.consumer or set(topics) == set(self.topics):
+            return
+        if self.assign_mode:
+            current_offsets = self.get_offsets()
+            current_offsets.update(offsets or dict())
+            self._assign(topics, current_offsets)
+        else:
+            self._subscribe(topics)
+
+    def set_active_topics(self, topics):
+        ''' Pause assigned partitions of topics not in `topics` and resume the others.
+            Paused partitions stay assigned (no rebalance) and keep their positions,
+            so the messages are consumed after resuming.
+            Args:
+                topics (list): topics that still need to be fetched
+        '''
+        if not self.consumer:
+            return
+        paused_topics = set(self.topics) - set(topics)
+        if paused_topics != self.paused_topics:
+            self.log.info('pause topics {}, resume topics {}'.format(
+                sorted(paused_topics), sorted(self.paused_topics - paused_topics)))
+        self.paused_topics = paused_topics
+        self._apply_pause(self.consumer.assignment())
+
+    def get_offsets(self):
+        ''' Get next offset to consume of assigned partitions
+            Returns:
+                offsets(dict): {(topic, partition): offset}, partitions without any consumed
+                message are not included
+        '''
+        if not self.consumer:
+            return dict()
+        positions = self.consumer.position(self.consumer.assignment())
+        return dict([((tp.topic, tp.partition), tp.offset) for tp in positions if tp.offset >= 0])
+
+    def get_lag(self, timeout=1):
+        ''' Get lag (high watermark - position) of assigned partitions that are not paused.
+            Watermarks cached from the last fetch are used, the broker is only queried
+            for partitions not fetched yet
+            Args:
+                timeout (int): seconds to wait for the watermarks of each queried partition
+            Returns:
+                lag(dict): {(topic, partition): lag}, partitions without any consumed
+                message count from the low watermark
+        '''
+        if not self.consumer:
+            return dict()
+        partitions = [tp for tp in self.consumer.assignment() if tp.topic not in self.paused_topics]
+        lag = dict()
+        for tp in self.consumer.position(partitions):
+            low, high = self.consumer.get_watermark_offsets(tp, cached=True)
+            if high < 0 or (tp.offset < 0 and low < 0):
+                low, high = self.consumer.get_watermark_offsets(tp, timeout=timeout)
+            position = tp.offset if tp.offset >= 0 else low
+            lag[(tp.topic, tp.partition)] = max(high - position, 0)
+        return lag
+
+    def _set_consumer(self, broker, group_id, client_id, timeout=5,
+                      group_instance_id=None, session_timeout=None, enable_auto_commit=True):
         def on_commit(err, part):
             print("[commit]", part)
 
         if not self.consumer:
-            self.consumer = Consumer({
+            config = {
                 'bootstrap.servers': broker,
                 'group.id': group_id,
                 'client.id': client_id,
                 'auto.offset.reset': 'earliest',
                 'session.timeout.ms': (timeout + 1) * 1000,   # [magic] add this line for reschedule consumer to work...
-                'enable.auto.commit': True,
+                'enable.auto.commit': enable_auto_commit,
                 'on_commit': on_commit
-            })
+            }
+            if session_timeout:
+                config['session.timeout.ms'] = int(session_timeout * 1000)
+            if group_instance_id:
+                # static membership, need librdkafka >= 1.4 and kafka broker >= 2.3
+                config['group.instance.id'] = group_instance_id
+            self.consumer = Consumer(config)
         return self
 
     def _subscribe(self, topics):
         def on_assign(consumer, part):
+            if self.assign_latency is None and getattr(self, 'connect_started_at', None):
+                self.assign_latency = time.time() - self.connect_started_at
+                self.log.info('partitions assigned after {:.3f}s'.format(self.assign_latency))
             print('[on assign]', part)
+            # pause state is not kept for the partitions assigned by rebalance
+            self._apply_pause(part)
 
         if self.consumer:
             self.consumer.subscribe(topics, on_assign=on_assign)
+            self.topics = list(topics)
         else:
             raise ValueError('consumer not set, can not assigined to any topic')
 
+    def _assign(self, topics, offsets, timeout=5):
+        if not self.consumer:
+            raise ValueError('consumer not set, can not assigined to any topic')
+        partitions = list()
+        for topic in topics:
+            metadata = self.consumer.list_topics(topic, timeout=timeout).topics[topic]
+            for partition in sorted(metadata.partitions):
+                offset = offsets.get((topic, partition), OFFSET_BEGINNING)
+                partitions.append(TopicPartition(topic, partition, offset))
+        self.consumer.assign(partitions)
+        self.topics = list(topics)
+        self._apply_pause(partitions)
+        if self.assign_latency is None:
+            self.assign_latency = time.time() - self.connect_started_at
+            self.log.info('partitions assigned after {:.3f}s'.format(self.assign_latency))
+
+    def _wait_for_assignment(self):
+        ''' Consume until partitions are assigned (assignment is served in consume) or
+            assign_wait_secs passed, the messages consumed meanwhile are kept for the
+            next consume
+        '''
+        deadline = time.time() + self.assign_wait_secs
+        while self.assign_latency is None and time.time() < deadline:
+            self.pending_msgs.extend(self.consumer.consume(num_messages=1000, timeout=0.1) or [])
+
+    def _apply_pause(self, partitions):
+        pause = [tp for tp in partitions if tp.topic in self.paused_topics]
+        resume = [tp for tp in partitions if tp.topic not in self.paused_topics]
+        if pause:
+            self.consumer.pause(pause)
+        if resume:
+            self.consumer.resume(resume)
+
     def _is_valid_msg(self, msg):
         if msg is None:
             return False
@@ -72,15 +264,24 @@ class KafkaConnector(BaseConnector):
         return True
 
     def _consume_valid_messages(self, num_messages=1000, timeout=5):
+        if self.pending_msgs:
+            msg_list, self.pending_msgs = self.pending_msgs, list()
+            msg_list = [m for m in msg_list if self._is_valid_msg(m)]
+            if msg_list:
+                return msg_list
         msg_list = self.consumer.consume(num_messages=num_messages, timeout=timeout)
         if msg_list is not None or len(msg_list) > 0:
             return [m for m in msg_list if self._is_valid_msg(m)]
         return None
 
-    def _set_producer(self):
-        self.producer = Producer({
-            'bootstrap.servers': self.broker
-        })
+    def _set_producer(self, profile=None, config=None):
+        if profile and profile not in self.producer_profiles:
+            raise ValueError('producer profile should be one of {}, got {}'.format(
+                sorted(self.producer_profiles), profile))
+        producer_config = dict(self.producer_profiles.get(profile, dict()))
+        producer_config.update(config or dict())
+        producer_config['bootstrap.servers'] = self.broker
+        self.producer = Producer(producer_config)
         return self
 
     def produce(self, topic, data, callback=None):
@@ -101,6 +302,33 @@ class KafkaConnector(BaseConnector):
         # callbacks to be triggered.
         self.producer.flush()
 
+    def produce_batch(self, msgs, flush_timeout=30):
+        ''' Produce messages asynchronously and flush once at the end
+            Args:
+                msgs (iterable): (topic, data) of messages to produce
+                flush_timeout (int): seconds to wait for outstanding messages after
+                    all messages are enqueued
+            Returns:
+                summary (DeliverySummary): aggregated delivery result
+        '''
+        summary = DeliverySummary()
+
+        def on_delivery(enqueued_at):
+            return lambda err, msg: summary.record(err, time.time() - enqueued_at)
+
+        for topic, data in msgs:
+            while True:
+                try:
+                    self.producer.produce(topic, data, callback=on_delivery(time.time()))
+                    break
+                except BufferError:
+                    # local queue is full, wait for deliveries to free up the space
+                    self.producer.poll(0.5)
+            # serve delivery callbacks without blocking
+            self.producer.poll(0)
+        summary.undelivered = self.producer.flush(flush_timeout)
+        return summary
+
     def delivery_report(self, err, msg):
         """ Called once for each message produced to indicate delivery result.
             Triggered by poll() or flush(). """
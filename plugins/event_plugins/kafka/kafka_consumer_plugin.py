@@ -1,10 +1,13 @@
 # -*- coding: UTF-8 -*-
 import json
+import confluent_kafka
+from airflow.exceptions import AirflowException
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
 from event_plugins.factory import plugin_factory
 from event_plugins.base.base_consumer_plugin import BaseConsumerOperator
+from event_plugins.kafka.sharded_connector import ShardedKafkaConnector
 
 
 class KafkaConsumerOperator(BaseConsumerOperator):
@@ -12,27 +15,162 @@ class KafkaConsumerOperator(BaseConsumerOperator):
     ui_color = '#16a085'
 
     source_type = 'kafka'
+    valid_consume_modes = ['subscribe', 'assign']
+
+    # extra seconds of session timeout for rescheduled static member to rejoin
+    static_member_grace_secs = 60
+    # librdkafka supports group.instance.id since 1.4.0
+    static_membership_min_libversion = 0x010400ff
 
     @apply_defaults
     def __init__(self,
                  broker,
                  group_id,
                  client_id,
+                 static_membership=False,
+                 session_timeout=None,
+                 consume_mode='subscribe',
+                 batch_match=False,
+                 num_shards=1,
                  *args,
                  **kwargs):
         super(KafkaConsumerOperator, self).__init__(*args, **kwargs)
         self.broker = broker
         self.group_id = group_id
         self.client_id = client_id
+        self.set_static_membership(static_membership)
+        self.session_timeout = session_timeout
+        self.num_shards = num_shards
+        self.set_consume_mode(consume_mode)
+        self.all_msgs_handler.set_batch_match(batch_match)
+
+    def set_consume_mode(self, consume_mode):
+        ''' subscribe: join the consumer group and commit offsets to kafka
+            assign: assign all partitions without group coordination,
+                    offsets are stored in status db with the messages of sensor
+        '''
+        if consume_mode not in self.valid_consume_modes:
+            raise AirflowException(
+                "The consume_mode must be one of {valid_modes}, {t}'; received '{m}'."
+                .format(valid_modes=self.valid_consume_modes, t=self.task_id, m=consume_mode))
+        if self.num_shards > 1 and consume_mode != 'subscribe':
+            raise AirflowException(
+                "Sharded consumers need consume_mode 'subscribe', {t}'; received '{m}'."
+                .format(t=self.task_id, m=consume_mode))
+        self.consume_mode = consume_mode
+
+    def set_static_membership(self, static_membership):
+        ''' Static membership needs librdkafka >= 1.4, older versions ignore group.instance.id
+            and the sensor would join the group as a new member on every reschedule
+        '''
+        if static_membership:
+            version, version_int = confluent_kafka.libversion()
+            if version_int < self.static_membership_min_libversion:
+                raise AirflowException(
+                    "static_membership needs librdkafka >= 1.4.0, {t}; found '{v}'."
+                    .format(t=self.task_id, v=version))
+        self.static_membership = static_membership
+
+    def shard_key(self, msg):
+        ''' Messages of a partition are decoded and matched in order by one worker '''
+        return msg.topic(), msg.partition()
 
     def initialize_conn_handler(self):
-        topics = self.all_msgs_handler.subscribe_topics()
-        self.conn_handler = plugin_factory(self.source_type).conn_handler(self.broker)
-        self.conn_handler.set_consumer(self.group_id, self.client_id, topics)
+        # only consume topics that still have unreceived messages
+        topics = self.all_msgs_handler.subscribe_topics(self.db_handler.get_unreceived_msgs())
+        if self.sharded:
+            self.conn_handler = ShardedKafkaConnector(self.broker, self.num_shards,
+                                                      self.all_msgs_handler.get_wanted_msgs())
+        else:
+            self.conn_handler = plugin_factory(self.source_type).conn_handler(self.broker)
+        self.conn_handler.set_consumer(self.group_id, self.client_id, topics,
+                                       group_instance_id=self.get_group_instance_id(),
+                                       session_timeout=self.get_session_timeout(),
+                                       offsets=self.get_stored_offsets())
+        assign_latency = getattr(self.conn_handler, 'assign_latency', None)
+        if assign_latency is not None:
+            self.metrics.gauge('assign_latency', assign_latency)
+
+    def get_stored_offsets(self):
+        ''' offsets to assign partitions with, None if subscribing topics '''
+        if self.assign_partitions:
+            return self.db_handler.get_offsets()
+        return None
+
+    def before_consume(self, consumer):
+        # only fetch and match the topics that still have unreceived messages
+        topics = set([msg['topic'] for msg in self.db_handler.get_unreceived_msgs()])
+        # 1. messages might time out (e.g. new day) while poking,
+        #    add the topics of them if they are not consumed
+        missing_topics = topics - set(consumer.topics)
+        if consumer.consumer and missing_topics:
+            self.log.info('start consuming topics {}'.format(sorted(missing_topics)))
+            consumer.set_topics(list(set(consumer.topics) | missing_topics),
+                                offsets=self.get_stored_offsets())
+        # 2. pause the partitions of topics that all messages are received
+        consumer.set_active_topics(list(topics))
+        self.all_msgs_handler.set_active_topics(list(topics))
+
+    def after_consume(self, consumer):
+        # store offsets after the received messages are stored in db,
+        # messages would be consumed again if failed before that
+        if self.assign_partitions:
+            with self.metrics.stage('db_write'):
+                self.db_handler.update_offsets(consumer.get_offsets())
+        if self.sharded:
+            consumer.commit()
+            for name, count in consumer.pop_counters().iteritems():
+                self.metrics.incr('shards.{}'.format(name), count)
+        self.report_lag(consumer)
+
+    def report_lag(self, consumer):
+        ''' Log and emit the lag of each partition after consuming, a sensor that
+            times out with lag is behind the messages rather than missing them
+        '''
+        with self.metrics.stage('lag'):
+            lag = consumer.get_lag()
+        topic_lag = dict()
+        for (topic, partition), value in sorted(lag.items()):
+            topic_lag[topic] = topic_lag.get(topic, 0) + value
+            self.metrics.gauge('lag.{}.{}'.format(topic, partition), value)
+        for topic, value in topic_lag.iteritems():
+            self.metrics.gauge('lag.{}'.format(topic), value)
+        if topic_lag:
+            self.log.info('consumer lag: {}'.format(topic_lag))
+        if self.debug_mode:
+            self.log.info('consumer lag of partitions: {}'.format(lag))
+
+    @property
+    def assign_partitions(self):
+        return self.consume_mode == 'assign'
+
+    @property
+    def sharded(self):
+        ''' consume by num_shards child processes, see ShardedKafkaConnector '''
+        return self.num_shards > 1
+
+    def get_group_instance_id(self):
+        ''' static member id of the consumer, one sensor is one member in the group '''
+        if self.static_membership:
+            return self.sensor_name
+        return None
+
+    def get_session_timeout(self):
+        ''' Session timeout (seconds) of the consumer
+
+            With static membership, the member should stay in the group between reschedules,
+            so the session timeout need to cover the longest delay of next poke (poke_interval,
+            jitter and the period of wake-up slots if rate limited) plus the time for scheduler
+            to pick up the task again
+        '''
+        if self.session_timeout or not self.static_membership:
+            return self.session_timeout
+        fleet_size = 1
+        if self.spreader.rate_limited:
+            fleet_size, _ = self.db_handler.get_sensor_slot()
+        return self.spreader.max_delay(self.poke_interval, fleet_size) + self.static_member_grace_secs
 
     def initialize_db_handler(self):
         # Initialize status DB, clear last_receive_time if msg timeout
         rmsgs = self.all_msgs_handler.get_wanted_msgs(render=True)
         self.db_handler.initialize(rmsgs)
-        if self.debug_mode:
-            self.log.info(self.db_handler.tabulate_data())
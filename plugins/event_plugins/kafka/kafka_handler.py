@@ -3,13 +3,21 @@ from __future__ import print_function
 
 import six
 import json
+from confluent_kafka import TIMESTAMP_NOT_AVAILABLE
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from event_plugins.base.base_handler import BaseHandler
 from event_plugins.base.base_handler import BaseAllMessageHandler
 from event_plugins.base.base_handler import BaseSingleMessageHandler
 
+from event_plugins.common.schedule.time_utils import TimeUtils
 from event_plugins.kafka.kafka_connector import KafkaConnector
 from event_plugins.kafka.consume.topic import topic_factory
+from event_plugins.kafka.consume.topic.basic import BasicMessage, Match
 from event_plugins.kafka.consume.utils import MsgRenderUtils
 
 
@@ -39,6 +47,23 @@ class KafkaAllMessageHandler(BaseAllMessageHandler):
 
     def __init__(self, wanted_msgs):
         self.wanted_msgs = wanted_msgs
+        self.active_topics = None
+        self.batch_match = False
+        self.wanted_index = dict()
+
+    def set_batch_match(self, enabled):
+        ''' Match the messages of each topic in a poke together by columns of their
+            match keys and time key, instead of one by one with every wanted message
+        '''
+        self.batch_match = enabled
+
+    def set_active_topics(self, topics):
+        ''' Only match messages of topics that still have unreceived messages,
+            messages of other topics are skipped without decoding
+            Args:
+                topics (list): active topics, all topics are active if None
+        '''
+        self.active_topics = set(topics) if topics is not None else None
 
     def get_wanted_msgs(self, topic=None, render=False):
         ''' Get wanted msgs
@@ -65,12 +90,15 @@ class KafkaAllMessageHandler(BaseAllMessageHandler):
             return [m['task_id'] for m in msgs]
         return [m['task_id'] for m in self.wanted_msgs]
 
-    def subscribe_topics(self):
-        ''' Get distinct subscribe topics from all wanted messages
+    def subscribe_topics(self, msgs=None):
+        ''' Get distinct subscribe topics from messages
+            Args:
+                msgs (list): list of json object messages, use all wanted messages if not given
             Returns:
                 topics (list): all topics that need to subscribe
         '''
-        return list(set([msg['topic'] for msg in self.wanted_msgs]))
+        msgs = msgs or self.wanted_msgs
+        return list(set([msg['topic'] for msg in msgs]))
 
     def __render_msgs(self):
         ''' Render all wanted msgs '''
@@ -81,29 +109,179 @@ class KafkaAllMessageHandler(BaseAllMessageHandler):
                                     for msg in self.wanted_msgs]
         return self.render_msgs
 
+    def decode(self, receive_msg):
+        ''' Decode incoming message to json
+
+            Args:
+                receive_msg(confluent_kafka.Message): incoming message
+
+            Returns:
+                DecodedMessage or None if topic of the message is not active
+        '''
+        if isinstance(receive_msg, DecodedMessage):
+            return receive_msg
+        receive = KafkaHandler('kafka').msg_handler(receive_msg, 'receive')
+        receive_msg_topic = receive.topic()
+        if self.active_topics is not None and receive_msg_topic not in self.active_topics:
+            return None
+        return DecodedMessage(receive_msg_topic, receive.convert2json(), receive.timestamp())
+
+    def event_time(self, receive_msg):
+        ''' Producer's `timestamp` (seconds) in message if given, kafka message timestamp otherwise
+
+            Args:
+                receive_msg(DecodedMessage): decoded incoming message
+
+            Returns:
+                datetime or None if no timestamp in message
+        '''
+        value = receive_msg.value
+        if isinstance(value, dict) and isinstance(value.get('timestamp'), (int, long, float)):
+            return TimeUtils().cvt_timestamp2datetime(value['timestamp'])
+        if receive_msg.timestamp is not None:
+            return TimeUtils().cvt_timestamp2datetime(receive_msg.timestamp)
+        return None
+
     def match(self, receive_msg, receive_dt):
         ''' Check if incoming message match one of the wanted_msgs
 
             Args:
-                receive_msg(confluent_kafka.Message): incoming message
+                receive_msg(confluent_kafka.Message or DecodedMessage): incoming message
                 receive_dt(datetime): receiving time
 
             Returns:
                 json or None. return wanted_msg and receive_msg if matched, None otherwise
         '''
-        try:
-            receive = KafkaHandler('kafka').msg_handler(receive_msg, 'receive')
-            receive_msg_topic = receive.topic()
-            receive_msg_value =  receive.convert2json()
-
-            topic_wanted_msgs = self.get_wanted_msgs(topic=receive_msg_topic, render=True)
-            for wanted_msg in topic_wanted_msgs:
-                topic_handler = topic_factory(receive_msg_topic).msg_handler(wanted_msg)
-                if topic_handler.match(receive_msg_value, receive_dt):
-                    return wanted_msg, receive_msg_value
+        decoded = self.decode(receive_msg)
+        if decoded is None:
             return None, None
-        except:
-            raise
+
+        topic_wanted_msgs = self.get_wanted_msgs(topic=decoded.topic, render=True)
+        for wanted_msg in topic_wanted_msgs:
+            topic_handler = topic_factory(decoded.topic).msg_handler(wanted_msg)
+            if topic_handler.match(decoded.value, receive_dt):
+                return wanted_msg, decoded.value
+        return None, None
+
+    def match_batch(self, receive_msgs, receive_dt):
+        ''' Match decoded messages consumed in one poke, see BaseAllMessageHandler.match_batch
+
+            With batch_match, messages are grouped by topic. For each topic, values of the
+            keys to match are looked up in an index of the rendered wanted messages, and
+            timestamps are checked against the range of the receiving day at once (by
+            numpy if installed). Only the matched rows are built into results. Messages
+            that can not be checked by columns (e.g. not a dict or time is not a unix
+            timestamp) are matched one by one
+        '''
+        if not self.batch_match:
+            return super(KafkaAllMessageHandler, self).match_batch(receive_msgs, receive_dt)
+        matches, errors = dict(), dict()
+        rows_of_topic = dict()
+        for i, receive_msg in enumerate(receive_msgs):
+            rows_of_topic.setdefault(receive_msg.topic, list()).append(i)
+
+        for topic, rows in rows_of_topic.iteritems():
+            index = self.get_wanted_index(topic)
+            if index is None:
+                for i in rows:
+                    self._match_one(receive_msgs, i, receive_dt, matches, errors)
+                continue
+            handler, wanted_by_keys = index
+            keys = handler.match_keys + [k for k, _ in handler.render_match_keys]
+            all_keys = handler._get_all_keys()
+            # candidates whose keys equal one of the wanted messages
+            candidates, times = list(), list()
+            for i in rows:
+                value = receive_msgs[i].value
+                if not isinstance(value, dict) or not all(k in value for k in all_keys):
+                    self._match_one(receive_msgs, i, receive_dt, matches, errors)
+                    continue
+                try:
+                    wanted_msg = wanted_by_keys.get(tuple(value[k] for k in keys))
+                except TypeError:
+                    # unhashable values
+                    self._match_one(receive_msgs, i, receive_dt, matches, errors)
+                    continue
+                if wanted_msg is None:
+                    continue
+                if handler.time_key is not None and \
+                        not isinstance(value[handler.time_key], six.integer_types):
+                    self._match_one(receive_msgs, i, receive_dt, matches, errors)
+                    continue
+                candidates.append((i, wanted_msg))
+                if handler.time_key is not None:
+                    times.append(value[handler.time_key])
+
+            if handler.time_key is not None:
+                # message time after offset should be in the day of receive_dt after offset
+                start, end = handler.day_bucketer.day_range(handler.day_bucket(receive_dt))
+                in_day = in_range(times, start - handler.offset_sec, end - handler.offset_sec)
+                candidates = [c for c, ok in zip(candidates, in_day) if ok]
+            for i, wanted_msg in candidates:
+                matches[i] = (wanted_msg, receive_msgs[i].value)
+        return matches, errors
+
+    def _match_one(self, receive_msgs, i, receive_dt, matches, errors):
+        try:
+            match_wanted, match_receive = self.match(receive_msgs[i], receive_dt)
+        except Exception, e:
+            errors[i] = e
+        else:
+            if match_wanted is not None:
+                matches[i] = (match_wanted, match_receive)
+
+    def get_wanted_index(self, topic):
+        ''' Topic message handler and {values of match keys and render match keys:
+            first rendered wanted message with them} of topic, None if messages of topic
+            are not matched by key equality and day of time key, i.e. match or the
+            comparisons of Match are overridden
+        '''
+        if topic not in self.wanted_index:
+            index = None
+            wanted_msgs = self.get_wanted_msgs(topic=topic, render=True)
+            topic_cls = topic_factory(topic)
+            if wanted_msgs and topic_cls is not None:
+                handler = topic_cls.msg_handler(wanted_msgs[0])
+                if isinstance(handler, BasicMessage) and \
+                        type(handler).match.__func__ is BasicMessage.match.__func__ and \
+                        is_default_match(handler.get_match_handler()):
+                    keys = handler.match_keys + [k for k, _ in handler.render_match_keys]
+                    wanted_by_keys = dict()
+                    for wanted_msg in wanted_msgs:
+                        wanted_by_keys.setdefault(tuple(wanted_msg.get(k) for k in keys), wanted_msg)
+                    index = (handler, wanted_by_keys)
+            self.wanted_index[topic] = index
+        return self.wanted_index[topic]
+
+
+def is_default_match(match_handler):
+    ''' Whether match_handler compares messages as Match, which batch_match implements '''
+    return all(getattr(match_handler, name, None) is getattr(Match, name)
+               for name in ['match_by_keys', 'match_by_rkeys', 'match_by_tkey'])
+
+
+def in_range(values, start, end):
+    ''' Whether each value is in [start, end) '''
+    if np is not None and values:
+        try:
+            array = np.array(values, dtype=np.int64)
+        except OverflowError:
+            pass
+        else:
+            return ((array >= start) & (array < end)).tolist()
+    return [start <= v < end for v in values]
+
+
+class DecodedMessage(object):
+    ''' Topic and json value of a kafka message, decoded once before matching '''
+
+    __slots__ = ('topic', 'value', 'timestamp')
+
+    def __init__(self, topic, value, timestamp=None):
+        self.topic = topic
+        self.value = value
+        # kafka message timestamp in seconds, None if not available
+        self.timestamp = timestamp
 
 
 class KafkaSingleMessageHandler(BaseSingleMessageHandler):
@@ -158,6 +336,15 @@ class KafkaSingleMessageHandler(BaseSingleMessageHandler):
         def topic(self):
             return self.msg.topic()
 
+        def timestamp(self):
+            ''' Kafka message timestamp in seconds, None if not available '''
+            if not hasattr(self.msg, 'timestamp'):
+                return None
+            ts_type, ts = self.msg.timestamp()
+            if ts_type == TIMESTAMP_NOT_AVAILABLE:
+                return None
+            return ts / 1000.0
+
         def convert2json(self):
             try:
                 if isinstance(self.value(), six.string_types):
@@ -1,15 +1,26 @@
 # -*- coding: UTF-8 -*-
 from __future__ import print_function
 
-import json
+from collections import OrderedDict
+from airflow.exceptions import AirflowException
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
+from event_plugins.common.metrics import StageTimer
 from event_plugins.factory import plugin_factory
-from event_plugins.kafka.produce.utils import merge_multiple_files
+from event_plugins.kafka.produce.merge import MergeEngine
+from event_plugins.kafka.produce.utils import encode_message, iter_messages, read_pool
 from event_plugins.kafka.produce.factory import topic_factory
 
 
+def log_summary(log, summary):
+    ''' Log the delivery summary and fail the task if any message is not delivered '''
+    if summary.ok:
+        log.info("produce finished, {}".format(summary))
+    else:
+        raise AirflowException("produce finished with errors, {}".format(summary))
+
+
 class KafkaProducerOperator(BaseOperator):
 
     ui_color = '#4db8ff'
@@ -21,21 +32,28 @@ class KafkaProducerOperator(BaseOperator):
                  broker,
                  topic,
                  data,
+                 producer_profile=None,
+                 producer_config=None,
+                 flush_timeout=30,
                  *args,
                  **kwargs):
         super(KafkaProducerOperator, self).__init__(*args, **kwargs)
         self.broker = broker
         self.topic = topic
         self.data = data
+        self.producer_profile = producer_profile
+        self.producer_config = producer_config
+        self.flush_timeout = flush_timeout
 
     def initialize_conn_handler(self):
         self.conn_handler = plugin_factory(self.name).conn_handler(self.broker)
-        self.conn_handler.set_producer()
+        self.conn_handler.set_producer(self.producer_profile, self.producer_config)
 
     def execute(self, context):
         self.initialize_conn_handler()
-        for data in self.data:
-            self.conn_handler.produce(self.topic, data)
+        summary = self.conn_handler.produce_batch(
+            ((self.topic, data) for data in self.data), flush_timeout=self.flush_timeout)
+        log_summary(self.log, summary)
 
 
 class KafkaProducerFromFileOperator(BaseOperator):
@@ -48,23 +66,58 @@ class KafkaProducerFromFileOperator(BaseOperator):
     def __init__(self,
                  broker,
                  file_list,
+                 read_workers=1,
+                 read_pool='thread',
+                 keep_order=True,
+                 producer_profile=None,
+                 producer_config=None,
+                 flush_timeout=30,
                  *args,
                  **kwargs):
         super(KafkaProducerFromFileOperator, self).__init__(*args, **kwargs)
         self.broker = broker
         self.file_list = file_list
+        self.read_workers = read_workers
+        self.read_pool = read_pool
+        self.keep_order = keep_order
+        self.producer_profile = producer_profile
+        self.producer_config = producer_config
+        self.flush_timeout = flush_timeout
 
     def initialize_conn_handler(self):
         self.conn_handler = plugin_factory(self.name).conn_handler(self.broker)
-        self.conn_handler.set_producer()
+        self.conn_handler.set_producer(self.producer_profile, self.producer_config)
 
     def execute(self, context):
-        self.initialize_conn_handler()
-        result = merge_multiple_files(self.file_list)
-        for topic, msgs in result.iteritems():
-            for msg in msgs:
-                self.log.info("try producing {data} to {topic}".format(data=msg, topic=topic))
-                self.conn_handler.produce(topic, json.dumps(msg))
+        # produce while reading files, so that the memory usage doesn't grow with file size
+        self.produce_from_files(
+            lambda msgs: ((topic, encode_message(msg)) for topic, msg in msgs))
+
+    def produce_from_files(self, to_batch):
+        ''' Initialize the producer, produce messages read from file_list and log the
+            time spent on each stage
+            Args:
+                to_batch(function): convert iterator of (topic, message) in files to
+                    iterator of (topic, message string) to produce
+        '''
+        timer = StageTimer()
+        # start the read pool before the producer, a process pool must not be forked
+        # after librdkafka has started its threads
+        with read_pool(self.read_workers, self.read_pool) as worker_pool:
+            self.initialize_conn_handler()
+            msgs = iter_messages(self.file_list, workers=self.read_workers,
+                                 keep_order=self.keep_order, timer=timer,
+                                 worker_pool=worker_pool)
+            with timer.stage('total'):
+                summary = self.conn_handler.produce_batch(timer.iterate(to_batch(msgs), 'wait'),
+                                                          flush_timeout=self.flush_timeout)
+        # time of producing excludes time waiting for the messages from files
+        timer.add('produce', timer.get('total') - timer.get('wait'))
+        self.log.info("time spent on read: {:.3f}s, parse: {:.3f}s, produce: {:.3f}s,"
+                      " total: {:.3f}s".format(timer.get('read'), timer.get('parse'),
+                                              timer.get('produce'), timer.get('total')))
+        log_summary(self.log, summary)
+        return summary
 
 
 class KafkaProducerFromMergeFileOperator(KafkaProducerFromFileOperator):
@@ -82,28 +135,30 @@ class KafkaProducerFromMergeFileOperator(KafkaProducerFromFileOperator):
         self.match_dict = match_dict
 
     def execute(self, context):
-        self.initialize_conn_handler()
-        result = merge_multiple_files(self.file_list)
-        for topic, msgs in result.iteritems():
-            handler_cls = topic_factory(topic)
-            if handler_cls:
-                msg_iterator = self.get_merge_msg(handler_cls, topic, msgs)
-                for msg in msg_iterator:
+        self.produce_from_files(self.get_merge_batch)
+
+    def get_merge_batch(self, msgs):
+        ''' Merge (topic, message) pairs in one pass and yield (topic, merged message string) '''
+        engines = OrderedDict()
+        for topic, msg in msgs:
+            if topic not in engines:
+                handler_cls = topic_factory(topic)
+                engines[topic] = handler_cls and self.get_merge_engine(handler_cls, topic)
+            if engines[topic]:
+                engines[topic].add(msg)
+        for topic, engine in engines.iteritems():
+            if engine:
+                for msg in engine.get_merge_msgs():
                     if msg:
-                        msg_str = json.dumps(msg, ensure_ascii=False)
-                        self.conn_handler.produce(topic, msg_str)
+                        yield topic, encode_message(msg, ensure_ascii=False)
 
-    def get_merge_msg(self, handler_cls, topic, msgs):
-        match_grps = self.match_dict.get(handler_cls(None).__class__.__name__)
+    def get_merge_engine(self, handler_cls, topic):
+        match_grps = self.match_dict.get(handler_cls.__name__)
         if not match_grps:
             self.log.warning("{h} not found in match_dict, but there are messages with topic: {t}"
                 " that can be processed by {h}. Define (key: value) in match_dict"
                 " to merge messages".format(
-                    h=handler_cls(None).__class__.__name__,
+                    h=handler_cls.__name__,
                     t=topic))
-        else:
-            for match_method in match_grps:
-                handler = handler_cls(match_method)
-                groups = filter(handler.match, msgs)
-                msg = handler.merge_messages(groups)
-                yield msg
+            return None
+        return MergeEngine(handler_cls, match_grps)
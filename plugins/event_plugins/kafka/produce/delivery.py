@@ -0,0 +1,70 @@
+# -*- coding: UTF-8 -*-
+from __future__ import division
+
+import random
+
+
+class DeliverySummary(object):
+    ''' Aggregated delivery result of a batch of produced messages
+        Attributes:
+            delivered(int): number of messages acked by broker
+            failed(int): number of messages failed permanently
+            undelivered(int): messages still in queue when flush timeout
+            errors(dict): {error string: count}
+            latencies(list): seconds from enqueue to delivery report, a uniform sample
+                (reservoir) of at most max_samples messages so that memory doesn't grow
+                with the number of messages
+            max_latency(float): max seconds from enqueue to delivery report
+    '''
+
+    def __init__(self, max_samples=10000):
+        self.delivered = 0
+        self.failed = 0
+        self.undelivered = 0
+        self.errors = dict()
+        self.latencies = list()
+        self.max_latency = None
+        self.max_samples = max_samples
+        self.reported = 0
+
+    @property
+    def total(self):
+        return self.delivered + self.failed + self.undelivered
+
+    @property
+    def ok(self):
+        return self.failed == 0 and self.undelivered == 0
+
+    def record(self, err, latency):
+        self.reported += 1
+        if len(self.latencies) < self.max_samples:
+            self.latencies.append(latency)
+        else:
+            i = random.randint(0, self.reported - 1)
+            if i < self.max_samples:
+                self.latencies[i] = latency
+        self.max_latency = max(self.max_latency, latency)
+        if err is None:
+            self.delivered += 1
+        else:
+            self.failed += 1
+            key = str(err)
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def percentile(self, p):
+        ''' Get the p-th percentile (nearest rank) of sampled latencies, None if nothing reported '''
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        rank = max(int(round(p / 100 * len(latencies))), 1)
+        return latencies[min(rank, len(latencies)) - 1]
+
+    def __str__(self):
+        text = 'delivered: {}, failed: {}, undelivered: {}'.format(
+            self.delivered, self.failed, self.undelivered)
+        if self.latencies:
+            text += ', latency p50: {:.3f}s, p99: {:.3f}s, max: {:.3f}s'.format(
+                self.percentile(50), self.percentile(99), self.max_latency)
+        if self.errors:
+            text += ', errors: {}'.format(self.errors)
+        return text
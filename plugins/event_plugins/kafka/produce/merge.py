@@ -0,0 +1,54 @@
+# -*- coding: UTF-8 -*-
+
+
+def join_values(merged, value):
+    return '+'.join([merged, value])
+
+
+def merge_dict_values(merged, value):
+    merged = dict(merged)
+    merged.update(value)
+    return merged
+
+
+# reducers to merge value of a field, which aggregate incrementally: f(merged, value)
+reducers = {
+    'sum': lambda merged, value: merged + value,
+    'max': max,
+    'join': join_values,
+    'dict_merge': merge_dict_values
+}
+
+
+class MergeEngine(object):
+    ''' Merge messages of a topic into one message per match group in a single pass
+        Args:
+            handler_cls(class): topic class in produce.topic, define `merge_rules`
+            match_grps(list): match methods, [{key1: value1, key2: value2}, ...]
+
+        The match methods are indexed by their keys, {(key1, key2): {(value1, value2): [group]}},
+        so every message is hashed once per distinct set of keys instead of being compared
+        with every match method.
+    '''
+
+    def __init__(self, handler_cls, match_grps):
+        self.handlers = [handler_cls(match_method) for match_method in match_grps]
+        self.merged = [None] * len(match_grps)
+        self.index = dict()
+        for grp, match_method in enumerate(match_grps):
+            keys = tuple(sorted(match_method))
+            values = tuple(match_method[k] for k in keys)
+            self.index.setdefault(keys, dict()).setdefault(values, list()).append(grp)
+
+    def add(self, msg):
+        for keys, grps in self.index.iteritems():
+            try:
+                values = tuple(msg[k] for k in keys)
+            except KeyError:
+                continue
+            for grp in grps.get(values, ()):
+                self.merged[grp] = self.handlers[grp].reduce(self.merged[grp], msg)
+
+    def get_merge_msgs(self):
+        ''' Return merged message of each group in order of match_grps, None if no message '''
+        return list(self.merged)
@@ -1,3 +1,6 @@
+import copy
+
+from event_plugins.kafka.produce.merge import reducers
 
 
 class Base(object):
@@ -8,6 +11,10 @@ class Base(object):
         }]
     '''
 
+    # how to merge value of each field, {field: reducer name in produce.merge.reducers},
+    # other fields are kept as the first message
+    merge_rules = dict()
+
     def __init__(self, match_method):
         self.match_method = match_method
 
@@ -15,11 +22,24 @@ class Base(object):
         '''
             return True if (key: value) in match_methods match the (key:value) in item
         '''
-        return all([item[k] == v for k, v in self.match_method.iteritems()])
+        return all(item[k] == v for k, v in self.match_method.iteritems())
 
     def merge_messages(self, msg_list):
         '''
-            Implement how to merge multiple messages
+            Merge multiple messages by merge_rules
+        '''
+        merged = None
+        for msg in msg_list:
+            merged = self.reduce(merged, msg)
+        return merged
+
+    def reduce(self, merged, msg):
+        '''
+            Merge one more message into merged message, the message is copied
+            if it's the first one, so that the input messages are not modified
         '''
-        if len(msg_list) > 0:
-            return msg_list[0]
+        if merged is None:
+            return copy.copy(msg)
+        for field, rule in self.merge_rules.iteritems():
+            merged[field] = reducers[rule](merged[field], msg[field])
+        return merged
@@ -9,13 +9,11 @@ class JobFinish(Base):
         }]
     '''
 
+    merge_rules = {
+        'timestamp': 'max',
+        'duration_time': 'sum',
+        'job_name': 'join'
+    }
+
     def __init__(self, match_method):
         super(JobFinish, self).__init__(match_method)
-
-    def merge_messages(self, msg_list):
-        if len(msg_list) > 0:
-            new_msg = msg_list[0]
-            new_msg["timestamp"] = max([v["timestamp"] for v in msg_list])
-            new_msg["duration_time"] = sum([v["duration_time"] for v in msg_list])
-            new_msg["job_name"] = "+".join([v["job_name"] for v in msg_list])
-            return new_msg
@@ -1,27 +1,191 @@
 import ast
+import bz2
+import gzip
+import json
+import multiprocessing
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+
+from event_plugins.common.metrics import StageTimer
+
+
+def open_file(file_path):
+    ''' Open plain, gzip or bz2 file depends on the magic bytes of file '''
+    with open(file_path, 'rb') as f:
+        magic = f.read(3)
+    if magic[:2] == b'\x1f\x8b':
+        return gzip.open(file_path, 'rb')
+    elif magic == b'BZh':
+        return bz2.BZ2File(file_path, 'rb')
+    return open(file_path, 'rb')
+
+
+def parse_line(line):
+    try:
+        # keep key order of objects so that messages are produced as they are in file
+        return json.loads(line, object_pairs_hook=OrderedDict)
+    except ValueError:
+        # legacy format written by python repr
+        line = line.replace('true', 'True').replace('false', 'False')
+        return ast.literal_eval(line)
 
 
 def read_data_from_file(file_path):
-    with open(file_path, 'r') as lines:
+    lines = open_file(file_path)
+    try:
         for line in lines:
-            line = line.strip().replace('true', 'True').replace('false', 'False')
-            # not using json.loads since string would be converted to unicode
-            # which can not be converted back when producing messages
-            json_obj = ast.literal_eval(line)
-            yield json_obj
+            line = line.strip()
+            if line:
+                yield parse_line(line)
+    finally:
+        lines.close()
+
+
+def read_file(file_path):
+    ''' Read and parse a whole file, used by workers of read pool
+        Returns:
+            (msgs, read_secs, parse_secs): msgs is list of (topic, message) in file
+    '''
+    started = time.time()
+    f = open_file(file_path)
+    try:
+        lines = f.read().splitlines()
+    finally:
+        f.close()
+    read_at = time.time()
+    msgs = list()
+    for line in lines:
+        line = line.strip()
+        if line:
+            obj = parse_line(line)
+            msgs.extend((obj['topic'], msg) for msg in obj['data'])
+    return msgs, read_at - started, time.time() - read_at
+
+
+def try_read_file(file_path):
+    ''' read_file returning (result, error), so that callback of pool is called on failure too '''
+    try:
+        return read_file(file_path), None
+    except Exception, e:
+        return None, e
+
+
+read_pools = {
+    'thread': ThreadPool,
+    'process': multiprocessing.Pool
+}
+
+
+@contextmanager
+def read_pool(workers, pool='thread'):
+    ''' Pool of iter_messages, None if workers <= 1. Worker processes are started on
+        creation, so create it before any kafka client: forking after librdkafka has
+        started its threads is unsafe
+    '''
+    if workers <= 1:
+        yield None
+        return
+    worker_pool = read_pools[pool](workers)
+    try:
+        yield worker_pool
+    finally:
+        worker_pool.terminate()
+        worker_pool.join()
+
+
+def iter_messages(file_list, workers=1, pool='thread', keep_order=True, timer=None,
+                  worker_pool=None):
+    ''' Read files and yield (topic, message) of each message in files
+        Args:
+            file_list(list): paths of files
+            workers(int): number of files read concurrently. If 1, files are read lazily
+                line by line in current thread. Otherwise each file is read as a whole
+                by a pool, with at most 2 * workers files in memory
+            pool(str): 'thread' or 'process', process pool is for parsing bound inputs
+            keep_order(bool): yield files in order of file_list, so that the order of
+                messages in each topic is the same as reading files one by one.
+                Otherwise yield files as soon as they are read
+            timer(StageTimer): record seconds spent on reading and parsing as
+                'read' and 'parse' (summed over workers)
+            worker_pool(Pool): pool created by read_pool, a new pool is created
+                and terminated by the iterator if not set
+    '''
+    timer = timer or StageTimer()
+    if workers <= 1:
+        for fpath in file_list:
+            lines = open_file(fpath)
+            try:
+                for line in timer.iterate(lines, 'read'):
+                    line = line.strip()
+                    if line:
+                        with timer.stage('parse'):
+                            obj = parse_line(line)
+                        for msg in obj['data']:
+                            yield obj['topic'], msg
+            finally:
+                lines.close()
+        return
+    if worker_pool is None:
+        with read_pool(workers, pool) as worker_pool:
+            for msg in iter_pool_messages(worker_pool, file_list, workers, keep_order, timer):
+                yield msg
+    else:
+        for msg in iter_pool_messages(worker_pool, file_list, workers, keep_order, timer):
+            yield msg
+
+
+def iter_pool_messages(worker_pool, file_list, workers, keep_order, timer):
+    ''' Read files by worker_pool with at most 2 * workers files in flight '''
+    files = iter(file_list)
+    pending = deque()
+    # results of unordered reads, in order of completion
+    done = Queue()
+
+    def submit():
+        for fpath in files:
+            if keep_order:
+                pending.append(worker_pool.apply_async(read_file, (fpath, )))
+            else:
+                pending.append(worker_pool.apply_async(
+                    try_read_file, (fpath, ), callback=done.put))
+            return
+
+    for _ in range(workers * 2):
+        submit()
+    while pending:
+        if keep_order:
+            msgs, read_secs, parse_secs = pending.popleft().get()
+        else:
+            pending.pop()
+            result, error = done.get()
+            if error is not None:
+                raise error
+            msgs, read_secs, parse_secs = result
+        submit()
+        timer.add('read', read_secs)
+        timer.add('parse', parse_secs)
+        for msg in msgs:
+            yield msg
 
 
 def merge_multiple_files(file_list):
     result = dict()
-    for fpath in file_list:
-        for obj in read_data_from_file(fpath):
-            if obj['topic'] not in result:
-                result[obj['topic']] = obj['data']
-            else:
-                result[obj['topic']].extend(obj['data'])
+    for topic, msg in iter_messages(file_list):
+        result.setdefault(topic, list()).append(msg)
     return result
 
 
+def encode_message(msg, ensure_ascii=True):
+    ''' Dump message to json string in bytes '''
+    msg_str = json.dumps(msg, ensure_ascii=ensure_ascii)
+    if isinstance(msg_str, unicode):
+        msg_str = msg_str.encode('utf-8')
+    return msg_str
+
+
 def merge_dicts(dict_list):
     result = {}
     for dictionary in dict_list:
@@ -0,0 +1,385 @@
+# -*- coding: UTF-8 -*-
+''' Replay recorded kafka traffic through a KafkaConsumerOperator offline, as fast as possible
+
+    The recording is json lines of messages, in the format of `kafkacat -C -J` or
+    {"topic": ..., "partition": ..., "offset": ..., "timestamp": <ms>, "value": ...}
+    (gzip or bz2 compressed files are also accepted)
+
+    usage:
+        python -m event_plugins.kafka.replay recording.json msgs.json --poke-interval 60
+
+    Each poke consumes the messages produced within the next poke_interval seconds of the
+    recording, and TimeUtils().get_now() returns the end of that window, so the sensor
+    sees the same day (and timeouts) as it did in production.
+'''
+from __future__ import print_function
+
+import argparse
+import bisect
+import json
+import six
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from confluent_kafka import TIMESTAMP_CREATE_TIME
+
+from event_plugins.base.base_connector import BaseConnector
+from event_plugins.common.metrics import StageTimer
+from event_plugins.common.schedule.time_utils import TimeUtils, AIRFLOW_EVENT_PLUGINS_TIMEZONE
+from event_plugins.common.storage.db import get_session
+from event_plugins.common.storage.event_message import EventMessage, EventMessageCRUD, EventOffset
+from event_plugins.kafka.kafka_consumer_plugin import KafkaConsumerOperator
+from event_plugins.kafka.produce.utils import open_file
+
+
+class ReplayMessage(object):
+    ''' Recorded message with the subset of confluent_kafka.Message used by sensors '''
+
+    __slots__ = ('_topic', '_partition', '_offset', '_key', '_value', '_timestamp')
+
+    def __init__(self, topic, partition, offset, value, timestamp, key=None):
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._key = key
+        self._value = value
+        self._timestamp = timestamp
+
+    @classmethod
+    def from_json(cls, obj):
+        ''' Message from a line of recording, `ts`/`payload` are the fields of kafkacat '''
+        value = obj['value'] if 'value' in obj else obj.get('payload')
+        if value is not None and not isinstance(value, six.string_types):
+            value = json.dumps(value)
+        return cls(obj['topic'], obj.get('partition', 0), obj['offset'], value,
+                   obj['timestamp'] if 'timestamp' in obj else obj['ts'], obj.get('key'))
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def key(self):
+        return self._key
+
+    def value(self):
+        return self._value
+
+    def timestamp(self):
+        return TIMESTAMP_CREATE_TIME, self._timestamp
+
+    def error(self):
+        return None
+
+
+class Recording(object):
+    ''' Recorded messages of each partition, ordered by offset
+        Args:
+            messages(iterable): ReplayMessage
+    '''
+
+    def __init__(self, messages):
+        self.partitions = dict()    # {(topic, partition): [message]}
+        for msg in messages:
+            self.partitions.setdefault((msg.topic(), msg.partition()), list()).append(msg)
+        for msgs in self.partitions.values():
+            msgs.sort(key=lambda m: m.offset())
+        # running max of timestamps (ms) of each partition, a message is available once
+        # it and all the messages before it in the partition are produced
+        self.timestamps = dict()
+        for tp, msgs in self.partitions.iteritems():
+            timestamps = self.timestamps[tp] = list()
+            for msg in msgs:
+                ts = msg.timestamp()[1]
+                timestamps.append(max(ts, timestamps[-1]) if timestamps else ts)
+        all_timestamps = [max_ts for tp_timestamps in self.timestamps.values()
+                          for max_ts in tp_timestamps]
+        self.start = min(all_timestamps) if all_timestamps else None
+        self.end = max(all_timestamps) if all_timestamps else None
+
+    @classmethod
+    def load(cls, path):
+        def read_lines():
+            lines = open_file(path)
+            try:
+                for line in lines:
+                    line = line.strip()
+                    if line:
+                        yield ReplayMessage.from_json(json.loads(line))
+            finally:
+                lines.close()
+        return cls(read_lines())
+
+    def __len__(self):
+        return sum(len(msgs) for msgs in self.partitions.values())
+
+    def topics(self):
+        return set(t for t, _ in self.partitions)
+
+    def produced_before(self, topic, partition, timestamp):
+        ''' Number of messages in partition produced before timestamp (ms),
+            i.e. high watermark at that time
+        '''
+        return bisect.bisect_left(self.timestamps.get((topic, partition), []), timestamp)
+
+
+class ReplayConnector(BaseConnector):
+    ''' Stand-in of KafkaConnector which consumes a recording window by window
+        Args:
+            recording(Recording): messages to replay
+            poke_interval(int): seconds of recording consumed by each poke
+    '''
+
+    topics = []
+    paused_topics = set()
+
+    def __init__(self, recording, poke_interval):
+        super(ReplayConnector, self).__init__()
+        self.recording = recording
+        self.poke_interval = poke_interval
+        self.consumer = None
+        # replay clock in ms, messages produced before it are available to consume
+        self.clock = recording.start if recording.start is not None else int(time.time() * 1000)
+        self.positions = dict()     # {(topic, partition): next offset index}
+
+    def set_consumer(self, group_id, client_id, topics, timeout=5,
+                     group_instance_id=None, session_timeout=None, offsets=None):
+        self.consumer = self.recording
+        self.set_topics(topics, offsets)
+
+    def set_topics(self, topics, offsets=None):
+        ''' Consume topics from offsets if given or from the start of recording,
+            positions of partitions being consumed are kept
+        '''
+        offsets = offsets or dict()
+        self.topics = list(topics)
+        positions = dict()
+        for tp in self.recording.partitions:
+            if tp[0] not in self.topics:
+                continue
+            positions[tp] = self.positions[tp] if tp in self.positions \
+                else self._index(tp, offsets.get(tp))
+        self.positions = positions
+
+    def _index(self, tp, offset):
+        ''' Position in recorded messages of partition of the offset to consume '''
+        if offset is None:
+            return 0
+        offsets = [m.offset() for m in self.recording.partitions[tp]]
+        return bisect.bisect_left(offsets, offset)
+
+    def set_active_topics(self, topics):
+        self.paused_topics = set(self.topics) - set(topics)
+
+    def tick(self):
+        ''' Move the replay clock to the end of next poke window
+            Returns:
+                False if the whole recording has been replayed
+        '''
+        if self.recording.end is None or self.clock > self.recording.end:
+            return False
+        self.clock += self.poke_interval * 1000
+        return True
+
+    def now(self, tz=AIRFLOW_EVENT_PLUGINS_TIMEZONE):
+        return TimeUtils().cvt_timestamp2datetime(self.clock / 1000.0, tz)
+
+    def get_messages(self):
+        msgs = list()
+        for (topic, partition), index in sorted(self.positions.items()):
+            if topic in self.paused_topics:
+                continue
+            high = self.recording.produced_before(topic, partition, self.clock)
+            msgs.extend(self.recording.partitions[(topic, partition)][index:high])
+            self.positions[(topic, partition)] = max(index, high)
+        return msgs
+
+    def get_offsets(self):
+        offsets = dict()
+        for tp, index in self.positions.items():
+            if index > 0:
+                offsets[tp] = self.recording.partitions[tp][index - 1].offset() + 1
+        return offsets
+
+    def get_lag(self, timeout=1):
+        return dict(((topic, partition),
+                     max(self.recording.produced_before(topic, partition, self.clock) - index, 0))
+                    for (topic, partition), index in self.positions.items()
+                    if topic not in self.paused_topics)
+
+    def close(self):
+        pass
+
+
+@contextmanager
+def replay_clock(connector):
+    ''' Make TimeUtils().get_now() and get_now_ts() return the replay clock of connector '''
+    get_now = TimeUtils.__dict__['get_now']
+    get_now_ts = TimeUtils.__dict__['get_now_ts']
+
+    def replay_now(utils, tz=AIRFLOW_EVENT_PLUGINS_TIMEZONE):
+        return connector.now(tz)
+
+    def replay_now_ts(utils):
+        return connector.clock / 1000.0
+
+    TimeUtils.get_now = replay_now
+    TimeUtils.get_now_ts = replay_now_ts
+    try:
+        yield
+    finally:
+        TimeUtils.get_now = get_now
+        TimeUtils.get_now_ts = get_now_ts
+
+
+def replay_operator_cls(operator_cls, session):
+    ''' Subclass of operator_cls whose status db is session, given to the db handler
+        when the operator is built so that the status db in config is never connected
+    '''
+    def set_db_handler(self, sensor_name):
+        self.db_handler = EventMessageCRUD(self.source_type, sensor_name, session)
+
+    return type('Replay' + operator_cls.__name__, (operator_cls, ),
+                {'set_db_handler': set_db_handler})
+
+
+class ReplayReport(object):
+    ''' Match results and cost of pokes in a replay '''
+
+    def __init__(self):
+        self.pokes = 0
+        self.counters = OrderedDict()
+        self.timer = StageTimer()
+        self.matches = list()
+        self.unreceived = list()
+        self.criteria_met_at = None
+        self.wall_seconds = 0
+        self.seen = set()
+
+    def add_poke(self, metrics):
+        ''' Sum up the metrics of a poke '''
+        self.pokes += 1
+        for name, count in metrics.counters.iteritems():
+            self.counters[name] = self.counters.get(name, 0) + count
+        for name, seconds in metrics.timer.stages.iteritems():
+            self.timer.add(name, seconds)
+
+    def add_matches(self, db_handler, replay_dt):
+        ''' Record wanted messages received since last poke '''
+        for r in db_handler.get_sensor_messages():
+            if r.last_receive_time is None or (r.msg, r.last_receive_time) in self.seen:
+                continue
+            self.seen.add((r.msg, r.last_receive_time))
+            msg = json.loads(r.msg)
+            self.matches.append(OrderedDict([
+                ('task_id', msg.get('task_id')),
+                ('topic', msg.get('topic')),
+                ('poke', self.pokes),
+                ('replay_time', TimeUtils().cvt_datetime2str(replay_dt)),
+                ('event_time', TimeUtils().cvt_datetime2str(r.last_event_time)
+                    if r.last_event_time else None),
+                ('receive', r.last_receive)
+            ]))
+
+    def to_dict(self):
+        return OrderedDict([
+            ('pokes', self.pokes),
+            ('criteria_met_at_poke', self.criteria_met_at),
+            ('counters', self.counters),
+            ('stages', self.timer.stages),
+            ('wall_seconds', self.wall_seconds),
+            ('matches', self.matches),
+            ('unreceived', self.unreceived)
+        ])
+
+    def __str__(self):
+        lines = ['pokes: {}, criteria met at poke: {}, wall: {:.3f}s'.format(
+                    self.pokes, self.criteria_met_at, self.wall_seconds),
+                 'counters: {}'.format(', '.join('{}: {}'.format(k, v)
+                                                 for k, v in self.counters.iteritems())),
+                 'stages: {}'.format(self.timer)]
+        for m in self.matches:
+            lines.append('matched {} at poke {} ({})'.format(m['task_id'], m['poke'], m['replay_time']))
+        for msg in self.unreceived:
+            lines.append('not received {}'.format(msg.get('task_id')))
+        return '\n'.join(lines)
+
+
+def replay(recording, msgs, poke_interval=60, sql_alchemy_conn='sqlite://',
+           sensor_name='replay', operator_cls=KafkaConsumerOperator, **operator_kwargs):
+    ''' Replay recording through a sensor of msgs, at maximum speed
+        Args:
+            recording(Recording): recorded messages
+            msgs(list): wanted messages of the sensor, as `msgs` of the DAG
+            poke_interval(int): seconds of recording consumed by each poke
+            sql_alchemy_conn(str): status db of the replay, in-memory sqlite by default
+            operator_cls(class): KafkaConsumerOperator or its subclass
+            operator_kwargs: other arguments of operator, e.g. consume_mode.
+                Tasks are not marked success since there's no dag run
+        Returns:
+            ReplayReport
+    '''
+    report = ReplayReport()
+    session = get_session(sql_alchemy_conn)
+    EventMessage.metadata.create_all(session.get_bind(),
+                                     tables=[EventMessage.__table__, EventOffset.__table__])
+    operator = replay_operator_cls(operator_cls, session)(
+        task_id=sensor_name, sensor_name=sensor_name, broker=None, group_id=sensor_name,
+        client_id=sensor_name, msgs=msgs, poke_interval=poke_interval, mark_success=False,
+        **operator_kwargs)
+
+    def emit_metrics():
+        # sum up pokes instead of sending to statsd
+        report.add_poke(operator.metrics)
+        operator.metrics.reset()
+    operator.emit_metrics = emit_metrics
+
+    connector = ReplayConnector(recording, poke_interval)
+    started = time.time()
+    with replay_clock(connector):
+        operator.initialize_db_handler()
+        topics = operator.all_msgs_handler.subscribe_topics(operator.db_handler.get_unreceived_msgs())
+        connector.set_consumer(sensor_name, sensor_name, topics,
+                               offsets=operator.get_stored_offsets())
+        operator.conn_handler = connector
+        while connector.tick():
+            criteria_met = operator.poke(None, connector)
+            report.add_matches(operator.db_handler, connector.now())
+            if criteria_met:
+                report.criteria_met_at = report.pokes
+                break
+        report.unreceived = operator.db_handler.get_unreceived_msgs()
+    report.wall_seconds = time.time() - started
+    operator.close_connection()
+    session.remove()
+    return report
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Replay recorded kafka messages through a sensor')
+    parser.add_argument('recording', help='json lines of recorded messages')
+    parser.add_argument('msgs', help='json file of the wanted messages (msgs of the sensor)')
+    parser.add_argument('--poke-interval', type=int, default=60,
+                        help='seconds of recording consumed by each poke')
+    parser.add_argument('--consume-mode', default='subscribe', choices=['subscribe', 'assign'])
+    parser.add_argument('--db', default='sqlite://', help='status db, in-memory sqlite by default')
+    parser.add_argument('--output', help='write report in json')
+    args = parser.parse_args(args)
+
+    with open(args.msgs) as f:
+        msgs = json.load(f)
+    report = replay(Recording.load(args.recording), msgs, poke_interval=args.poke_interval,
+                    sql_alchemy_conn=args.db, consume_mode=args.consume_mode)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report.to_dict(), f, indent=2, separators=(',', ': '))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+# -*- coding: UTF-8 -*-
+''' Consume with several child processes in the same consumer group, for sensors that one
+    consumer can't keep up with (e.g. thousands of wanted messages on a topic of lots of
+    partitions)
+
+    Every shard (child process) consumes the partitions assigned to it by the group and
+    matches the messages against the wanted messages. Only the matched messages are sent
+    to the parent, which matches them again and owns the status db and marking success.
+
+    Shards don't commit offsets automatically. The parent commits the positions of the
+    batches it has received after storing the matched messages, so messages consumed by
+    shards but not stored yet (e.g. the sensor is stopped) are consumed again.
+'''
+from __future__ import print_function
+
+import multiprocessing
+import time
+from Queue import Empty
+
+from airflow.exceptions import AirflowException
+
+from event_plugins.base.base_connector import BaseConnector
+from event_plugins.common.schedule.time_utils import TimeUtils
+from event_plugins.kafka.kafka_connector import KafkaConnector
+from event_plugins.kafka.kafka_handler import KafkaAllMessageHandler
+
+
+class ShardMessage(object):
+    ''' Matched message sent by a shard, with the subset of confluent_kafka.Message used
+        by sensors
+    '''
+
+    __slots__ = ('_topic', '_partition', '_offset', '_key', '_value', '_timestamp')
+
+    def __init__(self, topic, partition, offset, key, value, timestamp):
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._key = key
+        self._value = value
+        # (timestamp type, timestamp in ms)
+        self._timestamp = timestamp
+
+    @staticmethod
+    def dump(msg):
+        ''' Plain tuple of kafka message to put in queue '''
+        return msg.topic(), msg.partition(), msg.offset(), msg.key(), msg.value(), msg.timestamp()
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def key(self):
+        return self._key
+
+    def value(self):
+        return self._value
+
+    def timestamp(self):
+        return self._timestamp
+
+    def error(self):
+        return None
+
+
+class ShardedKafkaConnector(BaseConnector):
+    ''' Connector of num_shards child consumers, used by KafkaConsumerOperator like KafkaConnector
+        Args:
+            broker(str): kafka bootstrap servers
+            num_shards(int): number of child processes
+            wanted_msgs(list): wanted messages that shards match with before sending messages
+            fetch_timeout(int): seconds get_messages waits for every shard to catch up
+            poll_timeout(int): seconds a shard waits for messages in one consume, it's
+                also the most seconds for a shard to notice a command (e.g. stop)
+            lag_interval(int): seconds between the reports of consumer lag of a shard
+            stop_timeout(int): seconds to wait for shards to close before terminating them
+    '''
+
+    consumer = None
+    topics = []
+    paused_topics = set()
+
+    def __init__(self, broker, num_shards, wanted_msgs, fetch_timeout=30, poll_timeout=1,
+                 lag_interval=10, stop_timeout=10):
+        super(ShardedKafkaConnector, self).__init__()
+        self.broker = broker
+        self.num_shards = num_shards
+        self.wanted_msgs = wanted_msgs
+        self.fetch_timeout = fetch_timeout
+        self.poll_timeout = poll_timeout
+        self.lag_interval = lag_interval
+        self.stop_timeout = stop_timeout
+        self.shards = list()
+        self.commands = list()
+        self.results = None
+        # positions after the last received batch and last reported lag of each shard
+        self.positions = dict()
+        self.lag = dict()
+        self.counters = dict()
+
+    def set_consumer(self, group_id, client_id, topics, timeout=5,
+                     group_instance_id=None, session_timeout=None, offsets=None):
+        ''' Start shards subscribing topics in group_id, client.id (and group.instance.id if
+            static membership) of shards are suffixed with shard number
+        '''
+        if offsets is not None:
+            raise ValueError('sharded consumers need to subscribe topics, assign mode is not supported')
+        self.topics = list(topics)
+        self.results = multiprocessing.Queue()
+        for shard in range(self.num_shards):
+            commands = multiprocessing.Queue()
+            consumer_kwargs = {
+                'timeout': timeout,
+                'group_instance_id': '{}-{}'.format(group_instance_id, shard) if group_instance_id else None,
+                'session_timeout': session_timeout,
+                'enable_auto_commit': False
+            }
+            process = multiprocessing.Process(
+                target=consume_shard,
+                name='{}-shard-{}'.format(client_id, shard),
+                args=(shard, self.broker, group_id, '{}-{}'.format(client_id, shard), self.topics,
+                      consumer_kwargs, self.wanted_msgs, commands, self.results,
+                      self.poll_timeout, self.lag_interval))
+            process.daemon = True
+            process.start()
+            self.shards.append(process)
+            self.commands.append(commands)
+        # shards are the consumers, the connector itself is ready once they are started
+        self.consumer = self.shards
+        self.log.info('started {} shards of consumer {}'.format(self.num_shards, client_id))
+
+    def get_messages(self):
+        ''' Matched messages sent by shards, wait until every shard has consumed all the
+            messages available when called (or fetch_timeout)
+        '''
+        started = time.time()
+        waiting = set(range(len(self.shards)))
+        msgs = list()
+        while waiting:
+            try:
+                self._receive(self.results.get(timeout=self.poll_timeout), started, msgs, waiting)
+            except Empty:
+                self._check_shards()
+                if time.time() - started > self.fetch_timeout:
+                    self.log.warning('shards {} not caught up in {}s'.format(
+                        sorted(waiting), self.fetch_timeout))
+                    break
+        # take the batches already sent, but not the ones shards keep sending meanwhile
+        drained_at = time.time()
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except Empty:
+                break
+            self._receive(result, started, msgs, waiting)
+            if result[1] >= drained_at:
+                break
+        return msgs
+
+    def commit(self):
+        ''' Commit the positions of the batches received, call after matched messages
+            are stored
+        '''
+        for shard, commands in enumerate(self.commands):
+            if self.positions.get(shard):
+                commands.put(('commit', self.positions[shard]))
+
+    def set_topics(self, topics, offsets=None):
+        if not self.shards or set(topics) == set(self.topics):
+            return
+        self.topics = list(topics)
+        self._send(('topics', self.topics))
+
+    def set_active_topics(self, topics):
+        ''' Pause the topics not in topics in every shard, see KafkaConnector.set_active_topics '''
+        if not self.shards:
+            return
+        paused_topics = set(self.topics) - set(topics)
+        if paused_topics != self.paused_topics:
+            self.log.info('pause topics {}, resume topics {}'.format(
+                sorted(paused_topics), sorted(self.paused_topics - paused_topics)))
+            self.paused_topics = paused_topics
+            self._send(('active_topics', list(topics)))
+
+    def get_offsets(self):
+        ''' Positions of the batches received from shards, {(topic, partition): offset} '''
+        offsets = dict()
+        for positions in self.positions.values():
+            offsets.update(positions)
+        return offsets
+
+    def get_lag(self, timeout=1):
+        ''' Lag last reported by shards, {(topic, partition): lag} '''
+        lag = dict()
+        for shard_lag in self.lag.values():
+            lag.update(shard_lag)
+        return lag
+
+    def pop_counters(self):
+        ''' Messages consumed, skipped and matched by shards since last called '''
+        counters, self.counters = self.counters, dict()
+        return counters
+
+    def close(self):
+        ''' Stop shards, they apply the commands sent before (e.g. commit) and close their
+            consumers (leave the group)
+        '''
+        if not self.shards:
+            return
+        # commands of a shard are applied in order, so the commits are not lost
+        self._send(('stop', None))
+        deadline = time.time() + self.stop_timeout
+        for process in self.shards:
+            # results need to be read for shards to exit after putting them
+            while process.is_alive() and time.time() < deadline:
+                self._drain()
+                process.join(0.1)
+            if process.is_alive():
+                self.log.warning('terminate shard {} not stopped in {}s'.format(
+                    process.name, self.stop_timeout))
+                process.terminate()
+                process.join()
+        self._drain()
+        self.shards, self.commands, self.consumer = list(), list(), None
+
+    def _send(self, command):
+        for commands in self.commands:
+            commands.put(command)
+
+    def _receive(self, result, started, msgs, waiting):
+        shard, sent_at, shard_msgs, positions, counters, lag = result
+        msgs.extend(ShardMessage(*m) for m in shard_msgs)
+        self.positions[shard] = positions
+        for name, count in counters.iteritems():
+            self.counters[name] = self.counters.get(name, 0) + count
+        if lag is not None:
+            self.lag[shard] = lag
+        # caught up after get_messages is called
+        if counters['consumed'] == 0 and sent_at >= started:
+            waiting.discard(shard)
+
+    def _drain(self):
+        while True:
+            try:
+                self.results.get_nowait()
+            except Empty:
+                return
+
+    def _check_shards(self):
+        for process in self.shards:
+            if not process.is_alive():
+                raise AirflowException('shard {} exited with code {}'.format(
+                    process.name, process.exitcode))
+
+
+def consume_shard(shard, broker, group_id, client_id, topics, consumer_kwargs, wanted_msgs,
+                  commands, results, poll_timeout, lag_interval):
+    ''' Consume and match in a child process until the stop command, every consumed batch
+        is reported as (shard, time, matched messages, positions, counters, lag or None)
+    '''
+    handler = KafkaAllMessageHandler(wanted_msgs)
+    handler.set_batch_match(True)
+    connector = KafkaConnector(broker)
+    connector.set_consumer(group_id, client_id, topics, **consumer_kwargs)
+    lag_reported_at = 0
+    try:
+        while apply_commands(connector, handler, commands):
+            msgs = connector.consume(timeout=poll_timeout)
+            counters = {'consumed': len(msgs), 'skipped': 0, 'matched': 0}
+            decoded = list()
+            for msg in msgs:
+                try:
+                    decoded_msg = handler.decode(msg)
+                except Exception:
+                    decoded_msg = None
+                if decoded_msg is None:
+                    counters['skipped'] += 1
+                else:
+                    decoded.append((msg, decoded_msg))
+            matches, errors = handler.match_batch([d for _, d in decoded], TimeUtils().get_now())
+            counters['skipped'] += len(errors)
+            counters['matched'] = len(matches)
+            lag = None
+            if time.time() - lag_reported_at >= lag_interval:
+                lag, lag_reported_at = connector.get_lag(), time.time()
+            results.put((shard, time.time(),
+                         [ShardMessage.dump(decoded[i][0]) for i in sorted(matches)],
+                         connector.get_offsets(), counters, lag))
+    finally:
+        connector.close()
+
+
+def apply_commands(connector, handler, commands):
+    ''' Apply the commands queued by the parent in order
+        Returns:
+            False if the shard should stop
+    '''
+    while True:
+        try:
+            command, arg = commands.get_nowait()
+        except Empty:
+            return True
+        if command == 'stop':
+            return False
+        elif command == 'commit':
+            connector.commit_offsets(arg)
+        elif command == 'topics':
+            connector.set_topics(arg)
+        elif command == 'active_topics':
+            connector.set_active_topics(arg)
+            handler.set_active_topics(arg)
@@ -1,7 +1,10 @@
 # -*- coding: UTF-8 -*-
+import calendar
 import os
+import time
 import pytest
 
+from event_plugins.base.base_connector import prefetch
 from event_plugins.common.schedule.time_utils import TimeUtils, AIRFLOW_EVENT_PLUGINS_TIMEZONE
 from event_plugins.common.storage.db import STORAGE_CONF, get_session
 from event_plugins.common.storage.event_message import EventMessage
@@ -15,6 +18,7 @@ TEST_TABLE_NAME = STORAGE_CONF.get("Storage", "table_name")
 
 def patch_now(mocker, now):
     mocker.patch.object(TimeUtils, 'get_now', return_value=now)
+    mocker.patch.object(TimeUtils, 'get_now_ts', return_value=calendar.timegm(now.utctimetuple()))
 
 
 class TestBaseConsumerOperator:
@@ -200,3 +204,222 @@ class TestBaseConsumerOperator:
         is_criteria_met = operator.poke(context=None, consumer=consumer)
         assert is_criteria_met == False
         assert len(operator.db_handler.get_unreceived_msgs()) == 2
+
+    def test_execute_skip_connecting_if_all_received(self, mocker):
+        wanted_msgs = [
+            {'task_id': 'taskA', 'frequency': 'M'},
+            {'task_id': 'taskB', 'frequency': 'M'}
+        ]
+        operator = MockBaseConsumerOperator(
+            task_id='test',
+            sensor_name="test",
+            msgs=wanted_msgs,
+            poke_interval=2,
+            timeout=10,
+            mark_success=False,
+            debug_mode=True,
+        )
+        mocker.patch('event_plugins.factory.plugin_factory', return_value=MockBaseHandler('test'))
+        consumer = MockBaseConnector()
+        patch_now(mocker, TimeUtils().datetime(2019, 7, 7, 8, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE))
+
+        # monthly messages are received in previous run
+        mocker.patch.object(MockBaseConnector, 'get_messages', return_value=['taskA', 'taskB'])
+        assert operator.poke(context=None, consumer=consumer) == True
+
+        # next run in the same month does not connect to source
+        patch_now(mocker, TimeUtils().datetime(2019, 7, 8, 8, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE))
+        initialize_conn_handler = mocker.patch.object(MockBaseConsumerOperator, 'initialize_conn_handler')
+        operator.execute(context=None)
+        initialize_conn_handler.assert_not_called()
+
+    def test_execute_initialize_db_once(self, mocker):
+        operator = MockBaseConsumerOperator(
+            task_id='test',
+            sensor_name="test",
+            msgs=[{'task_id': 'taskA', 'frequency': 'D'}],
+            poke_interval=60,
+            timeout=120,
+        )
+        mocker.patch('event_plugins.factory.plugin_factory', return_value=MockBaseHandler('test'))
+        execution_date = TimeUtils().datetime(2019, 7, 7, 8, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        patch_now(mocker, execution_date)
+        initialize_db_handler = mocker.spy(operator, 'initialize_db_handler')
+        mocker.patch.object(MockBaseConnector, 'get_messages', side_effect=[['taskX'], ['taskA']])
+        mocker.patch.object(operator, 'next_poke_delay', return_value=1)
+        mocker.patch('time.sleep')
+        operator.execute(context={'execution_date': execution_date,
+                                  'next_execution_date': execution_date})
+        # once by execute before connecting, and once by the second poke
+        assert initialize_db_handler.call_count == 2
+        assert operator.db_handler.get_unreceived_msgs() == []
+
+    def test_last_poke_before_spread_delay(self, mocker):
+        operator = MockBaseConsumerOperator(
+            task_id='test',
+            sensor_name="test",
+            msgs=[{'task_id': 'taskA', 'frequency': 'D'}],
+            poke_interval=60,
+            timeout=120,
+        )
+        mocker.patch('event_plugins.factory.plugin_factory', return_value=MockBaseHandler('test'))
+        execution_date = TimeUtils().datetime(2019, 7, 7, 8, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        context = {'execution_date': execution_date, 'next_execution_date': execution_date}
+        # 30s after start: the next poke by poke_interval is before the timeout (08:02:00),
+        # but the spread delay is after it
+        patch_now(mocker, TimeUtils().add_seconds(execution_date, 30))
+        mocker.patch.object(operator, 'poke', return_value=False)
+        mocker.patch.object(operator, 'next_poke_delay', return_value=200)
+        schedule_next_time = mocker.patch.object(operator, 'schedule_next_time',
+                                                 side_effect=StopIteration)
+        with pytest.raises(StopIteration):
+            operator.execute(context=context)
+        # the last poke is 30s before timeout rather than after it
+        schedule_next_time.assert_called_once_with(60)
+
+    def test_poke_metrics(self, mocker):
+        wanted_msgs = [
+            {'task_id': 'taskA', 'frequency': 'D'},
+            {'task_id': 'taskB', 'frequency': 'D'}
+        ]
+        operator = MockBaseConsumerOperator(
+            task_id='test',
+            sensor_name="test",
+            msgs=wanted_msgs,
+            poke_interval=2,
+            timeout=10,
+            mark_success=False,
+            debug_mode=False,
+        )
+        mocker.patch('event_plugins.factory.plugin_factory', return_value=MockBaseHandler('test'))
+        stats = mocker.patch('event_plugins.common.metrics.Stats')
+        consumer = MockBaseConnector()
+        patch_now(mocker, TimeUtils().datetime(2019, 7, 7, 8, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE))
+
+        mocker.patch.object(MockBaseConnector, 'get_messages', return_value=['taskA', 'taskX'])
+        assert operator.poke(context=None, consumer=consumer) == False
+
+        counters = dict((c[0][0], c[0][1]) for c in stats.incr.call_args_list)
+        assert counters['event_plugins.test.consumed'] == 2
+        assert counters['event_plugins.test.matched'] == 1
+        assert counters['event_plugins.test.db_queries'] > 0
+        timings = set(c[0][0] for c in stats.timing.call_args_list)
+        assert set(['event_plugins.test.consume', 'event_plugins.test.match',
+                    'event_plugins.test.db_write']) <= timings
+        # metrics are reset after each poke
+        assert operator.metrics.counters == dict()
+
+    def test_poke_prefetch_batches(self, mocker):
+        wanted_msgs = [
+            {'task_id': 'taskA', 'frequency': 'D'},
+            {'task_id': 'taskB', 'frequency': 'D'},
+            {'task_id': 'taskC', 'frequency': 'D'}
+        ]
+        operator = MockBaseConsumerOperator(
+            task_id='test',
+            sensor_name="test",
+            msgs=wanted_msgs,
+            poke_interval=2,
+            timeout=10,
+            prefetch_batches=1,
+            write_behind=True,
+            mark_success=True,
+        )
+        mocker.patch('event_plugins.factory.plugin_factory', return_value=MockBaseHandler('test'))
+        mocker.patch.object(operator, 'emit_metrics')
+        consumer = MockBaseConnector()
+        patch_now(mocker, TimeUtils().datetime(2019, 7, 7, 8, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE))
+
+        consumed = list()
+
+        def iter_batches():
+            for batch in [['taskA', 'taskX'], ['taskB'], ['taskY']]:
+                consumed.append(batch)
+                yield batch
+
+        marked = list()
+
+        def mark_success(context, task_id):
+            unreceived = [m['task_id'] for m in operator.db_handler.get_unreceived_msgs()]
+            marked.append((task_id, task_id in unreceived))
+
+        get_messages = mocker.patch.object(MockBaseConnector, 'get_messages')
+        mocker.patch.object(MockBaseConnector, 'iter_batches', side_effect=iter_batches)
+        mocker.patch.object(operator, '_mark_success_task_by_id', side_effect=mark_success)
+        mocker.patch.object(operator, '_mark_skip_received_before')
+        assert operator.poke(context=None, consumer=consumer) == False
+        get_messages.assert_not_called()
+        assert len(consumed) == 3
+        assert operator.metrics.counters['consumed'] == 4
+        assert operator.metrics.counters['matched'] == 2
+        # updates of write-behind are drained by poke, before the tasks are marked
+        assert [m['task_id'] for m in operator.db_handler.get_unreceived_msgs()] == ['taskC']
+        assert marked == [('taskA', False), ('taskB', False)]
+        operator.close_connection()
+        assert operator.db_handler.writer is None
+        # success times queued after marking are written when closing
+        records = operator.db_handler.get_sensor_messages().all()
+        assert [r.last_success_time is not None for r in records] == [True, True, False]
+
+    def test_log_status_table(self, mocker):
+        operator = MockBaseConsumerOperator(
+            task_id='test',
+            sensor_name="test",
+            msgs=[{'task_id': 'taskA', 'frequency': 'D'}],
+            poke_interval=2,
+            timeout=10,
+            tabulate_interval=60,
+        )
+        tabulate_data = mocker.patch.object(operator.db_handler, 'tabulate_data', return_value='table')
+        mocker.patch('time.time', return_value=1000)
+        operator.log_status_table()
+        operator.log_status_table()
+        assert tabulate_data.call_count == 1
+        # rendered when criteria met or interval passed
+        operator.log_status_table(force=True)
+        assert tabulate_data.call_count == 2
+        mocker.patch('time.time', return_value=1060)
+        operator.log_status_table()
+        assert tabulate_data.call_count == 3
+
+        # not rendered if the table would not be logged
+        mocker.patch.object(operator.log, 'isEnabledFor', return_value=False)
+        operator.log_status_table(force=True)
+        assert tabulate_data.call_count == 3
+
+
+class TestPrefetch:
+
+    def test_prefetch_in_order(self):
+        assert list(prefetch(iter(range(10)), depth=3)) == range(10)
+        assert list(prefetch([])) == []
+
+    def test_prefetch_ahead(self):
+        fetched = list()
+
+        def batches():
+            for i in range(5):
+                fetched.append(i)
+                yield i
+
+        items = prefetch(batches(), depth=2)
+        assert next(items) == 0
+        # the next batches are fetched while the current one is handled
+        for _ in range(100):
+            if len(fetched) == 3:
+                break
+            time.sleep(0.01)
+        assert fetched == [0, 1, 2]
+        # closed early, no more batches are fetched
+        items.close()
+        assert fetched == [0, 1, 2]
+
+    def test_prefetch_error(self):
+        def batches():
+            yield 1
+            raise ValueError('broken source')
+
+        items = prefetch(batches())
+        assert next(items) == 1
+        with pytest.raises(ValueError):
+            next(items)
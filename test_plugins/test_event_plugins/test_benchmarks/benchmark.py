@@ -0,0 +1,241 @@
+# -*- coding: UTF-8 -*-
+''' Measure seconds per call of hot paths, compare them with tracked baselines and
+    write a json report. Configured by environment variables:
+
+    EVENT_PLUGINS_BENCHMARK: run benchmarks if set
+    EVENT_PLUGINS_BENCHMARK_BASELINE: baseline file, default baseline.json in this directory
+    EVENT_PLUGINS_BENCHMARK_REPORT: report file, default benchmark_report.json in current directory
+    EVENT_PLUGINS_BENCHMARK_THRESHOLD: fail if slower than baseline * (1 + threshold), default 0.25
+    EVENT_PLUGINS_BENCHMARK_MIN_TIME: seconds a round of calls should last, calls are
+        repeated until then, default 0.05
+    EVENT_PLUGINS_BENCHMARK_ROUNDS: rounds of calls of a compared benchmark, default 20
+    EVENT_PLUGINS_BENCHMARK_UPDATE: write the results to baseline file if set
+
+    To keep the comparison from failing on noise:
+    * a compared benchmark is timed in many short rounds and the best one is kept, so a
+      machine switching between faster and slower periods is measured in a faster one
+    * results are normalized by the lower quartile of a calibration loop timed after
+      each benchmark (stored in baseline file as CALIBRATION), so a baseline recorded on
+      a faster or slower machine still applies
+    * the threshold is widened by the noise of the run, i.e. how much the median of the
+      calibration is slower than its lower quartile
+    * results of calls that change data and run once are reported but not compared
+    * a result slower than the threshold is measured again up to 3 times after a pause,
+      and only fails if it's still slow
+'''
+from __future__ import print_function
+
+import gc
+import json
+import os
+import platform
+import sys
+import time
+from collections import OrderedDict
+
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+enabled = bool(os.environ.get('EVENT_PLUGINS_BENCHMARK'))
+baseline_path = os.environ.get('EVENT_PLUGINS_BENCHMARK_BASELINE',
+                               os.path.join(BENCHMARK_DIR, 'baseline.json'))
+report_path = os.environ.get('EVENT_PLUGINS_BENCHMARK_REPORT', 'benchmark_report.json')
+threshold = float(os.environ.get('EVENT_PLUGINS_BENCHMARK_THRESHOLD', 0.25))
+min_time = float(os.environ.get('EVENT_PLUGINS_BENCHMARK_MIN_TIME', 0.05))
+rounds = int(os.environ.get('EVENT_PLUGINS_BENCHMARK_ROUNDS', 20))
+update_baseline = bool(os.environ.get('EVENT_PLUGINS_BENCHMARK_UPDATE'))
+
+
+# key of the calibration seconds in baseline file
+CALIBRATION = '_calibration'
+
+
+def calibration_loop():
+    ''' Fixed pure python work to measure the speed of the machine with '''
+    total = 0
+    values = dict()
+    for i in range(10000):
+        values[i % 100] = str(i)
+        total += len(values[i % 100])
+    return total
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def env_ints(name, default):
+    ''' Comma separated integers, e.g. sizes of parametrized benchmarks '''
+    return [int(v) for v in os.environ.get(name, default).split(',') if v.strip()]
+
+
+class BenchmarkSuite(object):
+    ''' Results of benchmarks and the baseline they are compared with
+        Args:
+            baseline_path(str): json file of {name: seconds per call}, ignored if not exists
+            threshold(float): ratio of slowdown to baseline regarded as regression
+            min_time(float): seconds a round of calls should last to be compared
+            rounds(int): least rounds of calls of a compared benchmark
+    '''
+
+    def __init__(self, baseline_path, threshold, min_time=0.05, rounds=20):
+        self.baseline_path = baseline_path
+        self.threshold = threshold
+        self.min_time = min_time
+        self.rounds = rounds
+        self.baseline = dict()
+        if os.path.exists(baseline_path):
+            with open(baseline_path) as f:
+                self.baseline = json.load(f)
+        self.results = OrderedDict()
+        self.benchmarks = dict()    # {name: (func, number, repeat, items)} of compared results
+        self.calibrations = list()
+        for _ in range(20):
+            self.calibrate()
+
+    def calibrate(self):
+        ''' Time calibration_loop once more, between benchmarks so that the calibration
+            follows the speed of the machine over the whole run
+        '''
+        elapsed, _ = self.measure(calibration_loop, 1, 5)
+        self.calibrations.append(elapsed)
+
+    @property
+    def calibration(self):
+        ''' Lower quartile of seconds of calibration_loop in this run, i.e. its speed
+            in the faster periods of the machine
+        '''
+        calibrations = sorted(self.calibrations)
+        return calibrations[len(calibrations) // 4]
+
+    @property
+    def noise(self):
+        ''' Ratio of median to lower quartile of calibrations, 1 on a steady machine '''
+        calibrations = sorted(self.calibrations)
+        return calibrations[len(calibrations) // 2] / self.calibration
+
+    def measure(self, func, number, repeat):
+        ''' Best seconds of `repeat` rounds calling func `number` times, and number.
+            Like timeit, garbage collection is disabled while timing
+        '''
+        best = None
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for _ in range(repeat):
+                started = time.time()
+                for _ in range(number):
+                    func()
+                elapsed = time.time() - started
+                best = elapsed if best is None else min(best, elapsed)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return best, number
+
+    def run(self, name, func, number=1, repeat=3, items=1, autorange=True):
+        ''' Call func `number` times for `repeat` rounds, and record the best round
+            Args:
+                items(int): items processed by each call, e.g. messages of a batch
+                autorange(bool): call func more times in a round until it lasts min_time,
+                    for at least `rounds` rounds, and compare the result with baseline.
+                    Disable it for calls that change data, which are only reported
+            Returns:
+                seconds per call, or per item if items given
+        '''
+        if autorange:
+            # like timeit, grow the calls of a round before measuring
+            elapsed, _ = self.measure(func, number, 1)
+            while elapsed < self.min_time:
+                number *= 10 if elapsed < self.min_time / 10 else 2
+                elapsed, _ = self.measure(func, number, 1)
+            repeat = max(repeat, self.rounds)
+            self.benchmarks[name] = (func, number, repeat, items)
+        best, number = self.measure(func, number, repeat)
+        self.calibrate()
+        return self.record(name, best / number / items, number, items)
+
+    def record(self, name, seconds, number, items=1):
+        ''' Record seconds per call (or item) of name, compared with baseline if autoranged '''
+        baseline = self.baseline.get(name)
+        self.results[name] = OrderedDict([
+            ('seconds', seconds),
+            ('number', number),
+            ('baseline', baseline),
+            ('compared', bool(baseline) and name in self.benchmarks)
+        ])
+        print('{}: {:.3f}us per {}{}'.format(
+            name, seconds * 1e6, 'item' if items > 1 else 'call',
+            ', {:.2f}x of baseline{}'.format(
+                self.ratio(name), '' if self.results[name]['compared'] else ' (not compared)')
+            if baseline else ''))
+        return seconds
+
+    def ratio(self, name):
+        ''' Ratio of result of name to its baseline, normalized by the calibrations '''
+        result = self.results[name]
+        return (result['seconds'] / self.calibration) / (
+            result['baseline'] / self.baseline_calibration)
+
+    @property
+    def baseline_calibration(self):
+        ''' Calibration of the baseline, the results are compared as they are if not recorded '''
+        return self.baseline.get(CALIBRATION, self.calibration)
+
+    def regressions(self, names=None, recheck=0, pause=2):
+        ''' Names of compared results slower than baseline * (1 + threshold) * noise,
+            normalized by the calibrations
+            Args:
+                recheck(int): times to measure the slow results again before regarding
+                    them as regressions, keeping the best of them
+                pause(float): seconds to wait before measuring again, for a slower
+                    period of the machine to pass
+        '''
+        names = names if names is not None else self.results.keys()
+        slow = [n for n in names
+                if self.results[n]['compared'] and
+                self.ratio(n) > (1 + self.threshold) * self.noise]
+        if not recheck or not slow:
+            return slow
+        time.sleep(pause)
+        for name in slow:
+            func, number, repeat, items = self.benchmarks[name]
+            best, _ = self.measure(func, number, repeat)
+            self.calibrate()
+            self.record(name, min(best / number / items, self.results[name]['seconds']),
+                        number, items)
+        return self.regressions(slow, recheck - 1, pause)
+
+    def describe(self, names):
+        return ', '.join('{}: {:.3f}us (baseline {:.3f}us, {:.2f}x calibrated)'.format(
+            n, self.results[n]['seconds'] * 1e6, self.results[n]['baseline'] * 1e6,
+            self.ratio(n)) for n in names)
+
+    def report(self, config=None):
+        for name, result in self.results.iteritems():
+            result['ratio'] = self.ratio(name) if result['baseline'] else None
+        return OrderedDict([
+            ('python', sys.version.split()[0]),
+            ('platform', platform.platform()),
+            ('threshold', self.threshold),
+            ('min_time', self.min_time),
+            ('rounds', self.rounds),
+            ('calibration', self.calibration),
+            ('baseline_calibration', self.baseline_calibration),
+            ('noise', self.noise),
+            ('config', config or dict()),
+            ('results', self.results),
+            ('regressions', self.regressions())
+        ])
+
+    def write_report(self, path, config=None):
+        with open(path, 'w') as f:
+            json.dump(self.report(config), f, indent=2, separators=(',', ': '))
+
+    def write_baseline(self):
+        ''' Merge results into baseline file, keeping baselines of other sizes '''
+        self.baseline.update((n, r['seconds']) for n, r in self.results.iteritems())
+        self.baseline[CALIBRATION] = self.calibration
+        with open(self.baseline_path, 'w') as f:
+            json.dump(self.baseline, f, indent=2, sort_keys=True, separators=(',', ': '))
+            f.write('\n')
@@ -0,0 +1,194 @@
+# -*- coding: UTF-8 -*-
+'''
+    Benchmarks of matching and storage hot paths, compared with baseline.json
+    usage: EVENT_PLUGINS_BENCHMARK=1 ./run_test.sh -s -k hot_path
+    sizes (the defaults are small enough to run in minutes):
+        EVENT_PLUGINS_BENCHMARK_WANTED: wanted messages of sensor, default 10,100,1000
+        EVENT_PLUGINS_BENCHMARK_RECEIVED: received messages matched per size, default 1000
+        EVENT_PLUGINS_BENCHMARK_SENSORS: sensors in the table, default 100
+        EVENT_PLUGINS_BENCHMARK_ROWS: rows per sensor, default 1,100,1000
+'''
+from __future__ import print_function
+
+import datetime as dt
+import itertools
+import time
+import pytest
+
+from event_plugins.common.schedule.time_utils import TimeUtils
+from event_plugins.common.storage.db import get_session
+from event_plugins.common.storage.event_message import EventMessage, EventMessageCRUD, \
+    get_string_if_json
+from event_plugins.kafka.consume.topic import etl_finish
+from event_plugins.kafka.consume.utils import MsgRenderUtils
+from event_plugins.kafka.kafka_handler import KafkaAllMessageHandler
+
+from test_event_plugins.test_benchmarks import benchmark
+from test_event_plugins.test_kafka.mocks_kafka import FakeBroker, LoadGenerator
+
+
+pytestmark = pytest.mark.skipif(not benchmark.enabled, reason='EVENT_PLUGINS_BENCHMARK is not set')
+
+wanted_sizes = benchmark.env_ints('EVENT_PLUGINS_BENCHMARK_WANTED', '10,100,1000')
+num_received = benchmark.env_int('EVENT_PLUGINS_BENCHMARK_RECEIVED', 1000)
+num_sensors = benchmark.env_int('EVENT_PLUGINS_BENCHMARK_SENSORS', 100)
+row_sizes = benchmark.env_ints('EVENT_PLUGINS_BENCHMARK_ROWS', '1,100,1000')
+
+
+@pytest.fixture(scope='module')
+def suite():
+    suite = benchmark.BenchmarkSuite(benchmark.baseline_path, benchmark.threshold,
+                                     benchmark.min_time, benchmark.rounds)
+    yield suite
+    suite.write_report(benchmark.report_path, config={
+        'wanted': wanted_sizes,
+        'received': num_received,
+        'sensors': num_sensors,
+        'rows': row_sizes
+    })
+    if benchmark.update_baseline:
+        suite.write_baseline()
+
+
+def assert_no_regression(suite, names):
+    if benchmark.update_baseline:
+        # recording a baseline, keep the results as measured
+        return
+    regressions = suite.regressions(names, recheck=3)
+    assert not regressions, 'slower than baseline: ' + suite.describe(regressions)
+
+
+@pytest.mark.parametrize("num_wanted", wanted_sizes)
+def test_kafka_match_benchmark(suite, num_wanted):
+    generator = LoadGenerator(num_wanted=num_wanted, match_rate=0.01)
+    broker = FakeBroker()
+    generator.produce(broker, num_received)
+    msgs = [m for topic in broker.partitions for p in broker.partitions[topic] for m in p]
+    handler = KafkaAllMessageHandler(generator.wanted_msgs())
+    receive_dt = TimeUtils().get_now()
+    # render wanted messages before measuring
+    handler.match(msgs[0], receive_dt)
+
+    received = itertools.cycle(msgs)
+    name = 'kafka_match[wanted={}]'.format(num_wanted)
+    suite.run(name, lambda: handler.match(next(received), receive_dt), number=len(msgs))
+
+    # seconds per message of matching the decoded messages of a poke together
+    decoded = [handler.decode(m) for m in msgs]
+    handler.set_batch_match(True)
+    batch_name = 'kafka_match_batch[wanted={}]'.format(num_wanted)
+    suite.run(batch_name, lambda: handler.match_batch(decoded, receive_dt), items=len(decoded))
+    assert_no_regression(suite, [name, batch_name])
+
+
+def test_message_benchmark(suite):
+    now = TimeUtils().get_now()
+    wanted = {'frequency': 'D', 'topic': 'etl-finish', 'db': 'db0', 'table': 'table0',
+              'partition_values': '', 'task_id': 'tbl0'}
+    hit = {'db': 'db0', 'table': 'table0', 'partition_values': '', 'timestamp': int(time.time())}
+    miss = dict(hit, table='table1')
+    message = etl_finish.Message(wanted)
+    template = "{{yyyymm|dt.format(format='%Y%m')}}"
+    render_dict = {'yyyymm': now}
+
+    names = [
+        ('basic_message.match.hit', lambda: message.match(hit, now)),
+        ('basic_message.match.miss', lambda: message.match(miss, now)),
+        ('basic_message.timeout', message.timeout),
+        ('render', lambda: MsgRenderUtils.render(template, render_dict)),
+        ('get_string_if_json.dict', lambda: get_string_if_json(wanted)),
+        ('get_string_if_json.str', lambda: get_string_if_json('{"db": "db0"}'))
+    ]
+    for name, func in names:
+        suite.run(name, func, number=1000)
+    assert_no_regression(suite, [n for n, _ in names])
+
+
+def test_time_utils_benchmark(suite):
+    now = TimeUtils().get_now()
+    naive = dt.datetime(2019, 6, 15, 9, 0, 0)
+    timestamp = 1560589200
+    names = [
+        ('time_utils.get_now', TimeUtils().get_now),
+        ('time_utils.make_aware', lambda: TimeUtils().make_aware(naive)),
+        ('time_utils.make_naive', lambda: TimeUtils().make_naive(now)),
+        ('time_utils.add_seconds', lambda: TimeUtils().add_seconds(now, 7200)),
+        ('time_utils.add_days', lambda: TimeUtils().add_days(now, -2)),
+        ('time_utils.add_months', lambda: TimeUtils().add_months(now, 1)),
+        ('time_utils.cvt_datetime.str', lambda: TimeUtils().cvt_datetime('2019-06-15 09:00:00')),
+        ('time_utils.cvt_datetime.int', lambda: TimeUtils().cvt_datetime(timestamp)),
+        ('time_utils.cvt_datetime2str', lambda: TimeUtils().cvt_datetime2str(now, '%Y%m%d')),
+        ('time_utils.cvt_timestamp2datetime', lambda: TimeUtils().cvt_timestamp2datetime(timestamp))
+    ]
+    for name, func in names:
+        suite.run(name, func, number=1000)
+    assert_no_regression(suite, [n for n, _ in names])
+
+
+@pytest.fixture(scope='module', params=row_sizes)
+def crud_db(request, tmpdir_factory):
+    ''' SQLite file with num_sensors sensors of `rows` wanted messages,
+        half of them received
+    '''
+    rows = request.param
+    path = tmpdir_factory.mktemp('benchmark').join('event_plugins.db')
+    session = get_session('sqlite:///{}'.format(path))
+    msgs = LoadGenerator(num_wanted=rows).wanted_msgs()
+    now = TimeUtils().get_now()
+    timeout = now + dt.timedelta(days=1)
+    for sensor in range(num_sensors):
+        session.execute(EventMessage.__table__.insert(), [{
+            'name': 'sensor{}'.format(sensor),
+            'msg': get_string_if_json(msg),
+            'source_type': 'kafka',
+            'frequency': msg['frequency'],
+            'last_receive': '{}' if i % 2 == 0 else None,
+            'last_receive_time': now if i % 2 == 0 else None,
+            'timeout': timeout
+        } for i, msg in enumerate(msgs)])
+    session.commit()
+    yield rows, session, msgs
+    session.remove()
+
+
+def test_crud_benchmark(suite, crud_db):
+    rows, session, msgs = crud_db
+    db = EventMessageCRUD('kafka', 'sensor0', session=session)
+    received = msgs[::2]
+    offsets = dict((('etl-finish', p), 100) for p in range(10))
+    expired = TimeUtils().get_now() + dt.timedelta(days=400)
+
+    def update_offsets():
+        for tp in offsets:
+            offsets[tp] += 1
+        db.update_offsets(offsets)
+
+    tag = '[rows={},sensors={}]'.format(rows, num_sensors)
+    # (method, func, number, repeat), methods that change data run after the ones that read it
+    names = [
+        ('get_sensor_messages', lambda: db.get_sensor_messages().all(), 10, 3),
+        ('get_sensor_slot', lambda: db.get_sensor_slot(ttl=0), 10, 3),
+        ('status', db.status, 10, 3),
+        ('get_unreceived_msgs', db.get_unreceived_msgs, 10, 3),
+        ('have_successed_msgs', lambda: db.have_successed_msgs(received), 10, 3),
+        ('get_timeout', lambda: db.get_timeout(msgs[0]), 100, 3),
+        ('tabulate_data', lambda: db.tabulate_data(threshold=30), 1, 3),
+        ('tabulate_data.changed_only', lambda: db.tabulate_data(threshold=30, changed_only=True), 10, 3),
+        ('update_on_receive', lambda: db.update_on_receive(msgs[0], {'db': 'db0'}), 10, 3),
+        ('update_on_success', lambda: db.update_on_success(msgs[0]), 10, 3),
+        ('update_offsets', update_offsets, 10, 3),
+        ('get_offsets', db.get_offsets, 10, 3),
+        ('update_msgs', lambda: db.update_msgs(msgs), 1, 1),
+        ('initialize', lambda: db.initialize(msgs), 1, 1),
+        ('reset_timeout', db.reset_timeout, 10, 3),
+        ('reset_timeout.expired', lambda: db.reset_timeout(base_time=expired), 1, 3)
+    ]
+    for method, func, number, repeat in names:
+        # methods run once change data on the first call, not repeated
+        suite.run('crud.' + method + tag, func, number=number, repeat=repeat,
+                  autorange=repeat > 1)
+
+    delete_db = EventMessageCRUD('kafka', 'sensor{}'.format(num_sensors - 1), session=session)
+    suite.run('crud.delete' + tag, delete_db.delete, repeat=1, autorange=False)
+    assert delete_db.get_sensor_messages().count() == 0
+    assert_no_regression(suite, ['crud.' + m + tag for m, _, _, _ in names] + ['crud.delete' + tag])
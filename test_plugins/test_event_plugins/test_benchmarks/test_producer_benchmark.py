@@ -0,0 +1,68 @@
+# -*- coding: UTF-8 -*-
+'''
+    Benchmark of producer profiles against a local kafka, skipped if no broker given
+    usage: KAFKA_BENCHMARK_BROKER=localhost:9092 ./run_test.sh -s -k benchmark
+    Without a broker, the benchmark only runs a few messages against the in-memory
+    broker to check that it works, msgs/s and bytes sent of it are not meaningful
+'''
+from __future__ import print_function
+
+import json
+import os
+import time
+import pytest
+
+from event_plugins.kafka.kafka_connector import KafkaConnector
+
+from test_event_plugins.test_kafka.mocks_kafka import FakeBroker, patch_kafka
+
+
+broker = os.environ.get('KAFKA_BENCHMARK_BROKER')
+topic = os.environ.get('KAFKA_BENCHMARK_TOPIC', 'event-plugins-benchmark')
+num_messages = int(os.environ.get('KAFKA_BENCHMARK_MESSAGES', 100000))
+
+
+def get_messages(num_messages):
+    for i in range(num_messages):
+        yield topic, json.dumps({
+            'db': 'db0',
+            'table': 'table{}'.format(i % 100),
+            'partition_values': 'group_{}'.format(i),
+            'count': i,
+            'system_datetime': '2019-07-29 14:29:26'})
+
+
+def run_profile(broker, profile, num_messages):
+    stats = dict()
+
+    def on_stats(stats_json):
+        # txbytes: total bytes sent to brokers, including protocol overhead
+        stats['txbytes'] = json.loads(stats_json)['txbytes']
+
+    connector = KafkaConnector(broker)
+    connector.set_producer(profile, {'statistics.interval.ms': 100, 'stats_cb': on_stats})
+    started = time.time()
+    summary = connector.produce_batch(get_messages(num_messages), flush_timeout=120)
+    elapsed = time.time() - started
+    # wait for the stats after flushing
+    time.sleep(0.5)
+    connector.producer.poll(0)
+
+    print('\nprofile: {}, {:.0f} msgs/s, {} bytes sent, {}'.format(
+        profile or 'default', summary.delivered / elapsed, stats.get('txbytes'), summary))
+    return summary
+
+
+@pytest.mark.skipif(not broker, reason='KAFKA_BENCHMARK_BROKER is not set')
+@pytest.mark.parametrize("profile", [None, 'latency', 'throughput'])
+def test_producer_profile_benchmark(profile):
+    assert run_profile(broker, profile, num_messages).ok
+
+
+@pytest.mark.parametrize("profile", [None, 'latency', 'throughput'])
+def test_producer_profile_fake_broker(mocker, profile):
+    fake_broker = FakeBroker()
+    patch_kafka(mocker, fake_broker)
+    summary = run_profile('localhost:9092', profile, 1000)
+    assert summary.ok and summary.delivered == 1000
+    assert fake_broker.watermarks(topic, 0) == (0, 1000)
@@ -1,14 +1,19 @@
 # coding=utf-8
 from __future__ import print_function
 
+import calendar
 import json
 import mock
 import os
 import pytest
+import threading
+from sqlalchemy import create_engine, inspect
 
 from event_plugins.common.schedule.time_utils import TimeUtils, AIRFLOW_EVENT_PLUGINS_TIMEZONE
 from event_plugins.common.storage.db import get_session, STORAGE_CONF
-from event_plugins.common.storage.event_message import EventMessage, EventMessageCRUD
+from event_plugins.common.storage import event_message
+from event_plugins.common.storage.event_message import EventMessage, EventMessageCRUD, \
+    StatusWriter, update_records as update_records_orig
 from event_plugins.common.status import DBStatus
 
 
@@ -19,6 +24,7 @@ TEST_TABLE_NAME = STORAGE_CONF.get("Storage", "table_name")
 
 def patch_now(mocker, now):
     mocker.patch.object(TimeUtils, 'get_now', return_value=now)
+    mocker.patch.object(TimeUtils, 'get_now_ts', return_value=calendar.timegm(now.utctimetuple()))
 
 def db_commit_without_close(session):
     ''' not closing connection here (close in fixture) '''
@@ -195,6 +201,34 @@ class TestEventMessageCRUD:
             untimeout_record.last_receive_time == TimeUtils().datetime(2019, 6, 13, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
         )
 
+    @pytest.mark.usefixtures("db")
+    def test_reset_timeout_grouped(self, db, mocker):
+        '''
+            Timeout is computed once for each topic and frequency, both in
+            initialize and reset_timeout
+        '''
+        patch_now(mocker, TimeUtils().datetime(2019, 6, 15, 8, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE))
+        msgs = [{'frequency': freq, 'topic': topic, 'task_id': 't{}'.format(i)}
+                for i in range(600) for topic, freq in [('etl-finish', 'D'), ('job-finish', 'M')]]
+        get_timeout = mocker.spy(db, 'get_timeout')
+        db.initialize(msgs)
+        assert get_timeout.call_count == 2
+
+        now = TimeUtils().datetime(2019, 7, 1, 0, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        patch_now(mocker, now)
+        db.session.query(EventMessage).update({'last_receive': '{}', 'last_receive_time': now})
+        db.session.commit()
+        get_timeout.reset_mock()
+        db.reset_timeout()
+        assert get_timeout.call_count == 2
+        records = db.get_sensor_messages().all()
+        assert len(records) == 1200
+        assert all(r.last_receive is None and r.last_receive_time is None for r in records)
+        assert set((r.frequency, r.timeout) for r in records) == set([
+            ('D', TimeUtils().datetime(2019, 7, 1, 23, 59, 59, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)),
+            ('M', TimeUtils().datetime(2019, 7, 31, 23, 59, 59, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE))
+        ])
+
     @pytest.mark.usefixtures("db")
     def test_get_sensor_messages(self, db):
         assert db.get_sensor_messages().count() == 0
@@ -349,6 +383,214 @@ class TestEventMessageCRUD:
         assert record.last_receive_time == fake_now
         assert record.timeout == TimeUtils().datetime(2019, 6, 15, 23, 59, 59, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
 
+    @pytest.mark.usefixtures("db")
+    def test_update_on_success(self, db, mocker):
+        msg1 = {"test": "received"}
+        db.session.add(EventMessage(
+            name=TEST_SENSOR_NAME,
+            msg=msg1,
+            source_type=TEST_SOURCE_TYPE,
+            frequency='D',
+            last_receive=None,
+            last_receive_time=None,
+            timeout=TimeUtils().datetime(2019, 6, 15, 23, 59, 59, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        ))
+        db_commit_without_close(db.session)
+
+        event_time = TimeUtils().datetime(2019, 6, 15, 13, 59, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        receive_time = TimeUtils().datetime(2019, 6, 15, 14, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        success_time = TimeUtils().datetime(2019, 6, 15, 14, 0, 1, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        db.update_on_receive(msg1, msg1, event_time, receive_time)
+        db.update_on_success(msg1, success_time)
+        record = db.get_sensor_messages().first()
+        assert (record.last_event_time, record.last_receive_time, record.last_success_time) == \
+            (event_time, receive_time, success_time)
+
+        # success time is cleared when receiving the message again
+        db.update_on_receive(msg1, msg1)
+        assert db.get_sensor_messages().first().last_success_time is None
+        # or written with the receive update
+        db.update_on_receive(msg1, msg1, event_time, receive_time, success_time)
+        assert db.get_sensor_messages().first().last_success_time == success_time
+
+    def create_old_table(self, tmpdir):
+        ''' Table created before last_event_time and last_success_time were added '''
+        db_path = str(tmpdir.join('status.db'))
+        engine = create_engine('sqlite:///{}'.format(db_path))
+        engine.execute('CREATE TABLE {} (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL,'
+                       ' msg VARCHAR NOT NULL, source_type VARCHAR(32) NOT NULL,'
+                       ' frequency VARCHAR(4) NOT NULL, last_receive VARCHAR,'
+                       ' last_receive_time DATETIME, timeout DATETIME)'.format(TEST_TABLE_NAME))
+        session = get_session('sqlite:///{}'.format(db_path))
+        db = EventMessageCRUD(source_type=TEST_SOURCE_TYPE, sensor_name=TEST_SENSOR_NAME,
+                              session=session)
+        return engine, session, db
+
+    def test_add_missing_columns(self, tmpdir, mocker):
+        mocker.patch.dict(event_message.missing_columns, clear=True)
+        mocker.patch.object(STORAGE_CONF, 'getboolean', return_value=True)
+        engine, session, db = self.create_old_table(tmpdir)
+        msgs = [{'frequency': 'D', 'topic': 'job-finish', 'job_name': 'joba', 'task_id': 'joba'}]
+        db.initialize(msgs)
+        assert db.missing_columns == set()
+        columns = [c['name'] for c in inspect(engine).get_columns(TEST_TABLE_NAME)]
+        assert columns[-2:] == ['last_event_time', 'last_success_time']
+
+        success_time = TimeUtils().datetime(2019, 6, 15, 14, 0, 1, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        db.update_on_receive(msgs[0], msgs[0], success_time=success_time)
+        assert db.get_sensor_messages().first().last_success_time == success_time
+        # checked once per database
+        get_columns = mocker.patch('sqlalchemy.engine.reflection.Inspector.get_columns')
+        db.initialize(msgs)
+        assert not get_columns.called
+        session.remove()
+
+    def test_skip_missing_columns(self, tmpdir, mocker):
+        # table not managed by the plugin is not altered
+        mocker.patch.dict(event_message.missing_columns, clear=True)
+        mocker.patch.object(STORAGE_CONF, 'getboolean', return_value=False)
+        engine, session, db = self.create_old_table(tmpdir)
+        msgs = [{'frequency': 'D', 'topic': 'job-finish', 'job_name': 'joba', 'task_id': 'joba'}]
+        db.initialize(msgs)
+        columns = [c['name'] for c in inspect(engine).get_columns(TEST_TABLE_NAME)]
+        assert 'last_event_time' not in columns and 'last_success_time' not in columns
+        assert db.missing_columns == {'last_event_time', 'last_success_time'}
+
+        # the other columns are still written and read
+        receive_time = TimeUtils().datetime(2019, 6, 15, 14, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        success_time = TimeUtils().datetime(2019, 6, 15, 14, 0, 1, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        db.update_on_receive(msgs[0], msgs[0], receive_time, receive_time, success_time)
+        record = db.get_sensor_messages().first()
+        assert (record.last_receive_time, json.loads(record.last_receive)) == (receive_time, msgs[0])
+        # nothing to write
+        update_records = mocker.patch.object(event_message, 'update_records')
+        db.update_on_success(msgs[0], success_time)
+        assert not update_records.called
+        session.remove()
+
+    @pytest.mark.usefixtures("db")
+    def test_get_sensor_slot(self, db, mocker):
+        mocker.patch.dict(event_message.sensor_names_cache, clear=True)
+        assert db.get_sensor_slot() == (0, None)
+        db.session.add_all([EventMessage(
+            name=name,
+            msg={"test": i},
+            source_type=TEST_SOURCE_TYPE,
+            frequency='D',
+            last_receive=None,
+            last_receive_time=None,
+            timeout=None
+        ) for i, name in enumerate(['sensor_b', TEST_SENSOR_NAME, 'sensor_a', TEST_SENSOR_NAME])])
+        db_commit_without_close(db.session)
+        # looked up again since the sensor is not in the cached names
+        assert db.get_sensor_slot() == (3, 2)
+        # cached until ttl
+        query = mocker.spy(db.session, 'query')
+        assert db.get_sensor_slot() == (3, 2)
+        assert not query.called
+        assert db.get_sensor_slot(ttl=0) == (3, 2)
+        assert query.called
+
+    @pytest.mark.usefixtures("db")
+    def test_write_behind_in_memory(self, db):
+        msgs = [{"test": "a"}, {"test": "b"}, {"test": "c"}]
+        db.session.add_all([EventMessage(
+            name=TEST_SENSOR_NAME,
+            msg=msg,
+            source_type=TEST_SOURCE_TYPE,
+            frequency='D',
+            last_receive=None,
+            last_receive_time=None,
+            timeout=TimeUtils().datetime(2019, 6, 15, 23, 59, 59, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        ) for msg in msgs])
+        db_commit_without_close(db.session)
+        receive_time = TimeUtils().datetime(2019, 6, 15, 14, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        success_time = TimeUtils().datetime(2019, 6, 15, 14, 0, 1, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+
+        # in-memory sqlite is written by the caller, no thread
+        db.set_write_behind(flush_size=2, flush_interval=60)
+        db.update_on_receive(msgs[0], msgs[0], receive_time=receive_time)
+        db.update_on_success(msgs[0], success_time)
+        assert db.writer.thread is None
+        assert len(db.get_unreceived_msgs()) == 3
+        # updates of a message are coalesced, written when 2 messages are pending
+        db.update_on_receive(msgs[1], msgs[1], receive_time=receive_time)
+        assert db.get_unreceived_msgs() == [msgs[2]]
+        record = db.get_sensor_messages().first()
+        assert (record.last_receive_time, record.last_success_time) == (receive_time, success_time)
+
+        db.update_on_receive(msgs[2], msgs[2])
+        assert len(db.get_unreceived_msgs()) == 1
+        # the session shared with the caller is not closed by writing
+        assert record in db.session
+        db.drain()
+        assert record in db.session
+        assert db.get_unreceived_msgs() == []
+        db.close_writer()
+        assert db.writer is None
+
+    def test_write_behind_thread(self, tmpdir, mocker):
+        session = get_session('sqlite:///{}'.format(tmpdir.join('status.db')))
+        db = EventMessageCRUD(source_type=TEST_SOURCE_TYPE, sensor_name=TEST_SENSOR_NAME,
+                              session=session)
+        msgs = [{'frequency': 'D', 'topic': 'job-finish', 'job_name': name, 'task_id': name}
+                for name in ['joba', 'jobb']]
+        patch_now(mocker, TimeUtils().datetime(2019, 6, 15, 14, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE))
+        db.initialize(msgs)
+
+        db.set_write_behind(flush_size=10, flush_interval=60)
+        db.update_on_receive(msgs[0], msgs[0])
+        thread = db.writer.thread
+        assert thread.is_alive()
+        db.drain()
+        assert db.get_unreceived_msgs() == [msgs[1]]
+
+        # errors of writing are raised by drain, and the updates are kept to retry
+        update_records = mocker.patch('event_plugins.common.storage.event_message.update_records',
+                                      side_effect=ValueError('db is gone'))
+        db.update_on_receive(msgs[1], msgs[1])
+        with pytest.raises(ValueError):
+            db.drain()
+        assert db.get_unreceived_msgs() == [msgs[1]]
+        update_records.side_effect = update_records_orig
+        db.drain()
+        assert db.get_unreceived_msgs() == []
+        db.close_writer()
+        assert not thread.is_alive()
+
+        # drain raises if the thread exited with pending updates
+        db.set_write_behind(flush_size=10, flush_interval=60)
+        mocker.patch.object(StatusWriter, 'coalesce', side_effect=KeyError('broken'))
+        db.update_on_receive(msgs[0], msgs[0])
+        db.writer.thread.join()
+        with pytest.raises(KeyError):
+            db.drain()
+        with pytest.raises(RuntimeError):
+            db.drain()
+        with pytest.raises(RuntimeError):
+            db.update_on_receive(msgs[0], msgs[0])
+        with pytest.raises(RuntimeError):
+            db.close_writer()
+        assert db.writer is None
+        session.remove()
+
+    def test_write_behind_thread_exit_while_full(self, tmpdir, mocker):
+        session = get_session('sqlite:///{}'.format(tmpdir.join('status.db')))
+        db = EventMessageCRUD(source_type=TEST_SOURCE_TYPE, sensor_name=TEST_SENSOR_NAME,
+                              session=session)
+        # the thread exits without taking any update from the queue
+        exit_thread = threading.Event()
+        mocker.patch.object(StatusWriter, 'run', side_effect=lambda: exit_thread.wait())
+        db.set_write_behind(max_pending=1)
+        msg = {'frequency': 'D', 'topic': 'job-finish', 'job_name': 'joba', 'task_id': 'joba'}
+        db.update_on_receive(msg, msg)
+        assert db.writer.queue.full()
+        # put blocked by the full queue raises once the thread has exited
+        threading.Timer(0.5, exit_thread.set).start()
+        with pytest.raises(RuntimeError):
+            db.update_on_receive(msg, msg)
+        session.remove()
+
     @pytest.mark.usefixtures("db")
     def test_delete(self, db):
         msg1 = {"test": "received"}
@@ -367,6 +609,23 @@ class TestEventMessageCRUD:
         db.delete()
         assert db.get_sensor_messages().count() == 0
 
+    @pytest.mark.usefixtures("db")
+    def test_offsets(self, db):
+        assert db.get_offsets() == {}
+        db.update_offsets({('etl-finish', 0): 10, ('etl-finish', 1): 20})
+        assert db.get_offsets() == {('etl-finish', 0): 10, ('etl-finish', 1): 20}
+
+        # update existing partition and add new one
+        db.update_offsets({('etl-finish', 1): 25, ('job-finish', 0): 3})
+        assert db.get_offsets() == {('etl-finish', 0): 10, ('etl-finish', 1): 25, ('job-finish', 0): 3}
+
+        # offsets of other sensors are not affected
+        other = EventMessageCRUD(source_type=TEST_SOURCE_TYPE, sensor_name='other', session=db.session)
+        assert other.get_offsets() == {}
+
+        db.delete()
+        assert db.get_offsets() == {}
+
     @pytest.mark.usefixtures("db")
     def test_tabluate_data(self, db, capsys):
         #drop_test_table(db.session)
@@ -420,3 +679,29 @@ class TestEventMessageCRUD:
     str_timeout2
 )).decode("utf8")
         assert captured.out == expected_result
+
+    @pytest.mark.usefixtures("db")
+    def test_tabluate_data_changed_only(self, db, mocker):
+        patch_now(mocker, TimeUtils().datetime(2019, 6, 15, 14, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE))
+        msgs = [{"test": "received"}, {"test": "not_received"}]
+        db.session.add_all([EventMessage(
+            name=TEST_SENSOR_NAME,
+            msg=msg,
+            source_type=TEST_SOURCE_TYPE,
+            frequency='D',
+            last_receive=None,
+            last_receive_time=None,
+            timeout=TimeUtils().datetime(2019, 6, 15, 23, 59, 59, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        ) for msg in msgs])
+        db_commit_without_close(db.session)
+
+        # all rows are rendered at the first time
+        result = db.tabulate_data(changed_only=True)
+        assert "received" in result and "not_received" in result
+        assert db.tabulate_data(changed_only=True) is None
+
+        db.update_on_receive(msgs[0], msgs[0])
+        result = db.tabulate_data(changed_only=True)
+        assert '"received"' in result and "not_received" not in result
+        # full table is still rendered without changed_only
+        assert "not_received" in db.tabulate_data()
@@ -0,0 +1,64 @@
+import pytest
+
+from event_plugins.common.schedule.spread import WakeUpSpreader
+
+
+class TestWakeUpSpreader:
+
+    def test_phase_is_deterministic(self):
+        assert WakeUpSpreader('dag.sensor_a').phase == WakeUpSpreader('dag.sensor_a').phase
+        assert WakeUpSpreader('dag.sensor_a').phase != WakeUpSpreader('dag.sensor_b').phase
+        assert 0 <= WakeUpSpreader('dag.sensor_a').phase < 1
+
+    def test_delay_without_spreading(self):
+        spreader = WakeUpSpreader('dag.sensor_a')
+        assert spreader.delay(60, now_ts=1000) == 60
+
+    def test_delay_with_jitter(self):
+        phases = set()
+        for i in range(100):
+            spreader = WakeUpSpreader('dag.sensor_{}'.format(i), jitter=30)
+            delay = spreader.delay(60, now_ts=1000)
+            assert 60 <= delay < 90
+            assert delay <= spreader.max_delay(60) == 90
+            # same sensor always get the same delay
+            assert delay == spreader.delay(60, now_ts=2000)
+            phases.add(int(delay))
+        # sensors are spread instead of waking up at the same second
+        assert len(phases) > 20
+
+    @pytest.mark.parametrize("fleet_size", [10, 1000])
+    def test_delay_with_rate_limit(self, fleet_size):
+        max_wakeups_per_sec = 5
+        period = fleet_size / float(max_wakeups_per_sec)
+        wakeups = dict()
+        for slot in range(fleet_size):
+            spreader = WakeUpSpreader('dag.sensor_{}'.format(slot), jitter=30,
+                                      max_wakeups_per_sec=max_wakeups_per_sec)
+            delay = spreader.delay(60, now_ts=1000, fleet_size=fleet_size, slot=slot)
+            assert 60 <= delay < 90 + period
+            assert delay < spreader.max_delay(60, fleet_size) == 90 + period
+            # wake up on the own slot of sensor, no matter when it's rescheduled
+            wakeup_ts = 1000 + delay
+            next_wakeup_ts = wakeup_ts + spreader.delay(60, now_ts=wakeup_ts, fleet_size=fleet_size,
+                                                        slot=slot)
+            assert round((next_wakeup_ts - wakeup_ts) / period, 6) % 1 == 0
+            # slots are 1 / limit seconds apart
+            second = int(round(wakeup_ts * max_wakeups_per_sec)) // max_wakeups_per_sec
+            wakeups[second] = wakeups.get(second, 0) + 1
+        assert max(wakeups.values()) <= max_wakeups_per_sec
+
+    def test_delay_with_rate_limit_by_phase(self):
+        # without distinct slots, sensors may share a slot and the limit is kept on average
+        fleet_size, max_wakeups_per_sec = 1000, 5
+        period = fleet_size / float(max_wakeups_per_sec)
+        wakeups = dict()
+        for i in range(fleet_size):
+            spreader = WakeUpSpreader('dag.sensor_{}'.format(i), max_wakeups_per_sec=max_wakeups_per_sec)
+            delay = spreader.delay(60, now_ts=1000, fleet_size=fleet_size)
+            assert 60 <= delay < 60 + period
+            assert delay < spreader.max_delay(60, fleet_size)
+            wakeups[int(1000 + delay)] = wakeups.get(int(1000 + delay), 0) + 1
+        # one wake-up of every sensor in a period, but a second may get more than the limit
+        assert sum(wakeups.values()) / period == max_wakeups_per_sec
+        assert max(wakeups.values()) > max_wakeups_per_sec
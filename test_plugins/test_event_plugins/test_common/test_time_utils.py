@@ -0,0 +1,135 @@
+import calendar
+import pendulum
+import pytest
+
+from event_plugins.common.schedule.time_utils import TimeUtils, PeriodCache, DayBucketer, \
+    AIRFLOW_EVENT_PLUGINS_TIMEZONE
+from event_plugins.kafka.consume.topic import basic, etl_finish, job_finish
+
+
+def patch_now(mocker, now):
+    mocker.patch.object(TimeUtils, 'get_now', return_value=now)
+    mocker.patch.object(TimeUtils, 'get_now_ts', return_value=calendar.timegm(now.utctimetuple()))
+
+
+def utc(*args):
+    return TimeUtils().datetime(*args, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+
+
+def timestamp(*args):
+    return calendar.timegm(TimeUtils().datetime(*args).utctimetuple())
+
+
+class TestPeriodCache:
+
+    def test_compute_once_per_period(self, mocker):
+        cache = PeriodCache()
+        computed = list()
+
+        def get(now, frequency='D', offset_sec=0):
+            patch_now(mocker, now)
+            return cache.get(('key', frequency), frequency,
+                             lambda base: computed.append(base) or base.day, offset_sec)
+
+        assert get(utc(2019, 6, 15, 8)) == 15
+        assert get(utc(2019, 6, 15, 23, 59, 59)) == 15
+        assert len(computed) == 1
+        # day rolls over
+        assert get(utc(2019, 6, 16, 0, 0, 0)) == 16
+        assert len(computed) == 2
+        # or goes back
+        assert get(utc(2019, 6, 15, 8)) == 15
+        assert len(computed) == 3
+        # monthly values are kept in the month, also across years
+        assert get(utc(2019, 6, 1), 'M') == 1
+        assert get(utc(2019, 6, 30, 23, 59, 59), 'M') == 1
+        assert len(computed) == 4
+        assert get(utc(2019, 12, 31), 'M') == 31
+        assert get(utc(2020, 1, 1), 'M') == 1
+        assert len(computed) == 6
+        # the period is of now with offset
+        cache.clear()
+        assert get(utc(2019, 6, 15, 20), offset_sec=3600 * 6) == 16
+        assert get(utc(2019, 6, 16, 17, 59, 59), offset_sec=3600 * 6) == 16
+        assert len(computed) == 7
+        assert get(utc(2019, 6, 16, 18), offset_sec=3600 * 6) == 17
+        assert len(computed) == 8
+
+    def test_message_timeout_cached(self, mocker):
+        wanted = {'frequency': 'D', 'topic': 'etl-finish', 'db': 'db0', 'table': 'table0',
+                  'partition_values': '', 'task_id': 'tbl0'}
+        basic.BasicMessage.timeout_cache.clear()
+        compute = mocker.spy(basic.BasicMessage, 'compute_timeout')
+
+        patch_now(mocker, utc(2019, 6, 15, 8, 0, 0))
+        for table in range(10):
+            timeout = etl_finish.Message(dict(wanted, table='table{}'.format(table))).timeout()
+            assert timeout == utc(2019, 6, 15, 23, 59, 59)
+        assert compute.call_count == 1
+        # now is only built as a datetime when the timeout is computed
+        assert TimeUtils.get_now.call_count == 1
+
+        patch_now(mocker, utc(2019, 6, 16, 0, 0, 1))
+        assert etl_finish.Message(wanted).timeout() == utc(2019, 6, 16, 23, 59, 59)
+        assert etl_finish.Message(dict(wanted, frequency='M')).timeout() == utc(2019, 6, 30, 23, 59, 59)
+        assert compute.call_count == 3
+        # not shared by messages of other topics
+        job = {'frequency': 'D', 'topic': 'job-finish', 'job_name': 'jn0', 'task_id': 'job0'}
+        assert job_finish.Message(job).timeout() == utc(2019, 6, 16, 23, 59, 59)
+        assert compute.call_count == 4
+
+        with pytest.raises(ValueError):
+            etl_finish.Message(dict(wanted, frequency='Y')).timeout()
+
+
+class TestDayBucketer:
+
+    def test_timestamp_buckets(self):
+        bucketer = DayBucketer()
+        assert bucketer.day(timestamp(2019, 7, 7, 23, 59, 59)) == 20190707
+        assert bucketer.day(timestamp(2019, 7, 8, 0, 0, 0)) == 20190708
+        assert bucketer.day(timestamp(2019, 7, 7, 0, 0, 0)) == 20190707
+        # boundaries are kept sorted, looked up in any order
+        assert bucketer.bounds[0] == [timestamp(2019, 7, 7), timestamp(2019, 7, 8)]
+        assert bucketer.day(timestamp(2019, 7, 7, 22, 0, 0), offset_sec=7200) == 20190708
+        assert bucketer.month(timestamp(2019, 7, 31, 23, 0, 0), offset_sec=3600) == 201908
+
+    def test_datetime_buckets(self):
+        bucketer = DayBucketer()
+        now = utc(2019, 7, 7, 22, 0, 0)
+        assert bucketer.day(now) == 20190707
+        assert bucketer.day(now, offset_sec=7200) == 20190708
+        assert bucketer.day(TimeUtils().datetime(2019, 7, 7, 22, 0, 0)) == 20190707
+        # aware datetime is converted to the timezone of buckets
+        taipei = pendulum.timezone('Asia/Taipei')
+        assert DayBucketer(tz=taipei).day(now) == 20190708
+
+    def test_dst(self):
+        berlin = pendulum.timezone('Europe/Berlin')
+        bucketer = DayBucketer(tz=berlin)
+        # 2019/03/31 is 23 hours in Berlin, starts at 23:00 UTC of the day before
+        assert bucketer.day(timestamp(2019, 3, 30, 22, 59, 59)) == 20190330
+        assert bucketer.day(timestamp(2019, 3, 30, 23, 0, 0)) == 20190331
+        assert bucketer.day(timestamp(2019, 3, 31, 21, 59, 59)) == 20190331
+        assert bucketer.day(timestamp(2019, 3, 31, 22, 0, 0)) == 20190401
+        start, end = bucketer.bounds[0][1], bucketer.bounds[1][1]
+        assert end - start == 23 * 3600
+        for ts in range(timestamp(2019, 3, 29), timestamp(2019, 4, 2), 600):
+            local = TimeUtils().cvt_timestamp2datetime(ts, tz=berlin)
+            assert bucketer.day(ts) == int(local.strftime('%Y%m%d'))
+
+    def test_message_match_by_day(self, mocker):
+        wanted = {'frequency': 'D', 'topic': 'job-finish', 'job_name': 'jn0', 'is_success': True,
+                  'task_id': 'job0'}
+        message = job_finish.Message(wanted)
+        receive_dt = utc(2019, 7, 7, 8, 0, 0)
+        msg = {'job_name': 'jn0', 'is_success': True, 'timestamp': timestamp(2019, 7, 7, 0, 0, 0)}
+        bucketer = DayBucketer()
+        mocker.patch.object(basic.BasicMessage, 'day_bucketer', bucketer)
+        assert message.match(msg, receive_dt)
+        assert not message.match(dict(msg, timestamp=timestamp(2019, 7, 6, 23, 59, 59)), receive_dt)
+        # receive time is bucketed once, known days are looked up by the boundaries
+        day = mocker.spy(bucketer, '_day_of_datetime')
+        assert message.match(dict(msg, timestamp=timestamp(2019, 7, 7, 23, 59, 59)), receive_dt)
+        assert not message.match(dict(msg, timestamp=timestamp(2019, 7, 6, 0, 0, 0)), receive_dt)
+        assert day.call_count == 0
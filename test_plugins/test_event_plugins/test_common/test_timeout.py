@@ -1,3 +1,4 @@
+import calendar
 import pytest
 import mock
 
@@ -25,6 +26,7 @@ def manual_context():
 
 def patch_now(mocker, now):
     mocker.patch.object(TimeUtils, 'get_now', return_value=now)
+    mocker.patch.object(TimeUtils, 'get_now_ts', return_value=calendar.timegm(now.utctimetuple()))
 
 poke_interval = 60
 
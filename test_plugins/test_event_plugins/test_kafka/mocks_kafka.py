@@ -0,0 +1,323 @@
+# -*- coding: UTF-8 -*-
+''' In-memory stand-in of kafka and synthetic traffic for tests and load tests without broker
+
+    broker = FakeBroker(num_partitions=3)
+    patch_kafka(mocker, broker)     # KafkaConnector would use FakeConsumer/FakeProducer
+    generator = LoadGenerator(num_wanted=100, match_rate=0.01)
+    generator.produce(broker, 100000)
+'''
+import bisect
+import json
+import random
+import time
+import zlib
+
+from confluent_kafka import TopicPartition, TIMESTAMP_CREATE_TIME, \
+    OFFSET_BEGINNING, OFFSET_END, OFFSET_INVALID, OFFSET_STORED
+
+
+class FakeMessage(object):
+    ''' Subset of confluent_kafka.Message '''
+
+    __slots__ = ('_topic', '_partition', '_offset', '_key', '_value', '_timestamp')
+
+    def __init__(self, topic, partition, offset, key, value, timestamp):
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._key = key
+        self._value = value
+        self._timestamp = timestamp
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def key(self):
+        return self._key
+
+    def value(self):
+        return self._value
+
+    def timestamp(self):
+        return TIMESTAMP_CREATE_TIME, self._timestamp
+
+    def error(self):
+        return None
+
+
+class FakeBroker(object):
+    ''' Topics with partitions of messages, and committed offsets of consumer groups
+        Args:
+            num_partitions(int): partitions of topics created automatically
+    '''
+
+    def __init__(self, num_partitions=1):
+        self.num_partitions = num_partitions
+        self.partitions = dict()    # {topic: [[message]]}
+        self.committed = dict()     # {(group_id, topic, partition): offset}
+
+    def create_topic(self, topic, num_partitions=None):
+        if topic not in self.partitions:
+            self.partitions[topic] = [list() for _ in range(num_partitions or self.num_partitions)]
+        return self.partitions[topic]
+
+    def append(self, topic, value, key=None, partition=None, timestamp=None):
+        partitions = self.create_topic(topic)
+        if partition is None:
+            if key is None:
+                partition = sum(len(p) for p in partitions) % len(partitions)
+            else:
+                partition = zlib.crc32(key) % len(partitions)
+        if timestamp is None:
+            timestamp = int(time.time() * 1000)
+        msgs = partitions[partition]
+        msg = FakeMessage(topic, partition, len(msgs), key, value, timestamp)
+        msgs.append(msg)
+        return msg
+
+    def watermarks(self, topic, partition):
+        return 0, len(self.create_topic(topic)[partition])
+
+
+class FakeTopicMetadata(object):
+
+    def __init__(self, partitions):
+        self.partitions = dict((p, None) for p in range(len(partitions)))
+
+
+class FakeClusterMetadata(object):
+
+    def __init__(self, broker, topic=None):
+        topics = [topic] if topic else broker.partitions.keys()
+        self.topics = dict((t, FakeTopicMetadata(broker.create_topic(t))) for t in topics)
+
+
+class FakeConsumer(object):
+    ''' Subset of confluent_kafka.Consumer used by KafkaConnector.
+        Subscribed topics are assigned all partitions on the next consume (on_assign is
+        invoked there as librdkafka does in poll)
+    '''
+
+    def __init__(self, config, broker):
+        self.config = config
+        self.broker = broker
+        self.group_id = config.get('group.id')
+        self.auto_commit = config.get('enable.auto.commit', True)
+        self.positions = dict()     # {(topic, partition): offset}
+        self.paused = set()
+        self.subscription = None
+        self.on_assign = None
+        self.closed = False
+
+    def subscribe(self, topics, on_assign=None):
+        self.subscription = list(topics)
+        self.on_assign = on_assign
+        self.positions = dict()
+
+    def assign(self, partitions):
+        self.subscription = None
+        self.positions = dict()
+        for tp in partitions:
+            self.positions[(tp.topic, tp.partition)] = self._start_offset(tp.topic, tp.partition, tp.offset)
+
+    def assignment(self):
+        return [TopicPartition(t, p) for t, p in sorted(self.positions)]
+
+    def position(self, partitions):
+        return [TopicPartition(tp.topic, tp.partition,
+                               self.positions.get((tp.topic, tp.partition), OFFSET_INVALID))
+                for tp in partitions]
+
+    def pause(self, partitions):
+        self.paused.update((tp.topic, tp.partition) for tp in partitions)
+
+    def resume(self, partitions):
+        self.paused.difference_update((tp.topic, tp.partition) for tp in partitions)
+
+    def list_topics(self, topic=None, timeout=-1):
+        return FakeClusterMetadata(self.broker, topic)
+
+    def get_watermark_offsets(self, partition, timeout=None, cached=False):
+        return self.broker.watermarks(partition.topic, partition.partition)
+
+    def consume(self, num_messages=1, timeout=-1):
+        self._rebalance()
+        msgs = list()
+        for (topic, partition), offset in sorted(self.positions.items()):
+            if (topic, partition) in self.paused:
+                continue
+            batch = self.broker.create_topic(topic)[partition][offset:offset + num_messages - len(msgs)]
+            self.positions[(topic, partition)] = offset + len(batch)
+            msgs.extend(batch)
+            if len(msgs) >= num_messages:
+                break
+        if self.auto_commit:
+            self.commit()
+        return msgs
+
+    def commit(self, message=None, offsets=None, asynchronous=True):
+        if offsets is not None:
+            positions = dict(((tp.topic, tp.partition), tp.offset) for tp in offsets)
+        else:
+            positions = self.positions
+        for (topic, partition), offset in positions.items():
+            self.broker.committed[(self.group_id, topic, partition)] = offset
+
+    def close(self):
+        if self.auto_commit:
+            self.commit()
+        self.closed = True
+
+    def _rebalance(self):
+        if self.subscription is None or self.positions:
+            return
+        partitions = list()
+        for topic in self.subscription:
+            for partition in range(len(self.broker.create_topic(topic))):
+                offset = self._start_offset(topic, partition, OFFSET_STORED)
+                self.positions[(topic, partition)] = offset
+                partitions.append(TopicPartition(topic, partition, offset))
+        if self.on_assign:
+            self.on_assign(self, partitions)
+
+    def _start_offset(self, topic, partition, offset):
+        low, high = self.broker.watermarks(topic, partition)
+        if offset == OFFSET_STORED or offset < 0 and offset not in (OFFSET_BEGINNING, OFFSET_END):
+            offset = self.broker.committed.get((self.group_id, topic, partition), OFFSET_BEGINNING)
+        if offset == OFFSET_BEGINNING:
+            return low
+        elif offset == OFFSET_END:
+            return high
+        return offset
+
+
+class FakeProducer(object):
+    ''' Subset of confluent_kafka.Producer, messages are appended to broker immediately
+        and delivery callbacks are served by poll/flush
+    '''
+
+    def __init__(self, config, broker):
+        self.config = config
+        self.broker = broker
+        self.queue_size = int(config.get('queue.buffering.max.messages', 100000))
+        self.pending = list()
+
+    def produce(self, topic, value=None, key=None, callback=None, **kwargs):
+        if len(self.pending) >= self.queue_size:
+            raise BufferError('Local: Queue full')
+        msg = self.broker.append(topic, value, key=key)
+        self.pending.append((callback or kwargs.get('on_delivery'), msg))
+
+    def poll(self, timeout=None):
+        pending, self.pending = self.pending, list()
+        for callback, msg in pending:
+            if callback:
+                callback(None, msg)
+        return len(pending)
+
+    def flush(self, timeout=None):
+        self.poll()
+        return 0
+
+    def __len__(self):
+        return len(self.pending)
+
+
+def patch_kafka(mocker, broker):
+    ''' Make KafkaConnector connect to the in-memory broker '''
+    mocker.patch('event_plugins.kafka.kafka_connector.Consumer',
+                 side_effect=lambda config: FakeConsumer(config, broker))
+    mocker.patch('event_plugins.kafka.kafka_connector.Producer',
+                 side_effect=lambda config: FakeProducer(config, broker))
+    # no need to wait for partitions assigned
+    mocker.patch('event_plugins.kafka.kafka_connector.time.sleep')
+
+
+class LoadGenerator(object):
+    ''' Synthetic etl-finish / job-finish traffic
+        Args:
+            num_wanted(int): number of wanted messages of sensor
+            match_rate(float): ratio of messages that match one of wanted messages
+            topic_weights(dict): {topic: weight} of both wanted and produced messages
+            num_keys(int): distinct tables / jobs of the messages not matched
+            key_dist(str): 'uniform' or 'zipf', distribution of keys of messages
+            zipf_s(float): skew of zipf distribution, larger is more skewed
+            timestamp(int): `timestamp` in messages, now if not given
+            seed(int): seed of random, same seed generates same traffic
+    '''
+
+    topics = ['etl-finish', 'job-finish']
+
+    def __init__(self, num_wanted=10, match_rate=0.01, topic_weights=None, num_keys=1000,
+                 key_dist='uniform', zipf_s=1.1, timestamp=None, seed=0):
+        self.num_wanted = num_wanted
+        self.match_rate = match_rate
+        self.topic_weights = topic_weights or dict((t, 1) for t in self.topics)
+        self.num_keys = num_keys
+        self.key_dist = key_dist
+        self.timestamp = timestamp or int(time.time())
+        self.random = random.Random(seed)
+        if key_dist == 'zipf':
+            weights = [1.0 / (k ** zipf_s) for k in range(1, num_keys + 1)]
+        elif key_dist == 'uniform':
+            weights = [1.0] * num_keys
+        else:
+            raise ValueError('key_dist should be uniform or zipf')
+        self.key_cdf = self._cdf(weights)
+        self.topic_list = sorted(self.topic_weights)
+        self.topic_cdf = self._cdf([self.topic_weights[t] for t in self.topic_list])
+        self.wanted = [self._wanted_msg(i, self.topic_list[i % len(self.topic_list)])
+                       for i in range(num_wanted)]
+
+    @staticmethod
+    def _cdf(weights):
+        total = float(sum(weights))
+        cdf, acc = list(), 0
+        for w in weights:
+            acc += w
+            cdf.append(acc / total)
+        return cdf
+
+    def _pick(self, cdf):
+        return min(bisect.bisect_left(cdf, self.random.random()), len(cdf) - 1)
+
+    def _wanted_msg(self, i, topic):
+        if topic == 'etl-finish':
+            return {'frequency': 'D', 'topic': topic, 'db': 'db{}'.format(i % 10),
+                    'table': 'wanted{}'.format(i), 'partition_values': '',
+                    'task_id': 'etl{}'.format(i)}
+        return {'frequency': 'D', 'topic': topic, 'job_name': 'wanted{}'.format(i),
+                'is_success': True, 'task_id': 'job{}'.format(i)}
+
+    def wanted_msgs(self):
+        return [dict(m) for m in self.wanted]
+
+    def _value(self, topic, name, db='noise'):
+        if topic == 'etl-finish':
+            return {'db': db, 'table': name, 'partition_values': '', 'timestamp': self.timestamp}
+        return {'job_name': name, 'is_success': True, 'duration_time': 10,
+                'timestamp': self.timestamp}
+
+    def messages(self, n):
+        ''' Yield (topic, key, value) of n messages, value in json string '''
+        wanted = dict((t, [m for m in self.wanted if m['topic'] == t]) for t in self.topic_list)
+        for _ in range(n):
+            topic = self.topic_list[self._pick(self.topic_cdf)]
+            if wanted[topic] and self.random.random() < self.match_rate:
+                msg = wanted[topic][self._pick(self.key_cdf) % len(wanted[topic])]
+                name = msg['table'] if topic == 'etl-finish' else msg['job_name']
+                value = self._value(topic, name, msg.get('db'))
+            else:
+                name = 'key{}'.format(self._pick(self.key_cdf))
+                value = self._value(topic, name)
+            yield topic, name, json.dumps(value)
+
+    def produce(self, broker, n):
+        for topic, key, value in self.messages(n):
+            broker.append(topic, value, key=key, timestamp=self.timestamp * 1000)
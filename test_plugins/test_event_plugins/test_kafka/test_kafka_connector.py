@@ -0,0 +1,181 @@
+# -*- coding: UTF-8 -*-
+import pytest
+from confluent_kafka import TopicPartition, OFFSET_BEGINNING, OFFSET_INVALID
+
+from event_plugins.kafka.kafka_connector import KafkaConnector
+from event_plugins.kafka.produce.delivery import DeliverySummary
+
+from test_event_plugins.test_kafka.mocks_kafka import FakeBroker, patch_kafka
+
+
+@pytest.fixture()
+def consumer_cls(mocker):
+    mocker.patch('event_plugins.kafka.kafka_connector.time.sleep')
+    mocker.patch.object(KafkaConnector, 'assign_wait_secs', 0)
+    return mocker.patch('event_plugins.kafka.kafka_connector.Consumer')
+
+
+class TestKafkaConnector:
+
+    @pytest.mark.usefixtures("consumer_cls")
+    def test_set_consumer(self, consumer_cls):
+        connector = KafkaConnector(broker='localhost:9092')
+        connector.set_consumer('group', 'client', ['etl-finish'])
+        config = consumer_cls.call_args[0][0]
+        assert config['session.timeout.ms'] == 6000
+        assert 'group.instance.id' not in config
+        connector.consumer.subscribe.assert_called_once()
+
+    @pytest.mark.usefixtures("consumer_cls")
+    def test_set_consumer_static_membership(self, consumer_cls):
+        connector = KafkaConnector(broker='localhost:9092')
+        connector.set_consumer('group', 'client', ['etl-finish'],
+                               group_instance_id='dag.sensor', session_timeout=120)
+        config = consumer_cls.call_args[0][0]
+        assert config['group.instance.id'] == 'dag.sensor'
+        assert config['session.timeout.ms'] == 120000
+
+        # latency is recorded when partitions are assigned
+        on_assign = connector.consumer.subscribe.call_args[1]['on_assign']
+        on_assign(connector.consumer, [])
+        assert connector.assign_latency >= 0
+        # only the first assignment of a connect is measured
+        connector.connect_started_at -= 60
+        latency = connector.assign_latency
+        on_assign(connector.consumer, [])
+        assert connector.assign_latency == latency
+        connector.set_consumer('group', 'client', ['etl-finish'])
+        assert connector.assign_latency is None
+
+    def test_wait_for_assignment(self, mocker):
+        broker = FakeBroker(num_partitions=2)
+        patch_kafka(mocker, broker)
+        for i in range(10):
+            broker.append('etl-finish', 'msg{}'.format(i))
+        connector = KafkaConnector(broker='fake')
+        connector.set_consumer('group', 'client', ['etl-finish'])
+        # assigned by the first consume instead of waiting for a fixed time
+        assert 0 <= connector.assign_latency < connector.assign_wait_secs
+        # messages consumed while waiting are not lost
+        assert sorted(m.value() for m in connector.get_messages()) == \
+            sorted('msg{}'.format(i) for i in range(10))
+
+    @pytest.mark.usefixtures("consumer_cls")
+    def test_set_consumer_assign(self, consumer_cls, mocker):
+        connector = KafkaConnector(broker='localhost:9092')
+        metadata = mocker.MagicMock()
+        metadata.topics['etl-finish'].partitions = {0: None, 1: None}
+        consumer_cls.return_value.list_topics.return_value = metadata
+        connector.set_consumer('group', 'client', ['etl-finish'], offsets={('etl-finish', 1): 10})
+
+        config = consumer_cls.call_args[0][0]
+        assert config['enable.auto.commit'] is False
+        connector.consumer.subscribe.assert_not_called()
+        partitions = connector.consumer.assign.call_args[0][0]
+        assert [(p.topic, p.partition, p.offset) for p in partitions] == \
+            [('etl-finish', 0, OFFSET_BEGINNING), ('etl-finish', 1, 10)]
+
+        connector.consumer.position.return_value = [
+            TopicPartition('etl-finish', 0, OFFSET_INVALID),
+            TopicPartition('etl-finish', 1, 15)]
+        assert connector.get_offsets() == {('etl-finish', 1): 15}
+
+    @pytest.mark.usefixtures("consumer_cls")
+    def test_set_active_topics(self, consumer_cls):
+        connector = KafkaConnector(broker='localhost:9092')
+        connector.set_consumer('group', 'client', ['etl-finish', 'job-finish'])
+        etl_tp, job_tp = TopicPartition('etl-finish', 0), TopicPartition('job-finish', 0)
+        connector.consumer.assignment.return_value = [etl_tp, job_tp]
+
+        connector.set_active_topics(['etl-finish'])
+        assert connector.paused_topics == set(['job-finish'])
+        connector.consumer.pause.assert_called_with([job_tp])
+        connector.consumer.resume.assert_called_with([etl_tp])
+
+        # pause state is applied to partitions assigned by rebalance
+        on_assign = connector.consumer.subscribe.call_args[1]['on_assign']
+        new_job_tp = TopicPartition('job-finish', 1)
+        on_assign(connector.consumer, [new_job_tp])
+        connector.consumer.pause.assert_called_with([new_job_tp])
+
+        connector.set_active_topics(['etl-finish', 'job-finish'])
+        assert connector.paused_topics == set()
+        connector.consumer.resume.assert_called_with([etl_tp, job_tp])
+
+    def test_produce_batch(self, mocker):
+        producer = mocker.patch('event_plugins.kafka.kafka_connector.Producer').return_value
+        callbacks = list()
+
+        def produce(topic, data, callback):
+            if len(callbacks) == 1 and producer.produce.call_count == 2:
+                raise BufferError('Local: Queue full')
+            callbacks.append(callback)
+
+        def flush(timeout):
+            for i, callback in enumerate(callbacks[:-1]):
+                callback('Broker: Message timed out' if i == 0 else None, None)
+            return 1
+
+        producer.produce.side_effect = produce
+        producer.flush.side_effect = flush
+        connector = KafkaConnector(broker='localhost:9092')
+        connector.set_producer()
+        summary = connector.produce_batch(('job-finish', str(i)) for i in range(5))
+
+        # retry after queue is full and flush only once
+        assert producer.produce.call_count == 6
+        producer.poll.assert_any_call(0.5)
+        producer.flush.assert_called_once_with(30)
+        assert (summary.delivered, summary.failed, summary.undelivered) == (3, 1, 1)
+        assert summary.errors == {'Broker: Message timed out': 1}
+        assert not summary.ok
+        assert summary.percentile(50) >= 0
+
+    def test_delivery_summary_sampled(self):
+        summary = DeliverySummary(max_samples=100)
+        for i in range(10000):
+            summary.record(None, i / 10000.0)
+        # memory is bounded by the sample, and the percentiles are close to the real ones
+        assert len(summary.latencies) == 100
+        assert summary.delivered == 10000 and summary.max_latency == 0.9999
+        assert 0.3 < summary.percentile(50) < 0.7
+        assert 'max: 1.000s' in str(summary)
+
+    def test_set_producer_profile(self, mocker):
+        producer_cls = mocker.patch('event_plugins.kafka.kafka_connector.Producer')
+        connector = KafkaConnector(broker='localhost:9092')
+        connector.set_producer()
+        assert producer_cls.call_args[0][0] == {'bootstrap.servers': 'localhost:9092'}
+
+        connector.set_producer('throughput', {'linger.ms': 10})
+        config = producer_cls.call_args[0][0]
+        assert config['compression.codec'] == 'lz4'
+        assert config['linger.ms'] == 10
+        assert config['bootstrap.servers'] == 'localhost:9092'
+        # profile is not modified by config
+        assert connector.producer_profiles['throughput']['linger.ms'] == 100
+
+        with pytest.raises(ValueError):
+            connector.set_producer('unknown')
+
+    @pytest.mark.usefixtures("consumer_cls")
+    def test_get_lag(self, consumer_cls):
+        connector = KafkaConnector(broker='localhost:9092')
+        connector.set_consumer('group', 'client', ['etl-finish', 'job-finish'])
+        connector.consumer.assignment.return_value = [
+            TopicPartition('etl-finish', 0), TopicPartition('etl-finish', 1),
+            TopicPartition('job-finish', 0)]
+        connector.consumer.position.side_effect = lambda partitions: [
+            TopicPartition(tp.topic, tp.partition, OFFSET_INVALID if tp.partition else 90)
+            for tp in partitions]
+        connector.consumer.get_watermark_offsets.side_effect = \
+            lambda tp, timeout=None, cached=False: (10, 100) if not cached else \
+            (OFFSET_INVALID, 105 if tp.partition == 0 else OFFSET_INVALID)
+
+        connector.paused_topics = set(['job-finish'])
+        # position is the low watermark if nothing consumed, paused topics are excluded
+        assert connector.get_lag() == {('etl-finish', 0): 15, ('etl-finish', 1): 90}
+        # broker is only queried for the watermarks not cached from fetching
+        queried = [c[0][0].partition for c in connector.consumer.get_watermark_offsets.call_args_list
+                   if not c[1].get('cached')]
+        assert queried == [1]
@@ -1,19 +1,29 @@
 # -*- coding: UTF-8 -*-
+import calendar
 import json
+import multiprocessing
 import os
 import pytest
+from airflow.exceptions import AirflowException
+from confluent_kafka import TIMESTAMP_CREATE_TIME, TIMESTAMP_NOT_AVAILABLE
 
 from event_plugins import factory
 from event_plugins.common.schedule.time_utils import TimeUtils, AIRFLOW_EVENT_PLUGINS_TIMEZONE
 from event_plugins.common.storage.db import get_session
 from event_plugins.common.storage.event_message import EventMessage
 from event_plugins.kafka.kafka_consumer_plugin import KafkaConsumerOperator
+from event_plugins.kafka.consume.topic import job_finish
 from event_plugins.kafka.kafka_handler import KafkaHandler
 from event_plugins.kafka.kafka_connector import KafkaConnector
+from event_plugins.kafka.kafka_producer_plugin import KafkaProducerOperator
+
+from test_event_plugins.test_kafka.mocks_kafka import FakeBroker, FakeConsumer, LoadGenerator, \
+    patch_kafka
 
 
 def patch_now(mocker, now):
     mocker.patch.object(TimeUtils, 'get_now', return_value=now)
+    mocker.patch.object(TimeUtils, 'get_now_ts', return_value=calendar.timegm(now.utctimetuple()))
 
 
 class FakeKafkaMsg:
@@ -168,6 +178,7 @@ class TestKafkaConsumerOperator:
         mocker.patch.object(KafkaConnector, 'get_messages', return_value=[TestMsg('a', fake_now), TestMsg('b', fake_now)])
         is_criteria_met = operator.poke(context=None, consumer=consumer)
         assert is_criteria_met == True
+        operator.close_connection()
 
 
     def test_poke_D_M_messages(self, mocker):
@@ -290,3 +301,259 @@ class TestKafkaConsumerOperator:
         is_criteria_met = operator.poke(context=None, consumer=consumer)
         assert is_criteria_met == False
         assert len(operator.db_handler.get_unreceived_msgs()) == 2
+        operator.close_connection()
+
+
+    def test_report_lag(self, mocker):
+        operator = KafkaConsumerOperator(
+            task_id='test',
+            broker=None,
+            sensor_name="test",
+            group_id='test',
+            client_id='test',
+            msgs=[],
+            poke_interval=2,
+            timeout=10
+        )
+        consumer = KafkaConnector(broker=None)
+        mocker.patch.object(consumer, 'get_lag', return_value={
+            ('etl-finish', 0): 10, ('etl-finish', 1): 5, ('job-finish', 0): 0})
+        operator.report_lag(consumer)
+        assert operator.metrics.gauges == {
+            'lag.etl-finish.0': 10, 'lag.etl-finish.1': 5, 'lag.job-finish.0': 0,
+            'lag.etl-finish': 15, 'lag.job-finish': 0}
+
+
+    def test_static_membership(self, mocker):
+        def create_operator(**kwargs):
+            return KafkaConsumerOperator(task_id='test', broker=None, sensor_name='test',
+                                         group_id='test', client_id='test', msgs=[],
+                                         poke_interval=60, jitter=30, timeout=10, **kwargs)
+
+        mocker.patch('confluent_kafka.libversion', return_value=('1.3.0', 0x010300ff))
+        assert create_operator().get_session_timeout() is None
+        with pytest.raises(AirflowException):
+            create_operator(static_membership=True)
+
+        mocker.patch('confluent_kafka.libversion', return_value=('1.4.0', 0x010400ff))
+        operator = create_operator(static_membership=True)
+        assert operator.get_session_timeout() == 60 + 30 + 60
+        assert create_operator(static_membership=True, session_timeout=300).get_session_timeout() == 300
+        # the next poke may wait for a period of wake-up slots if rate limited
+        operator.spreader.max_wakeups_per_sec = 5
+        mocker.patch.object(operator.db_handler, 'get_sensor_slot', return_value=(1000, 1))
+        assert operator.get_session_timeout() == 60 + 30 + 1000 / 5 + 60
+
+
+    def test_decode_and_match_workers(self):
+        now = TimeUtils().datetime(2019, 7, 7, 8, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        ts = int((now - TimeUtils().datetime(1970, 1, 1, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)).total_seconds())
+        broker = FakeBroker(num_partitions=4)
+        generator = LoadGenerator(num_wanted=20, match_rate=0.2, timestamp=ts)
+        generator.produce(broker, 1000)
+        broker.append('etl-finish', 'non-json', partition=1)
+        msgs = [m for topic in sorted(broker.partitions) for p in broker.partitions[topic] for m in p]
+
+        def decode_and_match(match_workers):
+            operator = KafkaConsumerOperator(
+                task_id='test', broker=None, sensor_name="test", group_id='test', client_id='test',
+                msgs=generator.wanted_msgs(), poke_interval=2, match_workers=match_workers)
+            return operator.decode_and_match(msgs, now), operator.metrics
+
+        (rows, matches, errors), metrics = decode_and_match(1)
+        (workers_rows, workers_matches, workers_errors), workers_metrics = decode_and_match(3)
+        # results are in the consumed order, message not in json is skipped by decoding
+        non_json = [i for i, m in enumerate(msgs) if m.value() == 'non-json']
+        assert [r[0] for r in workers_rows] == [r[0] for r in rows] == \
+            [i for i in range(len(msgs)) if i not in non_json]
+        assert workers_matches == matches
+        assert len(matches) > 20
+        assert workers_errors == errors == dict()
+        assert workers_metrics.counters['skipped'] == metrics.counters['skipped'] == 1
+        assert workers_metrics.timer.get('parallel_match') > 0
+        assert workers_metrics.timer.get('decode') > 0
+
+    @pytest.mark.parametrize("consume_mode, batch_match, match_workers, prefetch_batches",
+                             [('subscribe', False, 1, 0), ('assign', False, 1, 0),
+                              ('subscribe', True, 3, 0), ('assign', True, 1, 2)])
+    def test_poke_with_fake_broker(self, mocker, consume_mode, batch_match, match_workers,
+                                   prefetch_batches):
+        now = TimeUtils().datetime(2019, 7, 7, 8, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        patch_now(mocker, now)
+        ts = int((now - TimeUtils().datetime(1970, 1, 1, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)).total_seconds())
+        broker = FakeBroker(num_partitions=3)
+        patch_kafka(mocker, broker)
+        generator = LoadGenerator(num_wanted=20, match_rate=0.05, key_dist='zipf', timestamp=ts)
+
+        # produce the traffic through producer operator
+        msgs = list(generator.messages(2000))
+        for topic in generator.topics:
+            KafkaProducerOperator(
+                task_id='send', broker='fake', topic=topic,
+                data=[value for t, _, value in msgs if t == topic]
+            ).execute(context=None)
+        assert sum(len(p) for t in broker.partitions.values() for p in t) == 2000
+
+        operator = KafkaConsumerOperator(
+            task_id='test',
+            broker='fake',
+            sensor_name="test",
+            group_id='test',
+            client_id='test',
+            msgs=generator.wanted_msgs(),
+            poke_interval=2,
+            timeout=10,
+            consume_mode=consume_mode,
+            batch_match=batch_match,
+            match_workers=match_workers,
+            prefetch_batches=prefetch_batches
+        )
+        operator.initialize_db_handler()
+        operator.initialize_conn_handler()
+        operator.poke(context=None, consumer=operator.conn_handler)
+        received = [json.loads(m.msg)['task_id'] for m in operator.db_handler.get_sensor_messages()
+                    if m.last_receive_time is not None]
+        matched = set(json.loads(v).get('table') or json.loads(v)['job_name'] for _, _, v in msgs)
+        assert set(received) == set(m['task_id'] for m in generator.wanted_msgs()
+                                    if m.get('table', m.get('job_name')) in matched)
+        # all messages are consumed
+        assert set(operator.conn_handler.get_lag().values()) == set([0])
+        operator.close_connection()
+
+    def test_poke_with_sharded_consumers(self, mocker):
+        now = TimeUtils().datetime(2019, 7, 7, 8, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        patch_now(mocker, now)
+        ts = int((now - TimeUtils().datetime(1970, 1, 1, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)).total_seconds())
+        broker = FakeBroker(num_partitions=3)
+        # shards are forked with the patched consumer and broker, commits of shards are
+        # recorded in the parent as (client.id, offsets)
+        patch_kafka(mocker, broker)
+        commits = multiprocessing.Manager().list()
+        mocker.patch.object(FakeConsumer, 'commit', autospec=True,
+                            side_effect=lambda consumer, offsets=None, **kwargs: commits.append(
+                                (consumer.config['client.id'],
+                                 dict(((tp.topic, tp.partition), tp.offset) for tp in offsets))))
+        generator = LoadGenerator(num_wanted=20, match_rate=0.05, timestamp=ts)
+        msgs = list(generator.messages(2000))
+        for topic, _, value in msgs:
+            broker.append(topic, value)
+
+        with pytest.raises(AirflowException):
+            KafkaConsumerOperator(task_id='test', broker='fake', group_id='test', client_id='test',
+                                  msgs=generator.wanted_msgs(), consume_mode='assign', num_shards=2)
+        operator = KafkaConsumerOperator(
+            task_id='test',
+            broker='fake',
+            sensor_name="test",
+            group_id='test',
+            client_id='test',
+            msgs=generator.wanted_msgs(),
+            poke_interval=2,
+            timeout=10,
+            num_shards=2
+        )
+        # keep the counters of the poke
+        mocker.patch.object(operator, 'emit_metrics')
+        operator.initialize_db_handler()
+        operator.initialize_conn_handler()
+        shards = list(operator.conn_handler.shards)
+        assert [p.name for p in shards] == ['test-shard-0', 'test-shard-1']
+        operator.poke(context=None, consumer=operator.conn_handler)
+        received = [json.loads(m.msg)['task_id'] for m in operator.db_handler.get_sensor_messages()
+                    if m.last_receive_time is not None]
+        matched = set(json.loads(v).get('table') or json.loads(v)['job_name'] for _, _, v in msgs)
+        assert set(received) == set(m['task_id'] for m in generator.wanted_msgs()
+                                    if m.get('table', m.get('job_name')) in matched)
+        # the fake broker assigns all partitions to every member, so both shards consume all
+        assert operator.metrics.counters['shards.consumed'] >= 2000
+        assert operator.metrics.counters['shards.matched'] >= len(set(received))
+        assert operator.conn_handler.get_offsets() == dict(
+            ((topic, p), len(broker.partitions[topic][p]))
+            for topic in broker.partitions for p in range(3))
+
+        offsets = operator.conn_handler.get_offsets()
+
+        operator.close_connection()
+        assert not any(p.is_alive() for p in shards)
+        assert operator.conn_handler.shards == []
+        # commits sent by poke are applied before shards stop
+        assert sorted(client for client, _ in commits) == ['test-0', 'test-1']
+        assert dict(commits)['test-0'] == offsets and dict(commits)['test-1'] == offsets
+
+
+class TestKafkaAllMessageHandler:
+
+    def test_match_skip_inactive_topics(self):
+        now = TimeUtils().datetime(2019, 7, 7, 8, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        a = {'frequency': 'D', 'topic': 'etl-finish', 'db': 'db0', 'table': 'table0',
+                'partition_values': "", 'task_id': "tbla"}
+        c = {'frequency': 'D', 'topic': 'job-finish', 'job_name': 'jn0', 'is_success': True,
+                'task_id': "tblc"}
+        handler = KafkaHandler('kafka').all_msgs_handler([a, c])
+        assert handler.match(TestMsg('c', now), now)[0] == c
+
+        handler.set_active_topics(['etl-finish'])
+        assert handler.match(TestMsg('c', now), now) == (None, None)
+        # messages of inactive topics are not decoded
+        assert handler.match(FakeKafkaMsg('job-finish', 'non-json'), now) == (None, None)
+        assert handler.match(TestMsg('a', now), now)[0] == a
+
+    def test_event_time(self, mocker):
+        handler = KafkaHandler('kafka').all_msgs_handler([])
+        # producer's timestamp in message
+        decoded = handler.decode(FakeKafkaMsg('job-finish', '{"timestamp": 1560925430}'))
+        assert handler.event_time(decoded) == TimeUtils().datetime(
+            2019, 6, 19, 6, 23, 50, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        # kafka message timestamp (milliseconds)
+        msg = FakeKafkaMsg('job-finish', '{"job_name": "jn0"}')
+        msg.timestamp = mocker.Mock(return_value=(TIMESTAMP_CREATE_TIME, 1560925430500))
+        assert handler.event_time(handler.decode(msg)) == TimeUtils().datetime(
+            2019, 6, 19, 6, 23, 50, 500000, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        msg.timestamp = mocker.Mock(return_value=(TIMESTAMP_NOT_AVAILABLE, 0))
+        assert handler.event_time(handler.decode(msg)) is None
+
+    def test_match_batch(self):
+        now = TimeUtils().datetime(2019, 7, 7, 8, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        ts = int((now - TimeUtils().datetime(1970, 1, 1, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)).total_seconds())
+        generator = LoadGenerator(num_wanted=20, match_rate=0.2, timestamp=ts)
+        msgs = [FakeKafkaMsg(topic, value) for topic, _, value in generator.messages(500)]
+        hit = [m for m in msgs if 'wanted' in m.v][0]
+        wanted = json.loads(hit.v)
+        # not the same day, time key not a timestamp, missing keys and not a json object
+        msgs += [FakeKafkaMsg(hit.t, json.dumps(dict(wanted, timestamp=ts - 86400))),
+                 FakeKafkaMsg(hit.t, json.dumps(dict(wanted, timestamp='20190707'))),
+                 FakeKafkaMsg('etl-finish', json.dumps({'db': 'db0'})),
+                 FakeKafkaMsg('job-finish', '[1, 2]')]
+        msgs.append(FakeKafkaMsg('job-finish', json.dumps({'job_name': 'wanted1', 'is_success': True,
+                                                           'timestamp': ts + 3600})))
+
+        handler = KafkaHandler('kafka').all_msgs_handler(generator.wanted_msgs())
+        decoded = [handler.decode(m) for m in msgs]
+        matches, errors = handler.match_batch(decoded, now)
+        handler.set_batch_match(True)
+        batch_matches, batch_errors = handler.match_batch(decoded, now)
+        assert len(matches) > 20
+        assert batch_matches == matches
+        assert sorted(batch_errors) == sorted(errors) == [len(msgs) - 4, len(msgs) - 3, len(msgs) - 2]
+        assert len(msgs) - 1 in batch_matches
+        # matched by columns
+        assert handler.get_wanted_index('job-finish') is not None
+
+    def test_match_batch_overridden_match_handler(self, mocker):
+        now = TimeUtils().datetime(2019, 7, 7, 8, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+        ts = int((now - TimeUtils().datetime(1970, 1, 1, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)).total_seconds())
+        # job-finish messages of any day are matched
+        mocker.patch.object(job_finish.JobFinishMatch, 'match_by_tkey',
+                            staticmethod(lambda msg_day, wanted_day: True))
+        wanted = {'frequency': 'D', 'topic': 'job-finish', 'job_name': 'joba', 'is_success': True,
+                  'task_id': 'joba'}
+        msgs = [FakeKafkaMsg('job-finish', json.dumps({'job_name': 'joba', 'is_success': True,
+                                                       'timestamp': ts - 86400 * 3}))]
+
+        handler = KafkaHandler('kafka').all_msgs_handler([wanted])
+        handler.set_batch_match(True)
+        decoded = [handler.decode(m) for m in msgs]
+        matches, errors = handler.match_batch(decoded, now)
+        # matched one by one by the overridden handler
+        assert handler.get_wanted_index('job-finish') is None
+        assert (matches, errors) == ({0: (wanted, decoded[0].value)}, {})
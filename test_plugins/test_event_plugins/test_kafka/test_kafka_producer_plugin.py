@@ -1,11 +1,20 @@
 # -*- coding: UTF-8 -*-
+import bz2
+import gzip
 import json
 import os
 import pytest
+from multiprocessing.pool import ThreadPool
 
-from event_plugins.kafka.produce.utils import merge_multiple_files
+from airflow.exceptions import AirflowException
+from event_plugins.common.metrics import StageTimer
+from event_plugins.kafka.produce.utils import encode_message, iter_messages, \
+    merge_multiple_files, read_pool
+from event_plugins.kafka.produce.delivery import DeliverySummary
 from event_plugins.kafka.produce.factory import topic_factory
-from event_plugins.kafka.kafka_producer_plugin import KafkaProducerFromMergeFileOperator
+from event_plugins.kafka.produce.merge import MergeEngine
+from event_plugins.kafka.kafka_producer_plugin import KafkaProducerFromFileOperator, \
+    KafkaProducerFromMergeFileOperator, KafkaProducerOperator
 
 
 test_home = os.path.join(os.environ.get('SERVICE_HOME'), 'test_plugins')
@@ -85,12 +94,79 @@ class TestKafkaProducerFromMergeFileOperator:
         assert len(result["job-finish"]) == 4
         assert len(result["hive-sink-finish"]) == 2
 
+    def test_iter_messages_compressed(self, tmpdir):
+        lines = [
+            '{"topic": "job-finish", "data": [{"job_name": "\\u4e2d", "is_success": true, "proj_name": "p"}]}',
+            "{'topic': 'job-finish', 'data': [{'job_name': 'legacy', 'is_success': true}]}",
+            '']
+        gz_path, bz2_path = str(tmpdir.join('a.gz')), str(tmpdir.join('b.txt'))
+        with gzip.open(gz_path, 'wb') as f:
+            f.write("\n".join(lines))
+        f = bz2.BZ2File(bz2_path, 'wb')
+        f.write("\n".join(lines[:1]))
+        f.close()
+
+        msgs = iter_messages([gz_path, bz2_path, file_list[0]])
+        topic, msg = next(msgs)
+        assert topic == 'job-finish'
+        # keys are kept in order and payload is encoded as utf-8 bytes
+        assert encode_message(msg) == '{"job_name": "\\u4e2d", "is_success": true, "proj_name": "p"}'
+        assert encode_message(msg, ensure_ascii=False) == \
+            '{"job_name": "\xe4\xb8\xad", "is_success": true, "proj_name": "p"}'
+        assert next(msgs) == ('job-finish', {'job_name': 'legacy', 'is_success': True})
+        assert len(list(msgs)) == 1 + 3
+
+    @pytest.mark.parametrize("pool", ['thread', 'process'])
+    def test_iter_messages_parallel(self, pool):
+        files = file_list * 3
+        serial = list(iter_messages(files))
+        timer = StageTimer()
+        msgs = list(iter_messages(files, workers=2, pool=pool, timer=timer))
+        assert msgs == serial
+        assert timer.get('read') > 0 and timer.get('parse') > 0
+        unordered = iter_messages(files, workers=2, pool=pool, keep_order=False)
+        assert sorted(map(json.dumps, unordered)) == sorted(map(json.dumps, serial))
+        # failure of unordered read is raised instead of waiting forever
+        with pytest.raises(IOError):
+            list(iter_messages(file_list + ['not_exist'], workers=2, pool=pool, keep_order=False))
+        # pool created by read_pool is shared and not terminated by the iterator
+        with read_pool(2, pool) as worker_pool:
+            assert list(iter_messages(files, workers=2, worker_pool=worker_pool)) == serial
+            assert list(iter_messages(files, workers=2, worker_pool=worker_pool)) == serial
+
+    def test_read_pool_before_producer(self, mocker):
+        calls = list()
+        summary = DeliverySummary()
+
+        def create_pool(workers):
+            calls.append('pool')
+            return ThreadPool(workers)
+
+        def initialize_conn_handler():
+            calls.append('producer')
+            op.conn_handler = mocker.Mock()
+            op.conn_handler.produce_batch.side_effect = \
+                lambda msgs, flush_timeout: calls.append(len(list(msgs))) or summary
+
+        mocker.patch.dict('event_plugins.kafka.produce.utils.read_pools',
+                          {'process': create_pool})
+        op = KafkaProducerFromFileOperator(
+            task_id='test_send_from_file',
+            broker='localhost:9092',
+            file_list=file_list,
+            read_workers=2,
+            read_pool='process'
+        )
+        mocker.patch.object(op, 'initialize_conn_handler', side_effect=initialize_conn_handler)
+        op.execute({})
+        assert calls == ['pool', 'producer', 6]
+
     def test_factory(self):
         assert topic_factory("job-finish") == topic_factory("uat-job-finish")
         assert topic_factory("hive-sink-finish") == topic_factory("uat-hive-sink-finish")
         assert topic_factory("test_none") is None
 
-    def test_get_merge_msg(self):
+    def test_merge_engine(self):
         match_dict = {
             'HiveSinkFinish': [
                 {'db': 'tmp',
@@ -104,46 +180,87 @@ class TestKafkaProducerFromMergeFileOperator:
             ]
         }
         result = merge_multiple_files(file_list)
+        assert sorted(result) == ['hive-sink-finish', 'job-finish']
+        for topic, msgs in result.iteritems():
+            handler_cls = topic_factory(topic)
+            engine = MergeEngine(handler_cls, match_dict[handler_cls.__name__])
+            for msg in msgs:
+                engine.add(msg)
+            merge_msgs = engine.get_merge_msgs()
+            if topic == 'hive-sink-finish':
+                assert len(merge_msgs) == 1
+                assert cmp(merge_msgs[0], {
+                    'db': 'tmp',
+                    'table': 'test',
+                    'partition_fields': 'group',
+                    'partition_values': 'gp_001+gp_002',
+                    'count': 100,
+                    'data_date': '2019-07-14',
+                    'system_datetime': '2019-07-29 14:30:00',
+                    'duration_time': 500,
+                    'options': {'items_info':
+                        [{'item_id': 'ctct0003', 'item_name': 'ghi', 'count': 789},
+                         {'item_id': 'ctct0004', 'item_name': 'jkl', 'count': 100}]
+                    }
+                }) == 0
+            elif topic == 'job-finish':
+                assert len(merge_msgs) == 2
+                assert cmp(merge_msgs[0], {
+                    "duration_time": 200,
+                    "timestamp": 1564568770,
+                    "is_success": True,
+                    "job_name": "gp_001+gp_002",
+                    "proj_name": "test_gp"
+                }) == 0
+                assert cmp(merge_msgs[1], {
+                    "duration_time": 300,
+                    "timestamp": 1564569650,
+                    "is_success": True,
+                    "job_name": "ds1+ds2",
+                    "proj_name": "test_ds"
+                }) == 0
+
+    def test_get_merge_batch(self):
+        match_dict = {
+            'JobFinish': [
+                {'proj_name': 'test_gp', 'is_success': True},
+                {'proj_name': 'test_none', 'is_success': True},
+                # message is merged into every group it matches
+                {'is_success': True}
+            ]
+        }
         op = KafkaProducerFromMergeFileOperator(
             task_id='test_send_from_merge_file',
             broker='localhost:9092',
             match_dict=match_dict,
             file_list=file_list
         )
-        for topic, msgs in result.iteritems():
-            merge_msgs = op.get_merge_msg(
-                topic_factory(topic), topic, result[topic])
-            if merge_msgs:
-                merge_msgs = list(merge_msgs)
-                if topic == 'hive-sink-finish':
-                    assert len(merge_msgs) == 1
-                    assert cmp(merge_msgs[0], {
-                        'db': 'tmp',
-                        'table': 'test',
-                        'partition_fields': 'group',
-                        'partition_values': 'gp_001+gp_002',
-                        'count': 100,
-                        'data_date': '2019-07-14',
-                        'system_datetime': '2019-07-29 14:30:00',
-                        'duration_time': 500,
-                        'options': {'items_info':
-                            [{'item_id': 'ctct0003', 'item_name': 'ghi', 'count': 789},
-                             {'item_id': 'ctct0004', 'item_name': 'jkl', 'count': 100}]
-                        }
-                    }) == 0
-                elif topic == 'job-finish':
-                    assert len(merge_msgs) == 2
-                    assert cmp(merge_msgs[0], {
-                        "duration_time": 200,
-                        "timestamp": 1564568770,
-                        "is_success": True,
-                        "job_name": "gp_001+gp_002",
-                        "proj_name": "test_gp"
-                    }) == 0
-                    assert cmp(merge_msgs[1], {
-                        "duration_time": 300,
-                        "timestamp": 1564569650,
-                        "is_success": True,
-                        "job_name": "ds1+ds2",
-                        "proj_name": "test_ds"
-                    }) == 0
+        msgs = list(iter_messages(file_list))
+        batch = list(op.get_merge_batch(msgs))
+        # HiveSinkFinish is not in match_dict and empty group is not produced
+        assert [topic for topic, _ in batch] == ['job-finish', 'job-finish']
+        assert json.loads(batch[0][1])['job_name'] == 'gp_001+gp_002'
+        assert json.loads(batch[1][1])['job_name'] == 'gp_001+ds1+gp_002+ds2'
+        assert json.loads(batch[1][1])['duration_time'] == 500
+        # input messages are not modified by merging
+        assert [m['job_name'] for t, m in msgs if t == 'job-finish'] == ['gp_001', 'ds1', 'gp_002', 'ds2']
+
+    def test_produce_fails_when_undelivered(self, mocker):
+        summary = DeliverySummary()
+        summary.delivered, summary.undelivered = 1, 1
+        conn_handler = mocker.Mock(**{'produce_batch.return_value': summary})
+        mocker.patch.object(KafkaProducerOperator, 'initialize_conn_handler')
+        op = KafkaProducerOperator(
+            task_id='test_send',
+            broker='localhost:9092',
+            topic='job-finish',
+            data=['a', 'b'],
+            flush_timeout=60
+        )
+        op.conn_handler = conn_handler
+        with pytest.raises(AirflowException):
+            op.execute({})
+        assert conn_handler.produce_batch.call_args[1] == {'flush_timeout': 60}
+
+        summary.undelivered = 0
+        op.execute({})
@@ -0,0 +1,105 @@
+# -*- coding: UTF-8 -*-
+import json
+import pytest
+
+from event_plugins.common.schedule.time_utils import TimeUtils, AIRFLOW_EVENT_PLUGINS_TIMEZONE
+from event_plugins.kafka.replay import Recording, ReplayConnector, ReplayMessage, replay, main
+
+
+START = TimeUtils().datetime(2019, 7, 7, 8, 0, 0, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)
+START_TS = int((START - TimeUtils().datetime(1970, 1, 1, tzinfo=AIRFLOW_EVENT_PLUGINS_TIMEZONE)).total_seconds())
+
+
+def record(topic, partition, offset, seconds, value):
+    ''' line of recording produced `seconds` after START '''
+    value = dict(value, timestamp=START_TS + seconds)
+    return {'topic': topic, 'partition': partition, 'offset': offset,
+            'timestamp': (START_TS + seconds) * 1000, 'value': value}
+
+
+@pytest.fixture()
+def wanted_msgs():
+    return [
+        {'frequency': 'D', 'topic': 'etl-finish', 'db': 'db0', 'table': 'table0',
+            'partition_values': "", 'task_id': "tbla"},
+        {'frequency': 'D', 'topic': 'job-finish', 'job_name': 'jn0', 'is_success': True,
+            'task_id': "joba"}
+    ]
+
+
+@pytest.fixture()
+def recording_file(tmpdir):
+    lines = [record('etl-finish', 0, i, i, {'db': 'db0', 'table': 'noise', 'partition_values': ''})
+             for i in range(100)]
+    lines.append(record('etl-finish', 1, 0, 130, {'db': 'db0', 'table': 'table0', 'partition_values': ''}))
+    lines.append(record('job-finish', 0, 0, 10, {'job_name': 'noise', 'is_success': True}))
+    lines.append(record('job-finish', 0, 1, 250, {'job_name': 'jn0', 'is_success': True}))
+    # not consumed, criteria are met before
+    lines.append(record('job-finish', 0, 2, 500, {'job_name': 'noise', 'is_success': True}))
+    path = tmpdir.join('recording.json')
+    path.write('\n'.join(json.dumps(l) for l in lines))
+    return str(path)
+
+
+class TestReplay:
+
+    def test_replay_message_from_kafkacat(self):
+        msg = ReplayMessage.from_json({'topic': 't', 'partition': 1, 'offset': 5, 'tstype': 'create',
+                                       'ts': 1000, 'key': None, 'payload': '{"a": 1}'})
+        assert (msg.topic(), msg.partition(), msg.offset(), msg.value()) == ('t', 1, 5, '{"a": 1}')
+        assert msg.timestamp()[1] == 1000
+
+    def test_replay_connector(self, recording_file):
+        recording = Recording.load(recording_file)
+        assert len(recording) == 104
+        connector = ReplayConnector(recording, poke_interval=60)
+        connector.set_consumer('g', 'c', ['etl-finish'], offsets={('etl-finish', 0): 50})
+
+        # first window: offset 50 ~ 59 of partition 0
+        assert connector.tick()
+        assert [m.offset() for m in connector.get_messages()] == range(50, 60)
+        assert connector.get_offsets() == {('etl-finish', 0): 60}
+        assert connector.now() == TimeUtils().add_seconds(START, 60)
+        # lag is the messages produced before the replay clock but not consumed
+        connector.tick()
+        assert connector.get_lag() == {('etl-finish', 0): 40, ('etl-finish', 1): 0}
+
+        # paused topics are consumed after resumed
+        connector.set_active_topics([])
+        assert connector.get_messages() == []
+        connector.set_topics(['etl-finish', 'job-finish'])
+        connector.set_active_topics(['etl-finish', 'job-finish'])
+        assert len(connector.get_messages()) == 40 + 1
+        connector.tick()
+        assert len(connector.get_messages()) == 1
+
+    def test_replay(self, wanted_msgs, recording_file, mocker):
+        # the status db in config is never connected
+        get_session = mocker.patch('event_plugins.base.base_consumer_plugin.get_session')
+        report = replay(Recording.load(recording_file), wanted_msgs, poke_interval=60,
+                        write_behind=True)
+        assert not get_session.called
+
+        assert [(m['task_id'], m['poke']) for m in report.matches] == [('tbla', 3), ('joba', 5)]
+        assert report.criteria_met_at == 5
+        assert report.pokes == 5
+        assert report.unreceived == []
+        assert report.counters['consumed'] == 103
+        assert report.counters['matched'] == 2
+        assert report.counters['db_queries'] > 0
+        assert report.timer.get('match') > 0
+        assert report.matches[0]['replay_time'] == TimeUtils().cvt_datetime2str(
+            TimeUtils().add_seconds(START, 180))
+        # replay clock is restored
+        assert TimeUtils().get_now().date() != START.date()
+
+    def test_replay_main(self, wanted_msgs, recording_file, tmpdir):
+        msgs_file = tmpdir.join('msgs.json')
+        msgs_file.write(json.dumps(wanted_msgs[:1]))
+        output = tmpdir.join('report.json')
+        main([recording_file, str(msgs_file), '--poke-interval', '600',
+              '--consume-mode', 'assign', '--output', str(output)])
+        report = json.loads(output.read())
+        assert report['pokes'] == 1
+        assert report['criteria_met_at_poke'] == 1
+        assert [m['task_id'] for m in report['matches']] == ['tbla']